@@ -0,0 +1,101 @@
+import os
+import random
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from website import create_app, db
+
+GENRES = ['pop', 'rock', 'hip hop', 'jazz', 'country']
+WORDS = ['love', 'night', 'fire', 'dream', 'heart', 'blue', 'summer', 'rain']
+
+
+'''
+    Write a small catalog with the original (unmigrated) Music.db tables
+
+    args:
+        path (str): database file to create,
+        songs (int): number of Song rows
+'''
+
+
+def make_catalog(path, songs=200):
+    rng = random.Random(1)
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE Song (TrackURI TEXT, Song TEXT, ArtistURI TEXT, Artist TEXT,
+            AlbumURI TEXT, Album TEXT, AlbumImageURL TEXT, TrackDuration INTEGER,
+            Explicit TEXT, Popularity INTEGER, Danceability REAL, Energy REAL,
+            Loudness REAL, Speechiness REAL, Acousticness REAL, Instrumentalness REAL,
+            Liveness REAL, Valence REAL, Label TEXT, ReleaseDate TEXT);
+        CREATE TABLE Album (Ranking INTEGER, Album TEXT, Artist TEXT, ReleaseDate TEXT,
+            Genres TEXT, AverageRating REAL, NumberofReviews INTEGER);
+        CREATE TABLE Artist (Artist TEXT, facebook TEXT, twitter TEXT, website TEXT,
+            genre TEXT, mtv TEXT);
+    ''')
+    artists = [f'Artist {i}' for i in range(20)]
+    for artist in artists:
+        conn.execute('INSERT INTO Artist VALUES (?, ?, ?, ?, ?, ?)',
+                     (artist, '', '', '', ', '.join(rng.sample(GENRES, 2)), ''))
+    for i in range(30):
+        conn.execute('INSERT INTO Album VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (i + 1, f'Album {i}', rng.choice(artists), f'{rng.randint(1960, 2023)}-05-10',
+                      ', '.join(rng.sample(GENRES, 2)), round(rng.uniform(2, 5), 2),
+                      rng.randint(10, 5000)))
+    for i in range(songs):
+        conn.execute('INSERT INTO Song VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+            f'spotify:track:{i}', ' '.join(rng.sample(WORDS, 2)).title() + f' {i}', '',
+            rng.choice(artists), '', f'Album {rng.randint(0, 29)}', '',
+            rng.randint(120000, 300000), rng.choice(['true', 'false']), rng.randint(0, 100),
+            rng.random(), rng.random(), rng.uniform(-20, 0), rng.random(), rng.random(),
+            rng.random(), rng.random(), rng.random(), f'Label {rng.randint(0, 4)}',
+            f'{rng.randint(1960, 2023)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}'))
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_catalog('Music.db')
+    return str(tmp_path / 'Music.db')
+
+
+@pytest.fixture
+def app(database):
+    # Pooled read connections are keyed by the (relative) database path,
+    # which is the same in every test's directory
+    db.pools.clear()
+    app = create_app()
+    app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+'''
+    Form for adding a song through /change, with every feature filled in
+
+    args:
+        title (str): song title,
+        **fields: form fields to override
+
+    returns:
+        dict: form data
+'''
+
+
+def song_form(title, **fields):
+    form = {'trackName': title, 'artistName': 'Artist 1', 'albumName': 'Album 1',
+            'label': 'Label 1', 'duration': '200000', 'popularity': '50',
+            'danceability': '0.5', 'energy': '0.5', 'loudness': '-5', 'speechiness': '0.5',
+            'acousticness': '0.5', 'instrumentalness': '0.5', 'liveness': '0.5',
+            'happiness': '0.5'}
+    form.update(fields)
+    return form
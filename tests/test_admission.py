@@ -0,0 +1,64 @@
+import sqlite3
+import threading
+
+from website.admission import FULL, REDUCED, Admission
+
+
+def test_unfiltered_browse_costs_one_pass(app, database):
+    admission = Admission(cheap=150)
+    conn = sqlite3.connect(database)
+    visited, matched = admission.estimate(conn, 'Song', '1', [])
+    conn.close()
+    assert visited == matched == 200
+    assert admission.cost(visited, matched) == 200
+    # Extras that go over the matches again add to it
+    assert admission.cost(visited, matched, chart=True) == 400
+    assert admission.cost(visited, matched, stat='AVG') == 600
+    assert admission.cost(visited, matched, stat='median') > 600
+
+
+# app migrates the catalog, which adds the ReleaseYear index
+def test_indexed_filter_counts_its_matches(app, database):
+    admission = Admission(cheap=1000)
+    conn = sqlite3.connect(database)
+    expected = conn.execute('SELECT COUNT(*) FROM Song WHERE ReleaseYear >= 2000').fetchone()[0]
+    visited, matched = admission.estimate(conn, 'Song', 'ReleaseYear >= ?', [2000])
+    like = admission.estimate(conn, 'Song', "Song LIKE ?", ['%love%'])
+    conn.close()
+    assert visited == matched == expected
+    # A LIKE scan visits every row but keeps a fraction
+    assert like == (200, 20)
+
+
+def test_cheap_searches_skip_the_queue():
+    admission = Admission(slots=1, cheap=100, wait=0.01, timeout=0.02)
+    with admission.admit(100) as level:
+        assert level == FULL
+        # Cheap searches don't take a slot
+        with admission.admit(50) as other:
+            assert other == FULL
+
+
+def test_levels_while_slots_are_busy():
+    admission = Admission(slots=1, cheap=100, wait=0.05, timeout=2.0)
+    with admission.admit(1000) as level:
+        assert level == FULL
+        # The only slot is held past the wait, then released: reduced
+        levels = []
+
+        def wait():
+            with admission.admit(1000) as level:
+                levels.append(level)
+
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        waiter.join(0.2)
+    waiter.join()
+    assert levels == [REDUCED]
+
+
+def test_turned_away_after_the_timeout():
+    admission = Admission(slots=1, cheap=100, wait=0.01, timeout=0.05)
+    with admission.admit(1000):
+        with admission.admit(1000) as level:
+            assert level is None
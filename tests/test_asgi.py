@@ -0,0 +1,133 @@
+import asyncio
+import json
+
+import pytest
+
+
+@pytest.fixture
+def asgi(app):
+    from website.asgi import ASGIApp
+    return ASGIApp(app, threads=4)
+
+
+'''
+    Run one request through the ASGI app
+
+    args:
+        asgi (ASGIApp): app under test,
+        method (str): HTTP method,
+        path (str): decoded path, as servers put it in the scope,
+        query (bytes): raw query string,
+        body (list): body chunks, sent as separate http.request messages,
+        headers (list): (name, value) byte pairs
+
+    returns:
+        status (int): response status,
+        headers (list): response (name, value) byte pairs,
+        body (bytes): response body
+'''
+
+
+def request(asgi, method, path, query=b'', body=(b'',), headers=()):
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query,
+             'root_path': '', 'headers': list(headers), 'http_version': '1.1',
+             'scheme': 'http', 'server': ('testserver', 80), 'client': ('127.0.0.1', 5000)}
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(body) - 1}
+                for i, chunk in enumerate(body)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi(scope, receive, send))
+    if not sent:
+        return None, [], b''
+    assert sent[0]['type'] == 'http.response.start'
+    return sent[0]['status'], sent[0]['headers'], b''.join(m.get('body', b'') for m in sent[1:])
+
+
+def cookie_of(headers):
+    for name, value in headers:
+        if name == b'set-cookie':
+            return value.split(b';', 1)[0]
+    return None
+
+
+def test_flask_routes_are_served(asgi):
+    status, headers, body = request(asgi, 'GET', '/')
+    assert status == 200
+    assert (b'content-type', b'text/html; charset=utf-8') in headers
+    assert b'<html' in body.lower()
+
+
+def test_form_body_in_chunks(asgi):
+    form = b'song=love&explicit=on'
+    status, _, body = request(asgi, 'POST', '/songs', body=[form[:7], form[7:]],
+                              headers=[(b'content-type', b'application/x-www-form-urlencoded'),
+                                       (b'content-length', str(len(form)).encode())])
+    assert status == 200
+    assert b'Love' in body
+
+
+def test_client_gone_before_the_body(asgi):
+    status, _, _ = request(asgi, 'POST', '/songs', body=[])
+    assert status is None
+
+
+def test_environ():
+    from website.asgi import ASGIApp
+    scope = {'method': 'GET', 'path': '/songs/a%2Fb', 'query_string': b'q=a%20b',
+             'headers': [(b'cookie', b'a=1'), (b'cookie', b'b=2'),
+                         (b'accept', b'text/html'), (b'accept', b'*/*'),
+                         (b'content-type', b'text/plain')]}
+    environ = ASGIApp.environ(None, scope, b'body')
+    # Already decoded by the server; decoding again would turn %2F into /
+    assert environ['PATH_INFO'] == '/songs/a%2Fb'
+    assert environ['QUERY_STRING'] == 'q=a%20b'
+    assert environ['HTTP_COOKIE'] == 'a=1; b=2'
+    assert environ['HTTP_ACCEPT'] == 'text/html,*/*'
+    assert environ['CONTENT_TYPE'] == 'text/plain'
+    assert environ['CONTENT_LENGTH'] == '4'
+    assert environ['wsgi.input'].read() == b'body'
+
+
+def test_suggest_is_served_async(asgi, client):
+    status, headers, body = request(asgi, 'GET', '/api/suggest', query=b'type=artist&q=artist%201&k=3')
+    assert status == 200
+    assert (b'content-type', b'application/json') in headers
+    assert json.loads(body) == client.get('/api/suggest?type=artist&q=artist%201&k=3').get_json()
+    assert json.loads(body)
+
+
+def test_chart_data_reads_the_saved_search(asgi):
+    status, headers, _ = request(asgi, 'POST', '/songs', body=[b'song=love&explicit=on&chart=on'],
+                                 headers=[(b'content-type', b'application/x-www-form-urlencoded')])
+    assert status == 200
+    cookie = cookie_of(headers)
+    assert cookie
+
+    status, _, body = request(asgi, 'GET', '/api/chart-data/songs', headers=[(b'cookie', cookie)])
+    assert status == 200
+    assert json.loads(body)['kind'] == 'bar'
+
+    # Nothing saved without the session
+    status, _, body = request(asgi, 'GET', '/api/chart-data/songs')
+    assert status == 404
+    assert json.loads(body) == {}
+
+
+def test_lifespan(asgi):
+    messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    asyncio.run(asgi({'type': 'lifespan'}, receive, send))
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
@@ -0,0 +1,137 @@
+import sqlite3
+import time
+
+import pytest
+
+from conftest import song_form
+from website.changelog import ChangeFeed, changes_since, latest_version
+
+
+def write(database, *statements):
+    conn = sqlite3.connect(database)
+    for statement, params in statements:
+        conn.execute(statement, params)
+    conn.commit()
+    return conn
+
+
+def test_changes_since_keeps_the_first_pre_image(app, database):
+    conn = sqlite3.connect(database)
+    energy = conn.execute('SELECT Energy FROM Song WHERE rowid = 1').fetchone()[0]
+    artist = conn.execute('SELECT Artist FROM Song WHERE rowid = 2').fetchone()[0]
+    conn.close()
+
+    conn = write(database,
+                 ("INSERT INTO Song (Song, Artist, Energy) VALUES ('New', 'A', 0.5)", ()),
+                 ('UPDATE Song SET Energy = 0.9 WHERE rowid = 1', ()),
+                 ('UPDATE Song SET Energy = 0.1 WHERE rowid = 1', ()),
+                 ('DELETE FROM Song WHERE rowid = 2', ()))
+    new = conn.execute("SELECT rowid FROM Song WHERE Song = 'New'").fetchone()[0]
+
+    version, touched = changes_since(conn, 0)
+    assert version == latest_version(conn)
+    assert touched['Song'][new] is None
+    # Two updates: the row as it was before the first
+    # JSON keeps 15 significant digits
+    assert touched['Song'][1]['Energy'] == pytest.approx(energy)
+    assert touched['Song'][2]['Artist'] == artist
+    assert touched['Album'] == touched['Artist'] == {}
+
+    assert changes_since(conn, version) == (version, {'Song': {}, 'Album': {}, 'Artist': {}})
+    conn.close()
+
+
+def test_updates_of_derived_columns_only_are_not_logged(app, database):
+    conn = write(database, ("UPDATE Song SET ReleaseDate = '1999-02-03' WHERE rowid = 3", ()))
+    # One entry for the date, none for the ReleaseYear/ReleaseDay it derived
+    assert latest_version(conn) == 1
+    assert conn.execute('SELECT ReleaseYear FROM Song WHERE rowid = 3').fetchone()[0] == 1999
+    conn.close()
+
+
+def test_first_pre_image_is_the_row_before_the_range(app, database):
+    conn = write(database, ('UPDATE Song SET Energy = 0.25 WHERE rowid = 5', ()),
+                 ('UPDATE Song SET Energy = 0.75 WHERE rowid = 5', ()))
+    _, touched = changes_since(conn, 1)
+    assert touched['Song'][5]['Energy'] == 0.25
+    conn.close()
+
+
+def test_caches_follow_insert_update_and_delete(app, client, database):
+    suggest = app.extensions['suggest']
+    similar = app.extensions['similar']
+    histograms = app.extensions['histograms']
+    before = int(histograms.counts['Energy'].sum() + histograms.undated['Energy'].sum())
+
+    client.post('/change', data=song_form('Zyzzyva Song', energy='0.3'))
+    conn = sqlite3.connect(database)
+    rowid = conn.execute("SELECT rowid FROM Song WHERE Song = 'Zyzzyva Song'").fetchone()[0]
+    assert suggest.search('song', 'zyzz', 5) == ['Zyzzyva Song']
+    assert similar.nearest(rowid, 3)
+    assert histograms.counts['Energy'].sum() + histograms.undated['Energy'].sum() == before + 1
+
+    # Updated elsewhere: picked up by the next poll
+    conn.execute("UPDATE Song SET Song = 'Zyzzyvas Song', Energy = 'high' WHERE rowid = ?", (rowid,))
+    conn.commit()
+    feed = app.extensions['changefeed']
+    feed.checked = 0
+    client.get('/')
+    assert suggest.search('song', 'zyzz', 5) == ['Zyzzyvas Song']
+    assert histograms.counts['Energy'].sum() + histograms.undated['Energy'].sum() == before
+
+    client.post('/change', data={'remove_song_title': 'Zyzzyvas Song',
+                                 'remove_song_artist': 'Artist 1'})
+    assert suggest.search('song', 'zyzz', 5) == []
+    assert similar.nearest(rowid, 3) is None
+    assert feed.version == latest_version(conn)
+    conn.close()
+
+
+def test_a_failing_cache_does_not_stop_the_others(app, database):
+    from website.views import sync_caches
+
+    def fail(*args):
+        raise ValueError('broken')
+
+    app.extensions['histograms'].sync = fail
+    feed = app.extensions['changefeed']
+    conn = write(database, ("INSERT INTO Song (Song, Artist, Energy) VALUES ('Quixotic', 'A', 0.5)", ()))
+    with app.app_context():
+        feed.catch_up(conn, sync_caches)
+    assert feed.version == latest_version(conn)
+    assert app.extensions['suggest'].search('song', 'quixo', 5) == ['Quixotic']
+    # Rebuilt from the database instead
+    assert app.extensions['histograms'].sync is not fail
+    conn.close()
+
+
+def test_prune_keeps_recent_entries_and_the_newest(app, database):
+    conn = write(database, ('UPDATE Song SET Energy = 0.5 WHERE rowid = 1', ()),
+                 ('UPDATE Song SET Energy = 0.6 WHERE rowid = 1', ()),
+                 ('UPDATE Song SET Energy = 0.7 WHERE rowid = 1', ()))
+    conn.execute("UPDATE ChangeLog SET At = julianday('now') - 30")
+    conn.execute('UPDATE Song SET Energy = 0.8 WHERE rowid = 1')
+    conn.commit()
+    conn.isolation_level = None
+
+    feed = ChangeFeed(database, 0, keep_days=7)
+    feed.prune(conn)
+    assert [r[0] for r in conn.execute('SELECT Version FROM ChangeLog')] == [4]
+    # Not again within PRUNE_INTERVAL
+    conn.execute("UPDATE ChangeLog SET At = julianday('now') - 30")
+    conn.execute('UPDATE Song SET Energy = 0.9 WHERE rowid = 1')
+    feed.prune(conn)
+    assert conn.execute('SELECT COUNT(*) FROM ChangeLog').fetchone()[0] == 2
+    conn.close()
+
+
+def test_writes_prune_the_log(app, client, database):
+    conn = write(database, ('UPDATE Song SET Energy = 0.5 WHERE rowid = 1', ()))
+    conn.execute("UPDATE ChangeLog SET At = julianday('now') - 30")
+    conn.commit()
+    client.post('/change', data=song_form('Pruned Song'))
+    deadline = time.monotonic() + 5
+    while conn.execute('SELECT MIN(Version) FROM ChangeLog').fetchone()[0] == 1:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    conn.close()
@@ -0,0 +1,25 @@
+from conftest import song_form
+from website.chartdata import FeatureMeans
+
+
+def test_feature_means_skip_values_that_are_not_numbers():
+    means = FeatureMeans()
+    means.add((None,) * 9 + (10, 0.5, 'high', None) + (1,) * 5)
+    means.add((None,) * 9 + (20, 1.5, 0.25, None) + (1,) * 5)
+    values = means.values()
+    assert values[0] == 15
+    assert values[1] == 1.0
+    assert values[2] == 0.25
+    assert values[3] == 0.0
+
+
+def test_song_chart_with_text_and_empty_features(client):
+    client.post('/change', data=song_form('Zz Text Energy', energy='high'))
+    client.post('/change', data=song_form('Zz Empty Features', danceability='', energy='',
+                                          valence=''))
+
+    response = client.post('/songs', data={'song': 'Zz', 'chart': 'on', 'explicit': 'on'})
+    assert response.status_code == 200
+    assert b'Something went wrong' not in response.data
+    assert b'Zz Text Energy' in response.data
+    assert b'Zz Empty Features' in response.data
@@ -0,0 +1,24 @@
+import os
+
+from website import featurestore
+
+
+def test_builds_in_the_same_millisecond_get_their_own_versions(database, tmp_path, monkeypatch):
+    root = str(tmp_path / 'feature_store')
+    monkeypatch.setattr(featurestore.time, 'time_ns', lambda: 1700000000000 * 1000000)
+
+    first = featurestore.build(database, root, keep=3)
+    second = featurestore.build(database, root, keep=3)
+
+    assert first != second
+    assert sorted([first, second]) == [first, second]
+    assert featurestore.current_version(root) == second
+    assert featurestore.read_manifest(root, second)['version'] == second
+    assert not [d for d in os.listdir(root) if d.endswith('.tmp')]
+
+
+def test_build_keeps_the_newest_versions(database, tmp_path):
+    root = str(tmp_path / 'feature_store')
+    versions = [featurestore.build(database, root, keep=2) for _ in range(3)]
+
+    assert sorted(d for d in os.listdir(root) if d.startswith('v')) == versions[1:]
@@ -0,0 +1,46 @@
+import sqlite3
+
+from conftest import make_catalog
+from website.schema import MIGRATIONS, migrate
+
+
+def test_migrations_run_in_order_once(tmp_path):
+    path = str(tmp_path / 'Music.db')
+    make_catalog(path)
+    conn = sqlite3.connect(path)
+
+    assert migrate(conn) == len(MIGRATIONS)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+    tables = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {'SongCube', 'Genre', 'ArtistGenre', 'AlbumGenre', 'ChangeLog', 'Trigram'} <= tables
+
+    # Backfills saw the rows that were already there
+    songs = conn.execute('SELECT COUNT(*) FROM Song').fetchone()[0]
+    assert conn.execute('SELECT SUM(n) FROM SongCube').fetchone()[0] == songs
+    assert conn.execute('SELECT COUNT(*) FROM Song WHERE ReleaseYear IS NULL').fetchone()[0] == 0
+
+    # Running again changes nothing
+    schema = conn.execute('SELECT sql FROM sqlite_master ORDER BY name').fetchall()
+    assert migrate(conn) == len(MIGRATIONS)
+    assert conn.execute('SELECT sql FROM sqlite_master ORDER BY name').fetchall() == schema
+    conn.close()
+
+
+def test_a_failing_migration_is_rolled_back(tmp_path, monkeypatch):
+    path = str(tmp_path / 'Music.db')
+    make_catalog(path)
+    conn = sqlite3.connect(path)
+    monkeypatch.setattr('website.schema.MIGRATIONS',
+                        MIGRATIONS[:1] + [['CREATE TABLE Half (x)', 'SELECT * FROM Missing']])
+
+    try:
+        migrate(conn)
+    except sqlite3.OperationalError:
+        pass
+    else:
+        raise AssertionError('migration should have failed')
+
+    # The first migration stays applied, the broken one left nothing behind
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'Half'").fetchone()[0] == 0
+    conn.close()
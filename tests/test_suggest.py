@@ -0,0 +1,55 @@
+import sqlite3
+
+from conftest import song_form
+from website.suggest import PrefixIndex, SuggestIndex
+
+
+def test_most_popular_names_come_first():
+    index = PrefixIndex()
+    index.extend([(1, 'Blue Moon', 10), (2, 'Blue Sky', 90), (3, 'Bluegrass', 50),
+                  (4, 'Red Sky', 100)])
+    assert index.search('blu', 10) == ['Blue Sky', 'Bluegrass', 'Blue Moon']
+    # Word starts match too
+    assert index.search('sky', 10) == ['Red Sky', 'Blue Sky']
+
+
+def test_duplicate_names_are_suggested_once():
+    index = PrefixIndex()
+    index.extend([(1, 'Yesterday', 80), (2, 'Yesterday', 70), (3, 'Yellow', 10)])
+    assert index.search('ye', 10) == ['Yesterday', 'Yellow']
+
+
+def test_cached_prefix_follows_changes():
+    index = PrefixIndex()
+    index.extend([(1, 'Alpha', 10), (2, 'Alps', 20)])
+    assert index.search('al', 10) == ['Alps', 'Alpha']
+    index.add(1, 'Alpha', 30)
+    assert index.search('al', 10) == ['Alpha', 'Alps']
+    index.remove(2)
+    assert index.search('al', 10) == ['Alpha']
+
+
+def test_weights_that_are_not_numbers_count_as_zero():
+    index = PrefixIndex()
+    index.extend([(1, 'Alpha', 'high'), (2, 'Alps', None), (3, 'Altar', 5)])
+    index.add(4, 'Alto', '')
+    index.bump('Alps', 'high')
+    assert index.search('al', 10)[0] == 'Altar'
+
+
+def test_sync_reads_text_popularity(database, client):
+    client.post('/change', data=song_form('Qqzz Text Popularity', popularity='high'))
+    client.post('/change', data=song_form('Qqzz Number Popularity', popularity='60'))
+
+    response = client.get('/api/suggest?type=song&q=qqzz')
+    assert response.status_code == 200
+    assert response.get_json() == ['Qqzz Number Popularity', 'Qqzz Text Popularity']
+
+    # Built from a catalog that already holds the text value, too
+    conn = sqlite3.connect(database)
+    try:
+        index = SuggestIndex.from_database(conn)
+    finally:
+        conn.close()
+    assert index.search('song', 'qqzz', 5) == ['Qqzz Number Popularity', 'Qqzz Text Popularity']
+    assert index.search('artist', 'artist 1', 5)
@@ -0,0 +1,25 @@
+import sqlite3
+
+from website.views import artist_filters
+
+
+def matching_artists(database, search, genre):
+    where, params = artist_filters(search, genre)
+    conn = sqlite3.connect(database)
+    rows = conn.execute(f'SELECT Artist, genre FROM Artist WHERE {where}', params).fetchall()
+    conn.close()
+    return rows
+
+
+def test_genre_filter_matches_part_of_a_genre(app, database):
+    conn = sqlite3.connect(database)
+    conn.execute("UPDATE Artist SET genre = 'Indie Rock, jazz' WHERE Artist = 'Artist 0'")
+    conn.commit()
+    conn.close()
+
+    rows = matching_artists(database, '', ' ROCK ')
+    assert rows
+    assert all('rock' in genre.lower() for _, genre in rows)
+    assert 'Artist 0' in [artist for artist, _ in rows]
+    assert [artist for artist, _ in matching_artists(database, '', 'indie')] == ['Artist 0']
+    assert matching_artists(database, 'Artist 1', 'polka') == []
@@ -0,0 +1,86 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import sqlite3
+import threading
+
+import pytest
+
+from website.writer import Writer
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / 'writes.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE T (x INTEGER UNIQUE)')
+    conn.commit()
+    conn.close()
+    return path
+
+
+def values(path):
+    conn = sqlite3.connect(path)
+    rows = [x for x, in conn.execute('SELECT x FROM T ORDER BY x')]
+    conn.close()
+    return rows
+
+
+def insert(x):
+    def fn(cur):
+        cur.execute('INSERT INTO T VALUES (?)', (x,))
+        return x
+    return fn
+
+
+def test_a_failing_job_is_rolled_back_alone(path):
+    commits = []
+    writer = Writer(path, on_commit=commits.append)
+    conn = sqlite3.connect(path, isolation_level=None)
+
+    def half_then_fail(cur):
+        cur.execute('INSERT INTO T VALUES (100)')
+        cur.execute('INSERT INTO T VALUES (1)')
+
+    batch = [(fn, Future()) for fn in (insert(1), half_then_fail, insert(2))]
+    writer.commit(conn, batch)
+
+    assert [f.result() for f in (batch[0][1], batch[2][1])] == [1, 2]
+    with pytest.raises(sqlite3.IntegrityError):
+        batch[1][1].result()
+    assert values(path) == [1, 2]
+    assert len(commits) == 1
+    conn.close()
+
+
+def test_a_failed_commit_fails_the_whole_batch(path):
+    writer = Writer(path)
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.execute('CREATE TABLE Child (x INTEGER REFERENCES T (x) DEFERRABLE INITIALLY DEFERRED)')
+
+    def dangling(cur):
+        # Only checked when the batch commits
+        cur.execute('INSERT INTO Child VALUES (99)')
+
+    batch = [(fn, Future()) for fn in (insert(1), dangling, insert(2))]
+    writer.commit(conn, batch)
+
+    assert all(isinstance(f.exception(), sqlite3.IntegrityError) for _, f in batch)
+    assert not conn.in_transaction
+    assert values(path) == []
+    conn.close()
+
+
+def test_concurrent_writes_share_a_transaction(path):
+    commits = []
+    writer = Writer(path, window=0.5, on_commit=commits.append)
+    ready = threading.Barrier(8)
+
+    def submit(x):
+        ready.wait()
+        return writer.submit(insert(x))
+
+    with ThreadPoolExecutor(8) as pool:
+        assert sorted(pool.map(submit, range(8))) == list(range(8))
+
+    assert values(path) == list(range(8))
+    assert len(commits) < 8
@@ -1,16 +1,123 @@
 from flask import Flask
+import importlib
+import threading
+from datetime import timedelta
 
 
 def create_app():
     app = Flask(__name__)
     app.config['SECRET_KEY'] = '&jL82hB%#h@k!9l!h'
 
-    app.config['SESSION_TYPE'] = 'filesystem'
-    app.config['SESSION_PERMANENT'] = True
-    app.config['SESSION_USE_SIGNER'] = True
+    # Saved searches are kept server-side; the cookie only holds a signed id
+    app.config['SESSION_TYPE'] = 'sqlite'
+    app.config['SESSION_SQLITE_PATH'] = 'Sessions.db'
+    app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)
 
+    # Searches read through a read-only, memory-mapped connection. Set
+    # READ_SNAPSHOT_PATH to serve them from a copy refreshed every
+    # READ_SNAPSHOT_INTERVAL seconds instead of the live database.
+    app.config['DATABASE'] = 'Music.db'
+    app.config['READ_MMAP_SIZE'] = 256 * 1024 * 1024
+    app.config['READ_SNAPSHOT_PATH'] = None
+    app.config['READ_SNAPSHOT_INTERVAL'] = 60
+    app.config['READ_POOL_SIZE'] = 16
+
+    # Answer numeric-only song stats and charts from NumPy arrays (optional)
+    app.config['COLUMNAR_ENGINE'] = False
+
+    # Directory of a memory-mapped feature store shared by all workers.
+    # When set, the snapshot above is mapped from it instead of loaded
+    # per process. Build it with `python -m website.featurestore`.
+    app.config['FEATURE_STORE_PATH'] = None
+
+    # Prefix index behind /api/suggest for the search boxes
+    app.config['SUGGEST_INDEX'] = True
+
+    # Nearest-neighbour index behind /songs/similar (needs NumPy)
+    app.config['SIMILAR_SONGS'] = True
+
+    # Precomputed per-year/explicit/artist bin counts for the song
+    # distribution chart (needs NumPy)
+    app.config['SONG_HISTOGRAMS'] = True
+
+    # Searches estimated to visit more than ADMISSION_CHEAP_COST rows share
+    # ADMISSION_SLOTS slots. After ADMISSION_WAIT seconds in the queue they
+    # drop their chart and approximate medians; after ADMISSION_TIMEOUT
+    # they are turned away.
+    app.config['ADMISSION_SLOTS'] = 2
+    app.config['ADMISSION_CHEAP_COST'] = 50000
+    app.config['ADMISSION_WAIT'] = 2.0
+    app.config['ADMISSION_TIMEOUT'] = 30.0
+
+    # Seconds the queries of one search may run before they are interrupted
+    app.config['QUERY_DEADLINES'] = {'songs': 5.0, 'albums': 5.0, 'artists': 5.0}
+
+    # Measure each request's peak Python allocation with tracemalloc
+    # (slow; see metrics.py)
+    app.config['TRACE_MEMORY'] = False
+
+    # Handler threads the ASGI entry point (website.asgi) runs Flask on
+    app.config['ASGI_THREADS'] = 16
+
+    # Seconds between checks of the change log for edits made by other
+    # worker processes
+    app.config['CHANGE_FEED_INTERVAL'] = 1.0
+
+    # /change writes arriving within WRITE_BATCH_WINDOW seconds of each
+    # other are committed together, up to WRITE_BATCH_SIZE at a time
+    app.config['WRITE_BATCH_WINDOW'] = 0.005
+    app.config['WRITE_BATCH_SIZE'] = 64
+
+    # Seconds between background maintenance passes (PRAGMA optimize,
+    # change log pruning, incremental vacuum of up to
+    # MAINTENANCE_VACUUM_PAGES pages, WAL checkpoint); None to leave it to
+    # `python -m website.maintenance`. Change log entries older than
+    # CHANGE_LOG_KEEP_DAYS are pruned by each pass, and after writes at
+    # most once an hour either way.
+    app.config['MAINTENANCE_INTERVAL'] = None
+    app.config['MAINTENANCE_VACUUM_PAGES'] = 1000
+    app.config['CHANGE_LOG_KEEP_DAYS'] = 7
+
+    # Charts are sent as their data series and drawn as SVG in the
+    # browser. Set CHART_RENDERER to 'png' to rasterize them on the server
+    # with matplotlib instead.
+    app.config['CHART_RENDERER'] = 'svg'
+
+    # With PNG charts, import matplotlib in the background so the first
+    # chart request doesn't pay for it, without delaying worker startup
+    app.config['CHART_PREWARM'] = True
+
+    from .admission import init_admission
+    from .changelog import init_changefeed
+    from .columnar import init_columnar
+    from .db import init_db
+    from .histograms import init_histograms
+    from .maintenance import init_maintenance
+    from .metrics import init_metrics
+    from .sessions import SqliteSessionInterface
+    from .similar import init_similar
+    from .suggest import init_suggest
     from .views import views
+    from .writer import init_writer
+
+    app.session_interface = SqliteSessionInterface(
+        app.config['SESSION_SQLITE_PATH'])
 
     app.register_blueprint(views, url_prefix='/')
 
+    init_metrics(app)
+    init_db(app)
+    init_changefeed(app)
+    init_columnar(app)
+    init_suggest(app)
+    init_similar(app)
+    init_histograms(app)
+    init_writer(app)
+    init_admission(app)
+    init_maintenance(app)
+
+    if app.config['CHART_RENDERER'] == 'png' and app.config['CHART_PREWARM']:
+        threading.Thread(target=importlib.import_module,
+                         args=(__name__ + '.charts',), daemon=True).start()
+
     return app
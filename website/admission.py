@@ -0,0 +1,159 @@
+"""Admission control for song and album searches.
+
+Before a search runs, its cost is estimated in rows visited. The estimate
+comes from the query plan SQLite picks for its filters (EXPLAIN QUERY
+PLAN), the table size and the extras asked for (stats, median sorts,
+charts). Searches at or under ADMISSION_CHEAP_COST go straight through.
+More expensive ones queue for one of ADMISSION_SLOTS slots. One that
+has waited ADMISSION_WAIT seconds is reduced to its cheap parts (no
+chart, approximate median) so it holds its slot for less time. One that
+can't get a slot within ADMISSION_TIMEOUT is turned away.
+"""
+from contextlib import contextmanager
+import math
+import threading
+import time
+
+FULL = 'full'
+REDUCED = 'reduced'
+
+# Seconds a cached table size is trusted for
+SIZE_TTL = 60
+
+
+class Admission:
+    def __init__(self, slots=2, cheap=50000, wait=2.0, timeout=30.0):
+        self.slots = threading.BoundedSemaphore(slots)
+        self.cheap = cheap
+        self.wait = wait
+        self.timeout = timeout
+        self.sizes = {}
+
+    def table_rows(self, conn, table):
+        size, checked = self.sizes.get(table, (None, 0))
+        if size is None or time.monotonic() - checked > SIZE_TTL:
+            # ANALYZE statistics when there are any, else the largest
+            # rowid, which is one b-tree descent
+            row = None
+            try:
+                row = conn.execute(
+                    'SELECT stat FROM sqlite_stat1 WHERE tbl = ? AND idx IS NULL', (table,)).fetchone()
+            except Exception:
+                pass
+            if row is not None:
+                size = int(row[0].split()[0])
+            else:
+                size = conn.execute(f'SELECT MAX(rowid) FROM {table}').fetchone()[0] or 0
+            self.sizes[table] = (size, time.monotonic())
+        return size
+
+    '''
+        Estimate how many rows a search's filters make SQLite visit and match
+
+        args:
+            conn (sqlite3.Connection): connection the search will use,
+            table (str): Song or Album,
+            where (str): SQL condition of the search,
+            params (list): parameters for the condition
+
+        returns:
+            visited (int): rows SQLite reads to evaluate the filters,
+            matched (int): rows the filters are expected to return
+    '''
+
+    def estimate(self, conn, table, where, params):
+        size = self.table_rows(conn, table)
+        plan = conn.execute(
+            f'EXPLAIN QUERY PLAN SELECT * FROM {table} WHERE {where}', params).fetchall()
+        scans = any(row[-1].startswith(f'SCAN {table}') for row in plan)
+
+        if not scans:
+            # An index narrows it down; count the matches, but stop as
+            # soon as the search is known to be expensive anyway
+            matched = conn.execute(
+                f'SELECT COUNT(*) FROM (SELECT 1 FROM {table} WHERE {where} LIMIT ?)',
+                list(params) + [self.cheap + 1]).fetchone()[0]
+            return matched, matched
+
+        # A full scan; LIKE filters keep a fraction of the rows
+        likes = where.count(' LIKE ')
+        return size, int(size * 0.1 ** likes) if where != '1' else size
+
+    '''
+        Add up the cost of a search's extras on top of its filters
+
+        args:
+            visited (int): rows read by the filters,
+            matched (int): rows returned by the filters,
+            stat (str): single statistic asked for, if any,
+            chart (bool): whether a chart is drawn from the results,
+            pairs (list): (stat, category) pairs for the statistics table
+
+        returns:
+            int: estimated rows visited
+    '''
+
+    def cost(self, visited, matched, stat=None, chart=False, pairs=()):
+        sort = int(matched * math.log2(matched + 2))
+        # The results are counted, paged and faceted in the same pass that
+        # evaluates the filters, so the matches aren't read a second time.
+        # Only extras that go over them again add to it.
+        cost = visited
+        if stat == 'median':
+            cost += visited + 2 * sort
+        elif stat:
+            cost += 2 * visited
+        if pairs:
+            cost += visited + sum(sort for s, _ in pairs if s == 'median')
+        if chart:
+            cost += matched
+        return cost
+
+    '''
+        Wait until a search of the given cost may run
+
+        args:
+            cost (int): estimated rows visited
+
+        yields:
+            FULL, REDUCED, or None if the search has to be turned away
+    '''
+
+    @contextmanager
+    def admit(self, cost):
+        if cost <= self.cheap:
+            yield FULL
+            return
+
+        level = FULL
+        acquired = self.slots.acquire(timeout=self.wait)
+        if not acquired:
+            level = REDUCED
+            acquired = self.slots.acquire(timeout=max(0, self.timeout - self.wait))
+        if not acquired:
+            yield None
+            return
+        try:
+            yield level
+        finally:
+            self.slots.release()
+
+
+'''
+    Set up admission control when the app starts
+
+    args:
+        app (Flask): application being created
+
+    returns:
+        Admission
+'''
+
+
+def init_admission(app):
+    admission = Admission(app.config.get('ADMISSION_SLOTS', 2),
+                          app.config.get('ADMISSION_CHEAP_COST', 50000),
+                          app.config.get('ADMISSION_WAIT', 2.0),
+                          app.config.get('ADMISSION_TIMEOUT', 30.0))
+    app.extensions['admission'] = admission
+    return admission
@@ -0,0 +1,175 @@
+"""ASGI entry point, next to the WSGI app in main.py:
+
+    uvicorn website.asgi:app --workers 4
+
+The event loop owns every client connection. A request's body is read and
+its response written with awaits, so a slow or idle client costs a
+coroutine instead of a thread.
+
+The JSON search API (/api/suggest and /api/chart-data) is served by async
+handlers here. They await their reads through db.AsyncReader, on
+READ_POOL_SIZE reader threads with a pooled connection each. Every other
+route is the Flask app itself, called once the whole request has arrived
+and run on a fixed pool of ASGI_THREADS handler threads, so its SQLite
+queries and matplotlib rendering happen off the loop too. A burst of slow
+clients therefore can't tie up the threads the searches need.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+import asyncio
+import io
+import sys
+
+from . import create_app
+from .db import AsyncReader
+from .views import get_chart_series, get_suggestions
+
+CHART_DATA = '/api/chart-data/'
+
+
+class ASGIApp:
+    def __init__(self, wsgi_app, threads=16):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='handler')
+        self.reader = AsyncReader(wsgi_app, wsgi_app.config.get('READ_POOL_SIZE') or threads)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                self.reader.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        # Read the whole body before a handler thread is involved
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        handler = self.route(scope)
+        if handler is not None:
+            status, headers, chunks = await handler
+        else:
+            environ = self.environ(scope, bytes(body))
+            loop = asyncio.get_running_loop()
+            status, headers, chunks = await loop.run_in_executor(
+                self.executor, self.call_wsgi, environ)
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        for chunk in chunks:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    '''
+        Pick the async handler for a request, if it has one
+
+        args:
+            scope (dict): ASGI connection scope
+
+        returns:
+            coroutine or None: handler resolving to (status, headers,
+                chunks); None for routes the Flask app serves
+    '''
+
+    def route(self, scope):
+        if scope['method'] != 'GET':
+            return None
+        path = scope['path']
+        if path == '/api/suggest':
+            return self.suggest(scope)
+        if path.startswith(CHART_DATA) and '/' not in path[len(CHART_DATA):]:
+            return self.chart_data(scope, path[len(CHART_DATA):])
+        return None
+
+    async def suggest(self, scope):
+        query = parse_qs(scope.get('query_string', b'').decode('latin1'))
+        kind = query.get('type', ['song'])[0]
+        prefix = query.get('q', [''])[0]
+        try:
+            k = int(query.get('k', ['8'])[0])
+        except ValueError:
+            k = 8
+        return self.json(200, await self.reader.run(get_suggestions, kind, prefix, k))
+
+    async def chart_data(self, scope, chart):
+        # The chart is of the search saved in the session, so the reads run
+        # in a request context that has the session cookie
+        data = await self.reader.run(get_chart_series, chart,
+                                     environ=self.environ(scope, b''))
+        return self.json(200, data) if data else self.json(404, {})
+
+    def json(self, status, data):
+        body = f'{self.wsgi_app.json.dumps(data)}\n'.encode()
+        headers = [(b'content-type', b'application/json'),
+                   (b'content-length', str(len(body)).encode('latin1'))]
+        return status, headers, [body]
+
+    def environ(self, scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+            # scope['path'] is already percent-decoded
+            'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin1').upper().replace('-', '_')
+            value = value.decode('latin1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'CONTENT_LENGTH':
+                key = f'HTTP_{name}'
+                # Repeated headers are joined like a server would; cookies
+                # with '; ', the separator within one Cookie header
+                separator = '; ' if key == 'HTTP_COOKIE' else ','
+                environ[key] = f'{environ[key]}{separator}{value}' if key in environ else value
+        return environ
+
+    def call_wsgi(self, environ):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(k.lower().encode('latin1'), v.encode('latin1'))
+                                   for k, v in headers]
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            chunks = [chunk for chunk in result if chunk]
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], chunks
+
+
+flask_app = create_app()
+app = ASGIApp(flask_app, flask_app.config.get('ASGI_THREADS', 16))
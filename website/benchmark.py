@@ -0,0 +1,199 @@
+"""Compare the WSGI and ASGI serving modes under slow clients.
+
+While SLOW clients hold connections open, dribbling their request headers
+out a byte at a time over --slow seconds, --workers fast clients run
+--requests song searches. The report has the fast clients' throughput,
+latency percentiles and errors, and the server's peak thread count.
+
+    python -m website.benchmark http://127.0.0.1:5000 --clients 1000
+    python -m website.benchmark --compare --clients 1000
+
+--compare starts both servers itself, from the current directory: the
+Werkzeug threaded server for WSGI and uvicorn (if installed) for ASGI.
+"""
+from urllib.parse import urlsplit, urlencode
+import argparse
+import asyncio
+import socket
+import subprocess
+import sys
+import time
+
+SEARCH = urlencode({'song': 'love', 'order': 'Popularity', 'explicit': 'on'}).encode()
+
+
+def request_bytes(host, path='/songs', body=SEARCH):
+    return (f'POST {path} HTTP/1.1\r\nHost: {host}\r\n'
+            'Content-Type: application/x-www-form-urlencoded\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n').encode() + body
+
+
+async def fetch(host, port, data, slow=0.0):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        if slow:
+            step = slow / len(data)
+            for i in range(len(data)):
+                writer.write(data[i:i + 1])
+                await writer.drain()
+                await asyncio.sleep(step)
+        else:
+            writer.write(data)
+            await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    status = response.split(b' ', 2)[1] if response.startswith(b'HTTP/') else b'0'
+    return int(status)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def server_threads(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('Threads:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+async def run(url, clients, slow, workers, requests, pid=None):
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    data = request_bytes(f'{host}:{port}')
+
+    slow_results = []
+    latencies = []
+    errors = 0
+    peak = 0
+
+    async def slow_client():
+        try:
+            slow_results.append(await fetch(host, port, data, slow))
+        except OSError:
+            slow_results.append(0)
+
+    async def fast_client(count):
+        nonlocal errors
+        for _ in range(count):
+            start = time.perf_counter()
+            try:
+                status = await fetch(host, port, data)
+            except OSError:
+                status = 0
+            if status != 200:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    async def watch():
+        nonlocal peak
+        while True:
+            peak = max(peak, server_threads(pid) if pid else 0)
+            await asyncio.sleep(0.05)
+
+    watcher = asyncio.ensure_future(watch())
+    slow_tasks = [asyncio.ensure_future(slow_client()) for _ in range(clients)]
+    # Give the slow clients time to connect before measuring
+    await asyncio.sleep(min(1.0, slow / 4))
+
+    start = time.perf_counter()
+    per_worker = [requests // workers + (i < requests % workers) for i in range(workers)]
+    await asyncio.gather(*(fast_client(n) for n in per_worker))
+    elapsed = time.perf_counter() - start
+
+    await asyncio.gather(*slow_tasks)
+    watcher.cancel()
+
+    return {
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'errors': errors,
+        'slow_ok': sum(1 for s in slow_results if s == 200),
+        'slow_failed': sum(1 for s in slow_results if s != 200),
+        'peak_threads': peak,
+    }
+
+
+def report(name, result):
+    print(f"{name}: {result['throughput']:.1f} req/s, "
+          f"p50 {result['p50'] * 1000:.0f} ms, p95 {result['p95'] * 1000:.0f} ms, "
+          f"p99 {result['p99'] * 1000:.0f} ms, {result['errors']} errors; "
+          f"slow clients {result['slow_ok']} ok / {result['slow_failed']} failed; "
+          f"peak server threads {result['peak_threads'] or '?'}")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def serve_wsgi(port):
+    from werkzeug.serving import run_simple
+    from . import create_app
+    run_simple('127.0.0.1', port, create_app(), threaded=True)
+
+
+def compare(args):
+    servers = {'WSGI (werkzeug, threaded)': [sys.executable, '-m', 'website.benchmark', '--serve-wsgi']}
+    try:
+        import uvicorn  # noqa: F401
+        servers['ASGI (uvicorn)'] = [sys.executable, '-m', 'uvicorn', 'website.asgi:app',
+                                     '--log-level', 'warning', '--backlog', '4096', '--port']
+    except ImportError:
+        print('uvicorn is not installed; only benchmarking WSGI')
+
+    for name, command in servers.items():
+        port = free_port()
+        proc = subprocess.Popen(command + [str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not wait_for(port):
+                print(f'{name}: server did not start')
+                continue
+            result = asyncio.run(run(f'http://127.0.0.1:{port}', args.clients, args.slow,
+                                     args.workers, args.requests, proc.pid))
+            report(name, result)
+        finally:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('url', nargs='?', default='http://127.0.0.1:5000')
+    parser.add_argument('--clients', type=int, default=500, help='slow clients')
+    parser.add_argument('--slow', type=float, default=5.0, help='seconds each slow client takes')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent fast clients')
+    parser.add_argument('--requests', type=int, default=200, help='fast requests in total')
+    parser.add_argument('--compare', action='store_true', help='start and benchmark both modes')
+    parser.add_argument('--serve-wsgi', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_wsgi:
+        serve_wsgi(args.serve_wsgi)
+    elif args.compare:
+        compare(args)
+    else:
+        report(args.url, asyncio.run(run(args.url, args.clients, args.slow,
+                                         args.workers, args.requests)))
@@ -0,0 +1,168 @@
+"""Feed of catalog changes from the ChangeLog table.
+
+Triggers append a row to ChangeLog for every insert, update and delete on
+Song, Album and Artist, numbered by a Version that only ever grows. Each
+process remembers the last version its in-memory caches reflect. Catching
+up reads only the newer entries and turns them into the touched dict
+sync_caches() takes: rowid -> the row before the first change (None for
+inserts). Updated or deleted songs carry their old values so the
+histograms can take them back out. Caches are synced after this process's
+own commits and, at most every CHANGE_FEED_INTERVAL seconds, before a
+request, to pick up edits made by other workers.
+
+After its own commits a process also prunes entries older than
+CHANGE_LOG_KEEP_DAYS (at most once per PRUNE_INTERVAL), which every
+worker's feed has long caught up with, so the log doesn't grow with every
+write when no maintenance pass is scheduled.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Seconds between prunes of the change log after this process's writes
+PRUNE_INTERVAL = 3600
+
+# The newest entry stays, so versions carry on from where they were
+PRUNE = '''DELETE FROM ChangeLog WHERE At < julianday('now') - ?
+    AND Version < (SELECT MAX(Version) FROM ChangeLog)'''
+
+'''
+    Get the newest change log version
+
+    args:
+        conn (sqlite3.Connection): connection to read from
+
+    returns:
+        int: 0 if nothing has changed yet
+'''
+
+
+def latest_version(conn):
+    return conn.execute('SELECT COALESCE(MAX(Version), 0) FROM ChangeLog').fetchone()[0]
+
+
+'''
+    Read the changes made after a version
+
+    args:
+        conn (sqlite3.Connection): connection to read from,
+        version (int): last version already seen
+
+    returns:
+        version (int): newest version read,
+        touched (dict): table -> {rowid: row before the first change,
+            None for inserts}
+'''
+
+
+def changes_since(conn, version):
+    touched = {'Song': {}, 'Album': {}, 'Artist': {}}
+    rows = conn.execute('''SELECT Version, TableName, RowKey, Op, Old FROM ChangeLog
+        WHERE Version > ? ORDER BY Version''', (version,))
+    for version, table, rowid, op, old in rows:
+        if rowid in touched[table]:
+            continue
+        touched[table][rowid] = json.loads(old) if op != 'I' and old else None
+    return version, touched
+
+
+class ChangeFeed:
+    def __init__(self, database, version, interval=1.0, keep_days=7):
+        self.database = database
+        self.version = version
+        self.interval = interval
+        self.keep_days = keep_days
+        self.checked = 0
+        self.pruned = None
+        self.lock = threading.Lock()
+
+    '''
+        Apply every change since the last catch-up
+
+        args:
+            conn (sqlite3.Connection): connection that sees the latest commits,
+            apply (callable): apply(conn, touched) updating the caches
+
+        returns:
+            dict: the touched rows that were applied
+    '''
+
+    def catch_up(self, conn, apply):
+        # One catch-up at a time, so changes are applied in version order
+        with self.lock:
+            version, touched = changes_since(conn, self.version)
+            if version != self.version:
+                # Move past these entries even if applying them fails;
+                # apply() rebuilds what it couldn't sync, and retrying the
+                # same range would only fail the same way
+                try:
+                    apply(conn, touched)
+                finally:
+                    self.version = version
+            return touched
+
+    '''
+        Drop old entries, at most once per PRUNE_INTERVAL
+
+        args:
+            conn (sqlite3.Connection): read-write connection, outside a
+                transaction (the writer's)
+    '''
+
+    def prune(self, conn):
+        now = time.monotonic()
+        if self.keep_days is None or (self.pruned is not None and now - self.pruned < PRUNE_INTERVAL):
+            return
+        self.pruned = now
+        conn.execute(PRUNE, (self.keep_days,))
+
+    '''
+        Catch up with changes other processes made, at most once per interval
+    '''
+
+    def poll(self):
+        from .views import sync_caches
+
+        now = time.monotonic()
+        if now - self.checked < self.interval:
+            return
+        self.checked = now
+
+        conn = sqlite3.connect(f'file:{self.database}?mode=ro', uri=True)
+        try:
+            self.catch_up(conn, sync_caches)
+        except sqlite3.Error:
+            pass
+        finally:
+            conn.close()
+
+
+'''
+    Start following the change log when the app starts. Called before the
+    caches are built, so no change between the two can be missed.
+
+    args:
+        app (Flask): application being created
+
+    returns:
+        ChangeFeed or None
+'''
+
+
+def init_changefeed(app):
+    database = app.config['DATABASE']
+    if not os.path.exists(database):
+        return None
+    conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    try:
+        version = latest_version(conn)
+    finally:
+        conn.close()
+
+    feed = ChangeFeed(database, version, app.config.get('CHANGE_FEED_INTERVAL', 1.0),
+                      app.config.get('CHANGE_LOG_KEEP_DAYS', 7))
+    app.extensions['changefeed'] = feed
+    app.before_request(feed.poll)
+    return feed
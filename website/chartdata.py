@@ -0,0 +1,119 @@
+"""Chart series for search results.
+
+Each function returns the already-aggregated numbers behind one chart as a
+small dict with a 'kind'. The templates draw them as inline SVG in the
+browser (the renderer is in base.html), /api/chart-data serves them as
+JSON, and with CHART_RENDERER = 'png' charts.py rasterizes the same dicts
+with matplotlib instead.
+"""
+
+# Features in the order the bar and trend charts plot them
+FEATURES = ['popularity', 'danceability', 'energy', 'loudness', 'speechiness',
+            'acousticness', 'instrumentalness', 'liveness', 'valence']
+COLORS = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728',
+          '#9467bd', '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22']
+
+
+class FeatureMeans:
+    '''
+        Running mean of each chart feature, fed one song row at a time
+        so the rows themselves needn't be kept
+    '''
+
+    def __init__(self):
+        self.sums = [0] * len(FEATURES)
+        self.counts = [0] * len(FEATURES)
+
+    def add(self, row):
+        # Like AVG() and the columnar snapshot, leave out values that aren't
+        # numbers (NULL, or text such as '' or 'high')
+        for i, value in enumerate(row[9:18]):
+            if isinstance(value, (int, float)):
+                self.sums[i] += value
+                self.counts[i] += 1
+
+    def values(self):
+        return [s / n if n else 0.0 for s, n in zip(self.sums, self.counts)]
+
+
+'''
+    Series for the bar chart of feature means
+
+    args:
+        values (list): mean of each feature, in FEATURES order
+
+    returns:
+        dict: bar chart data
+'''
+
+
+def bar_data(values):
+    return {'kind': 'bar', 'title': 'Statistics for your search!',
+            'labels': FEATURES, 'colors': COLORS,
+            'values': [round(float(v), 4) for v in values]}
+
+
+'''
+    Series for the genre pie chart; genres under 2% are grouped as Other
+
+    args:
+        genre_counts (dict): number of artists in each genre
+
+    returns:
+        dict: pie chart data, slices in ascending order
+'''
+
+
+def pie_data(genre_counts):
+    data = dict(genre_counts)
+    total = sum(data.values())
+
+    # Convert small percentage categories to category 'other'
+    other_genres = [key for key, value in data.items() if value / total < 0.02]
+    other_ct = sum(data.pop(key) for key in other_genres)
+    if other_genres:
+        data["Other: " + ', '.join(other_genres)] = other_ct
+
+    slices = sorted(data.items(), key=lambda item: item[1])
+    return {'kind': 'pie', 'labels': [k for k, _ in slices],
+            'values': [v for _, v in slices]}
+
+
+'''
+    Series for the histogram of one category
+
+    args:
+        category (str): name of the binned column,
+        edges (tuple): (low, width) of the bins,
+        counts (list): number of rows in each bin
+
+    returns:
+        dict: histogram data
+'''
+
+
+def histogram_data(category, edges, counts):
+    low, width = edges
+    return {'kind': 'histogram', 'title': f'Distribution of {category} for your search!',
+            'label': category, 'low': float(low), 'width': float(width),
+            'values': [int(n) for n in counts]}
+
+
+'''
+    Series for the trend chart of the feature means by release year
+
+    args:
+        years (list): release years, ascending,
+        counts (list): number of songs released each year,
+        trends (list): per-year means of each feature, in FEATURES order
+
+    returns:
+        dict: trend chart data
+'''
+
+
+def trend_data(years, counts, trends):
+    return {'kind': 'trend', 'years': [int(y) for y in years],
+            'counts': [int(n) for n in counts], 'labels': FEATURES, 'colors': COLORS,
+            'series': [[None if v is None else round(float(v), 4) for v in values]
+                       for values in trends]}
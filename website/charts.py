@@ -0,0 +1,157 @@
+"""PNG rendering of the chart series in chartdata.py.
+
+Charts are drawn as SVG in the browser by default; this is the fallback
+used when CHART_RENDERER is 'png'. matplotlib is expensive to import, so
+this module is only loaded the first time a PNG chart is requested (or
+pre-warmed in the background by create_app).
+"""
+from io import BytesIO
+from matplotlib.figure import Figure
+from matplotlib.patches import Circle
+import base64
+
+
+def png_url(fig):
+    # Save the chart image to buffer
+    buf = BytesIO()
+    fig.savefig(buf, format='png')
+    data = base64.b64encode(buf.getbuffer()).decode('ascii')
+    return f'data:image/png;base64,{data}'
+
+
+'''
+    Create pie chart
+
+    args:
+        data (dict): chartdata.pie_data series
+
+    returns:
+        str: url for pie chart image
+'''
+
+
+def pie_chart(data):
+    total = sum(data['values'])
+    sizes = [x/total for x in data['values']]
+
+    fig = Figure()
+
+    ax = fig.add_subplot(1, 1, 1)
+
+    # Create the pie chart
+    wedges, text, autotexts = ax.pie(
+        sizes, labels=data['labels'], autopct='%1.1f%%', startangle=90)
+    centre_circle = Circle((0, 0), 0.70, fc='white')
+    ax.add_artist(centre_circle)
+    ax.axis('equal')
+
+    return png_url(fig)
+
+
+'''
+    Create bar chart
+
+    args:
+        data (dict): chartdata.bar_data series
+
+    returns:
+        str: url for bar chart image
+'''
+
+
+def bar_chart(data):
+    labels = data['labels']
+
+    fig = Figure()
+    ax = fig.add_axes([0.1, 0.25, 0.8, 0.6])
+
+    # Create the bar chart
+    ax.bar(labels, data['values'], color=data['colors'], width=0.4)
+
+    ax.set_xlabel('Statistic')
+    ax.set_ylabel('Rating')
+    ax.set_title(data['title'])
+    ax.set_xticks(range(len(labels)))
+    ax.set_xticklabels(labels, rotation=90)
+
+    return png_url(fig)
+
+
+'''
+    Create histogram of one category
+
+    args:
+        data (dict): chartdata.histogram_data series
+
+    returns:
+        str: url for histogram image
+'''
+
+
+def histogram_chart(data):
+    low, width, counts = data['low'], data['width'], data['values']
+    starts = [low + i * width for i in range(len(counts))]
+
+    fig = Figure()
+    ax = fig.add_axes([0.12, 0.15, 0.8, 0.7])
+
+    # Create the histogram from the precomputed bins
+    ax.bar(starts, counts, width=width, align='edge', color='#1f77b4', edgecolor='white')
+
+    ax.set_xlabel(data['label'])
+    ax.set_ylabel('Count')
+    ax.set_title(data['title'])
+
+    return png_url(fig)
+
+
+'''
+    Create trend chart of the feature means by release year
+
+    args:
+        data (dict): chartdata.trend_data series
+
+    returns:
+        str: url for trend chart image
+'''
+
+
+def trend_chart(data):
+    years = data['years']
+
+    fig = Figure(figsize=(10, 12))
+    axes = fig.subplots(5, 2, sharex=True)
+    fig.suptitle('Trends for your search by release year!')
+
+    # Song count first, then one panel per feature, since their scales differ
+    axes[0][0].bar(years, data['counts'], color='#17becf')
+    axes[0][0].set_title('songs')
+    for ax, label, color, values in zip(axes.flat[1:], data['labels'], data['colors'],
+                                        data['series']):
+        ax.plot(years, [float('nan') if v is None else v for v in values],
+                color=color, marker='.')
+        ax.set_title(label)
+    for ax in axes[-1]:
+        ax.set_xlabel('Release Year')
+    fig.tight_layout()
+
+    return png_url(fig)
+
+
+RENDERERS = {'pie': pie_chart, 'bar': bar_chart,
+             'histogram': histogram_chart, 'trend': trend_chart}
+
+
+'''
+    Rasterize any chart series
+
+    args:
+        data (dict): series from chartdata.py
+
+    returns:
+        str: url for chart image
+'''
+
+
+def render_png(data):
+    return RENDERERS[data['kind']](data)
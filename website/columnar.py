@@ -0,0 +1,275 @@
+"""In-memory columnar copy of the numeric Song columns.
+
+When enabled (COLUMNAR_ENGINE), the numeric columns of Song are loaded into
+NumPy arrays at startup. Stats and charts for searches that only filter on
+release year and the explicit flag are then answered with vectorized masks
+instead of another pass over SQLite. SQLite stays the source of truth: rows
+touched by /change are re-read and patched in with sync().
+
+The arrays are never modified once published. sync() builds new ones and
+swaps them in as a single View, and a search takes the view once, with
+mask(), and computes everything from the Mask it gets back. A sync landing
+in the middle of a search then can't change the rows under it.
+"""
+from .schema import number_of, year_of
+from typing import NamedTuple
+import os
+import sqlite3
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Columns in the order the bar chart plots them (chartdata.FEATURES)
+FEATURES = ['Popularity', 'Danceability', 'Energy', 'Loudness', 'Speechiness',
+            'Acousticness', 'Instrumentalness', 'Liveness', 'Valence']
+
+COLUMNS = FEATURES + ['TrackDuration', 'ReleaseYear', 'Explicit']
+
+# The release year follows the same rule as Song.ReleaseYear, so undated
+# songs are NULL (NaN here) and drop out of date filters like in SQLite.
+# Values not stored as numbers (e.g. '' or 'high') load as NaN too.
+SELECT = f'''SELECT rowid, {", ".join(number_of(c) for c in FEATURES + ['TrackDuration'])},
+    {year_of('ReleaseDate')}, Explicit = 'true' FROM Song'''
+
+
+'''
+    Convert fetched Song rows into column arrays
+
+    args:
+        rows (list): tuples from SELECT
+
+    returns:
+        rowids (ndarray): Song rowids,
+        columns (dict): column name -> float64 ndarray
+'''
+
+
+def to_columns(rows):
+    data = np.array(rows, dtype=np.float64).reshape(len(rows), len(COLUMNS) + 1)
+    rowids = data[:, 0].astype(np.int64)
+    columns = {name: np.ascontiguousarray(data[:, i + 1])
+               for i, name in enumerate(COLUMNS)}
+    return rowids, columns
+
+
+class View(NamedTuple):
+    rowids: object
+    columns: dict
+    live: object
+
+
+class Mask(NamedTuple):
+    # Rows of view matching a search's filters
+    view: View
+    rows: object
+
+    def any(self):
+        return bool(self.rows.any())
+
+
+class ColumnarSnapshot:
+    def __init__(self, rowids, columns):
+        self.lock = threading.Lock()
+        self.view = View(rowids, columns, np.ones(len(rowids), dtype=bool))
+        self.index = None
+
+    @property
+    def columns(self):
+        return self.view.columns
+
+    @classmethod
+    def from_database(cls, conn):
+        return cls(*to_columns(conn.execute(SELECT).fetchall()))
+
+    '''
+        Build a boolean mask of rows matching the numeric filters
+
+        args:
+            date1 (int): starting year (inclusive),
+            date2 (int): ending year (exclusive),
+            explicit (bool): whether explicit songs are included
+
+        returns:
+            Mask: the current view, and True for its matching rows
+    '''
+
+    def mask(self, date1=None, date2=None, explicit=True):
+        view = self.view
+        rows = view.live.copy()
+        year = view.columns['ReleaseYear']
+        # Same bounds as the ReleaseYear conditions of the SQL path
+        if date1:
+            rows &= year >= int(date1)
+        if date2:
+            rows &= year < int(date2)
+        if not explicit:
+            rows &= view.columns['Explicit'] == 0
+        return Mask(view, rows)
+
+    '''
+        Compute one statistic over the masked rows
+
+        args:
+            stat (str): AVG, MIN, MAX, median or STDDEV,
+            category (str): column name,
+            mask (Mask): rows to include
+
+        returns:
+            value (float): result, or the rowid of the matching row for MIN/MAX
+    '''
+
+    def aggregate(self, stat, category, mask):
+        view, rows = mask
+        values = view.columns[category][rows]
+        known = ~np.isnan(values)
+        values = values[known]
+        if not len(values):
+            return None
+        if stat == 'MIN' or stat == 'MAX':
+            i = values.argmin() if stat == 'MIN' else values.argmax()
+            return int(view.rowids[rows][known][i])
+        if stat == 'median':
+            return float(np.median(values))
+        if stat == 'STDDEV':
+            return float(values.std())
+        return float(values.mean())
+
+    '''
+        Compute a statistic of one column over the masked rows
+
+        args:
+            stat (str): AVG, MIN, MAX, median or STDDEV,
+            category (str): column to summarize,
+            mask (Mask): rows to include
+
+        returns:
+            float or None: the value itself, also for MIN and MAX
+    '''
+
+    def statistic(self, stat, category, mask):
+        if stat == 'MIN' or stat == 'MAX':
+            view, rows = mask
+            values = view.columns[category][rows]
+            values = values[~np.isnan(values)]
+            if not len(values):
+                return None
+            return float(values.min() if stat == 'MIN' else values.max())
+        return self.aggregate(stat, category, mask)
+
+    '''
+        Compute the mean of every chart feature over the masked rows
+
+        args:
+            mask (Mask): rows to include
+
+        returns:
+            list: means in FEATURES order
+    '''
+
+    def means(self, mask):
+        view, rows = mask
+        return [float(np.nanmean(view.columns[name][rows])) if rows.any() else 0.0
+                for name in FEATURES]
+
+    '''
+        Order the masked rows by a column, largest first
+
+        args:
+            category (str): column to sort on,
+            mask (Mask): rows to include
+
+        returns:
+            ndarray: rowids in sorted order
+    '''
+
+    def order(self, category, mask):
+        view, rows = mask
+        values = view.columns[category][rows]
+        return view.rowids[rows][np.argsort(-values, kind='stable')]
+
+    '''
+        Re-read the given Song rows and patch them into the snapshot
+
+        args:
+            conn (sqlite3.Connection): connection to read from,
+            rowids (iterable): rowids that were inserted, updated or deleted
+    '''
+
+    def sync(self, conn, rowids):
+        rowids = list(rowids)
+        if not rowids:
+            return
+        marks = ', '.join('?' * len(rowids))
+        rows = conn.execute(
+            f'{SELECT} WHERE rowid IN ({marks})', rowids).fetchall()
+
+        with self.lock:
+            view = self.view
+            if self.index is None:
+                self.index = {int(r): i for i, r in enumerate(view.rowids)}
+
+            # Copies, never the published arrays (which may also be mapped
+            # read-only from the feature store)
+            columns = {name: np.array(view.columns[name]) for name in COLUMNS}
+            live = view.live.copy()
+            all_rowids = view.rowids
+
+            found = set()
+            new = []
+            for row in rows:
+                found.add(row[0])
+                i = self.index.get(row[0])
+                if i is None:
+                    new.append(row)
+                    continue
+                for name, value in zip(COLUMNS, row[1:]):
+                    columns[name][i] = np.nan if value is None else value
+                live[i] = True
+
+            for rowid in rowids:
+                if rowid not in found and rowid in self.index:
+                    live[self.index[rowid]] = False
+
+            if new:
+                new_rowids, new_columns = to_columns(new)
+                start = len(all_rowids)
+                columns = {name: np.concatenate((columns[name], new_columns[name]))
+                           for name in COLUMNS}
+                all_rowids = np.concatenate((all_rowids, new_rowids))
+                live = np.concatenate((live, np.ones(len(new), dtype=bool)))
+                for offset, rowid in enumerate(new_rowids):
+                    self.index[int(rowid)] = start + offset
+
+            # Publish the new arrays together, in one assignment
+            self.view = View(all_rowids, columns, live)
+
+
+'''
+    Load the columnar snapshot if it is enabled and NumPy is available
+
+    args:
+        app (Flask): application being created
+
+    returns:
+        ColumnarSnapshot or None
+'''
+
+
+def init_columnar(app):
+    if app.config.get('FEATURE_STORE_PATH'):
+        from .featurestore import init_feature_store
+        return init_feature_store(app)
+
+    database = app.config['DATABASE']
+    if not app.config.get('COLUMNAR_ENGINE') or np is None or not os.path.exists(database):
+        return None
+    conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    try:
+        snapshot = ColumnarSnapshot.from_database(conn)
+    finally:
+        conn.close()
+    app.extensions['columnar'] = snapshot
+    return snapshot
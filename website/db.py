@@ -0,0 +1,275 @@
+"""Database connections.
+
+Searches only read, so they go through connect_read(), which opens Music.db
+(or a periodically refreshed snapshot copy of it) read-only with a large
+mmap window. Pages are then shared through the OS page cache across worker
+processes, and reads never take the write lock that /change needs. Writes
+go through the single writer thread in writer.py.
+
+Closing a read connection hands it back to a small per-process pool
+(READ_POOL_SIZE), so a search doesn't pay for opening the file, parsing
+the schema and setting up the mmap again.
+
+Async handlers (asgi.py) read through an AsyncReader instead: the work is
+awaited on a fixed pool of reader threads, one pooled connection each,
+so the event loop itself never blocks on SQLite.
+
+A search can give its connection a deadline (QUERY_DEADLINES, seconds per
+route). SQLite then calls back every PROGRESS_STEPS virtual machine
+instructions and the running statement is interrupted once the time is
+up, raising sqlite3.OperationalError: interrupted.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from .schema import migrate
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+
+DATABASE = 'Music.db'
+
+PROGRESS_STEPS = 10000
+
+
+class PooledConnection(sqlite3.Connection):
+    pool = None
+    idle = False
+
+    def close(self):
+        if self.idle:
+            return
+        # Hand the connection back instead, unless the pool is full
+        if self.pool is not None:
+            if self.in_transaction:
+                self.rollback()
+            # A deadline only lasts for the search that set it
+            self.set_progress_handler(None, 0)
+            if self.pool.put(self):
+                return
+        super().close()
+
+
+class ReadPool:
+    def __init__(self, size):
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            while self.idle:
+                conn_key, conn = self.idle.pop()
+                conn.idle = False
+                if conn_key == key:
+                    return conn
+                # Opened on a snapshot that has since been replaced
+                conn.pool = None
+                conn.close()
+        return None
+
+    def put(self, conn):
+        with self.lock:
+            if len(self.idle) >= self.size:
+                return False
+            conn.idle = True
+            self.idle.append((conn.key, conn))
+            return True
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+'''
+    Open a read-only connection for searches
+
+    returns:
+        conn (sqlite3.Connection): connection with query_only set
+'''
+
+
+def connect_read():
+    config = current_app.config
+    snapshot = config.get('READ_SNAPSHOT_PATH')
+
+    # The snapshot file is only ever replaced by rename, never modified,
+    # so SQLite can skip locking and change detection on it entirely
+    if snapshot and os.path.exists(snapshot):
+        uri = f'file:{snapshot}?mode=ro&immutable=1'
+        key = (uri, os.stat(snapshot).st_ino)
+    else:
+        uri = f"file:{config.get('DATABASE', DATABASE)}?mode=ro"
+        key = (uri, None)
+
+    size = config.get('READ_POOL_SIZE', 0)
+    pool = None
+    if size:
+        # Pooled connections aren't carried across fork
+        with pools_lock:
+            pool = pools.get(os.getpid())
+            if pool is None:
+                pool = pools[os.getpid()] = ReadPool(size)
+        conn = pool.get(key)
+        if conn is not None:
+            conn.pool = pool
+            return conn
+
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False, factory=PooledConnection)
+    conn.execute(f"PRAGMA mmap_size={int(config.get('READ_MMAP_SIZE', 0))}")
+    conn.execute('PRAGMA query_only=1')
+    conn.key = key
+    conn.pool = pool
+    return conn
+
+
+class Deadline:
+    def __init__(self, conn, route, seconds):
+        self.route = route
+        self.seconds = seconds
+        self.start = time.monotonic()
+        if seconds:
+            conn.set_progress_handler(self.check, PROGRESS_STEPS)
+
+    def check(self):
+        # Nonzero makes SQLite interrupt the statement
+        return self.expired
+
+    @property
+    def expired(self):
+        return bool(self.seconds) and time.monotonic() - self.start > self.seconds
+
+    '''
+        Tell whether an error is this deadline interrupting a query, and
+        if so count it
+
+        args:
+            error (Exception): error the query raised,
+            stage (str): part of the search the query was for
+
+        returns:
+            bool: True if the query was cancelled for running too long
+    '''
+
+    def cancelled(self, error, stage):
+        if not (isinstance(error, sqlite3.OperationalError) and self.expired):
+            return False
+        metrics = current_app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.record('query_cancelled', self.route, stage, time.monotonic() - self.start)
+        return True
+
+
+'''
+    Give a search's read connection its route's deadline
+
+    args:
+        conn (sqlite3.Connection): connection from connect_read(),
+        route (str): key in QUERY_DEADLINES
+
+    returns:
+        Deadline: shared by every query the search runs on conn
+'''
+
+
+def start_deadline(conn, route):
+    seconds = current_app.config.get('QUERY_DEADLINES', {}).get(route)
+    return Deadline(conn, route, seconds)
+
+
+class AsyncReader:
+    def __init__(self, app, threads):
+        self.app = app
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='reader')
+
+    '''
+        Run database reads on a reader thread and wait for them without
+        blocking the event loop
+
+        args:
+            fn (callable): reads through connect_read(), called as fn(*args),
+            *args: arguments for fn,
+            environ (dict): WSGI environ to run fn in a request context of,
+                for fn that need the session; None for an app context
+
+        returns:
+            whatever fn returns
+    '''
+
+    async def run(self, fn, *args, environ=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.call, fn, args, environ)
+
+    def call(self, fn, args, environ):
+        app = self.app
+        context = app.request_context(environ) if environ is not None else app.app_context()
+        with context:
+            # What the before_request hooks do for Flask's own routes:
+            # bring the in-memory caches up to date first
+            feed = app.extensions.get('changefeed')
+            if feed is not None:
+                feed.poll()
+            store = app.extensions.get('feature_store')
+            if store is not None:
+                store.reload_if_changed()
+            return fn(*args)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+'''
+    Copy the database to a read-only snapshot file
+
+    args:
+        database (str): path of the live database,
+        snapshot (str): path the snapshot should be published at
+'''
+
+
+def refresh_snapshot(database, snapshot):
+    tmp = f'{snapshot}.{os.getpid()}.tmp'
+    src = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    dst = sqlite3.connect(tmp)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    os.replace(tmp, snapshot)
+
+
+'''
+    Prepare the database when the app starts
+
+    args:
+        app (Flask): application being created
+'''
+
+
+def init_db(app):
+    database = app.config.get('DATABASE', DATABASE)
+    if not os.path.exists(database):
+        return
+
+    # WAL lets readers keep going while a write is in progress
+    conn = sqlite3.connect(database, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    migrate(conn)
+    conn.close()
+
+    snapshot = app.config.get('READ_SNAPSHOT_PATH')
+    if snapshot:
+        refresh_snapshot(database, snapshot)
+        interval = app.config.get('READ_SNAPSHOT_INTERVAL', 60)
+
+        def refresh_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    refresh_snapshot(database, snapshot)
+                except sqlite3.Error:
+                    pass
+
+        threading.Thread(target=refresh_loop, daemon=True).start()
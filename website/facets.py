@@ -0,0 +1,79 @@
+"""Facet counts for song searches.
+
+While a search's results stream past (see pipeline.py), FacetCounts tallies
+how the matches split by Explicit, Label, release decade and Artist. All
+four come out of the pass the results take anyway, so facets add no query.
+Picking a value adds an exact-match drill-down filter to the saved search.
+"""
+from collections import Counter
+
+# Facet -> position of its column in a Song row (SELECT *)
+FACETS = {'Explicit': 8, 'Decade': 20, 'Label': 18, 'Artist': 3}
+
+# Values shown per facet, largest first
+TOP_VALUES = 10
+
+
+class FacetCounts:
+    def __init__(self):
+        self.counts = {name: Counter() for name in FACETS}
+
+    def add(self, row):
+        for name, column in FACETS.items():
+            value = row[column]
+            if name == 'Decade':
+                # ReleaseYear is NULL or 0 for songs without a usable date
+                value = value // 10 * 10 if value else None
+            if value is not None and value != '':
+                self.counts[name][value] += 1
+
+    '''
+        The most common values of every facet
+
+        args:
+            k (int): values to keep per facet
+
+        returns:
+            dict: facet -> [(value, count)], decades in order, the rest by count
+    '''
+
+    def top(self, k=TOP_VALUES):
+        top = {}
+        for name, counts in self.counts.items():
+            if name == 'Decade':
+                values = sorted(counts.items())
+            else:
+                values = counts.most_common(k)
+            if values:
+                top[name] = values
+        return top
+
+
+'''
+    Build the conditions for the facet values picked
+
+    args:
+        facets (dict): facet -> value picked, as saved in the session,
+        cube (bool): whether the conditions are for SongCube, which keeps
+            Explicit as 0/1 instead of 'true'/'false'
+
+    returns:
+        conditions (list): SQL conditions,
+        params (list): parameters for the conditions
+'''
+
+
+def facet_filters(facets, cube=False):
+    conditions = []
+    params = []
+    for name, value in (facets or {}).items():
+        if name == 'Decade' and str(value).isdigit():
+            conditions.append('ReleaseYear >= ? AND ReleaseYear < ?')
+            params += [int(value), int(value) + 10]
+        elif name == 'Explicit':
+            conditions.append('Explicit = ?')
+            params.append(int(value == 'true') if cube else value)
+        elif name in ('Label', 'Artist'):
+            conditions.append(f'{name} = ?')
+            params.append(value)
+    return conditions, params
@@ -0,0 +1,327 @@
+"""Memory-mapped feature store shared by worker processes.
+
+The numeric Song columns are exported to one .npy file per column inside a
+versioned directory, with a manifest describing the build:
+
+    feature_store/
+        CURRENT             -> name of the live version directory
+        v1700000000000/
+            manifest.json
+            rowids.npy
+            Popularity.npy
+            ...
+
+Workers map the live version read-only, so every process shares the same
+pages through the OS page cache instead of holding its own copy. A rebuild
+writes a new version directory and then replaces CURRENT with a rename, so
+readers always see a complete version. Workers notice the new CURRENT and
+remap on their next request.
+
+The manifest records the ChangeLog version the build read. A build never
+replaces one made from a newer version, so with several workers rebuilding
+at once the last to finish can't publish stale data. After mapping a
+version, a worker replays the changes logged since its build, so rows the
+change feed already patched in are not lost by the remap.
+
+Build from the command line with:
+
+    python -m website.featurestore [Music.db] [feature_store]
+"""
+from .changelog import changes_since, latest_version
+from .columnar import COLUMNS, SELECT, ColumnarSnapshot, to_columns, np
+from contextlib import nullcontext
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CURRENT = 'CURRENT'
+
+# Taken around publishing, across processes where fcntl is available
+LOCK = '.lock'
+
+
+'''
+    Export the numeric Song columns to a new store version
+
+    args:
+        database (str): path to Music.db,
+        root (str): feature store directory,
+        keep (int): number of versions to keep on disk
+
+    returns:
+        version (str): name of the live version, which is the one already
+            published if it was built from newer changes than this build
+'''
+
+
+def build(database, root, keep=2):
+    os.makedirs(root, exist_ok=True)
+
+    conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    try:
+        # One read transaction, so the rows match the recorded version
+        conn.execute('BEGIN')
+        try:
+            changes = latest_version(conn)
+        except sqlite3.OperationalError:
+            # Database not migrated yet, so nothing has been logged
+            changes = 0
+        rowids, columns = to_columns(conn.execute(SELECT).fetchall())
+        conn.rollback()
+    finally:
+        conn.close()
+
+    # Unique per build; the version name is only picked when publishing
+    tmp = tempfile.mkdtemp(prefix='.build-', suffix='.tmp', dir=root)
+
+    np.save(os.path.join(tmp, 'rowids.npy'), rowids)
+    for name in COLUMNS:
+        np.save(os.path.join(tmp, f'{name}.npy'), columns[name])
+
+    with open(os.path.join(root, LOCK), 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+        live = current_version(root)
+        if live is not None and read_manifest(root, live).get('changes', 0) > changes:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return live
+
+        version = next_version(root)
+        manifest = {
+            'version': version,
+            'rows': len(rowids),
+            'columns': COLUMNS,
+            'changes': changes,
+            'source': os.path.abspath(database),
+            'created': time.time()
+        }
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        # Publish: the version directory first, then the pointer to it
+        os.rename(tmp, os.path.join(root, version))
+        pointer = os.path.join(root, f'.{CURRENT}.{os.getpid()}.tmp')
+        with open(pointer, 'w') as f:
+            f.write(version)
+        os.replace(pointer, os.path.join(root, CURRENT))
+
+        # Drop old versions; workers still mapping them keep their open files
+        versions = sorted(d for d in os.listdir(root) if d.startswith('v'))
+        for old in versions[:-keep]:
+            shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+
+    return version
+
+
+'''
+    Pick the name for a new store version: the current time in
+    milliseconds, moved past the newest version on disk so builds in the
+    same millisecond don't collide and names keep sorting by age. Called
+    with the store lock held
+
+    args:
+        root (str): feature store directory
+
+    returns:
+        str: version name
+'''
+
+
+def next_version(root):
+    stamp = time.time_ns() // 1000000
+    for d in os.listdir(root):
+        if d.startswith('v') and d[1:].isdigit():
+            stamp = max(stamp, int(d[1:]) + 1)
+    return f'v{stamp}'
+
+
+'''
+    Read the name of the live store version
+
+    args:
+        root (str): feature store directory
+
+    returns:
+        str or None: version name, None if nothing has been built
+'''
+
+
+def current_version(root):
+    try:
+        with open(os.path.join(root, CURRENT)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+'''
+    Read the manifest of a store version
+
+    args:
+        root (str): feature store directory,
+        version (str): version directory name
+
+    returns:
+        dict: manifest written by build()
+'''
+
+
+def read_manifest(root, version):
+    with open(os.path.join(root, version, 'manifest.json')) as f:
+        return json.load(f)
+
+
+'''
+    Map the live store version as a columnar snapshot
+
+    args:
+        root (str): feature store directory
+
+    returns:
+        ColumnarSnapshot or None: snapshot over read-only memory maps
+'''
+
+
+def open_store(root):
+    version = current_version(root)
+    if version is None:
+        return None
+    path = os.path.join(root, version)
+    manifest = read_manifest(root, version)
+
+    rowids = np.load(os.path.join(path, 'rowids.npy'), mmap_mode='r')
+    columns = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+               for name in manifest['columns']}
+    snapshot = ColumnarSnapshot(rowids, columns)
+    snapshot.version = version
+    # Stores built before the manifest recorded it are rebuilt
+    snapshot.changes = manifest.get('changes')
+    return snapshot
+
+
+class FeatureStore:
+    # Seconds between checks for a newer version
+    check_interval = 5
+
+    def __init__(self, app, root):
+        self.app = app
+        self.root = root
+        self.database = app.config['DATABASE']
+        self.checked = 0
+        self.lock = threading.Lock()
+        self.building = False
+        self.pending = False
+
+    '''
+        Map the live version, bring it up to date with the change log and
+        make it the snapshot searches use
+    '''
+
+    def load(self):
+        snapshot = open_store(self.root)
+        if snapshot is None:
+            return None
+        feed = self.app.extensions.get('changefeed')
+
+        # Under the feed's lock, so no catch-up syncs the old snapshot
+        # after the replay has read the log
+        with feed.lock if feed is not None else nullcontext():
+            conn = sqlite3.connect(f'file:{self.database}?mode=ro', uri=True)
+            try:
+                oldest = conn.execute('SELECT MIN(Version) FROM ChangeLog').fetchone()[0]
+                if snapshot.changes is None or (oldest is not None and oldest > snapshot.changes + 1):
+                    # Entries since the build were trimmed from the log
+                    self.schedule_rebuild()
+                else:
+                    _, touched = changes_since(conn, snapshot.changes)
+                    snapshot.sync(conn, touched['Song'])
+            finally:
+                conn.close()
+            self.app.extensions['columnar'] = snapshot
+        return snapshot
+
+    '''
+        Swap in the newest version if another process published one
+    '''
+
+    def reload_if_changed(self):
+        now = time.monotonic()
+        if now - self.checked < self.check_interval:
+            return
+        self.checked = now
+
+        snapshot = self.app.extensions.get('columnar')
+        version = current_version(self.root)
+        if version and getattr(snapshot, 'version', None) != version:
+            self.load()
+
+    '''
+        Rebuild the store in the background after the catalog changed. A
+        request during a rebuild queues one more, which then covers every
+        change made in the meantime.
+    '''
+
+    def schedule_rebuild(self):
+        with self.lock:
+            if self.building:
+                self.pending = True
+                return
+            self.building = True
+
+        def run():
+            while True:
+                try:
+                    build(self.database, self.root)
+                    self.checked = 0
+                except Exception:
+                    self.app.logger.exception('Rebuilding the feature store failed')
+                with self.lock:
+                    if not self.pending:
+                        self.building = False
+                        return
+                    self.pending = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+'''
+    Load song features from the feature store, building it if needed
+
+    args:
+        app (Flask): application being created
+
+    returns:
+        ColumnarSnapshot or None
+'''
+
+
+def init_feature_store(app):
+    root = app.config.get('FEATURE_STORE_PATH')
+    if not root or np is None or not os.path.exists(app.config['DATABASE']):
+        return None
+
+    if current_version(root) is None:
+        build(app.config['DATABASE'], root)
+
+    store = FeatureStore(app, root)
+    app.extensions['feature_store'] = store
+    store.load()
+    app.before_request(store.reload_if_changed)
+    return app.extensions.get('columnar')
+
+
+if __name__ == '__main__':
+    database = sys.argv[1] if len(sys.argv) > 1 else 'Music.db'
+    root = sys.argv[2] if len(sys.argv) > 2 else 'feature_store'
+    print(f'Published {build(database, root)} in {root}')
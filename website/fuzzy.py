@@ -0,0 +1,84 @@
+"""Typo-tolerant name search over the Trigram index.
+
+schema.py keeps a Trigram row for every distinct three-letter piece of each
+song title, song artist, album title and artist name, maintained by
+triggers. A fuzzy search splits the query the same way and takes as
+candidates the rows sharing at least THRESHOLD of the query's trigrams,
+which is one index range per trigram instead of a LIKE scan of the table.
+Candidates are then ranked by how similar the whole name is to the query.
+"""
+import json
+import math
+
+# Share of the query's trigrams a name must contain to match. A one-letter
+# typo in a word of five or more letters keeps more than half of them.
+THRESHOLD = 0.5
+
+
+'''
+    Prepare text the way schema.trigram_split does in SQL
+
+    args:
+        text (str): name or query
+
+    returns:
+        str: lowercased (ASCII only, like SQLite's lower()), with each word
+            padded by two spaces before and one after
+'''
+
+
+def normalize(text):
+    lowered = ''.join(c.lower() if c.isascii() else c for c in text)
+    return '  ' + lowered.replace(' ', '  ') + ' '
+
+
+def trigrams(text):
+    padded = normalize(text)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+'''
+    Build the condition matching rows whose name is close to a query
+
+    args:
+        kind (str): Trigram kind, one of schema.TRIGRAM_COLUMNS,
+        key (str): rowid reference of the searched table, e.g. "Song.rowid",
+        text (str): user search query
+
+    returns:
+        condition (str): SQL condition,
+        params (list): parameters for the condition
+'''
+
+
+def fuzzy_filter(kind, key, text):
+    grams = sorted(trigrams(text))
+    condition = f'''{key} IN (SELECT RowKey FROM Trigram
+        WHERE Kind = '{kind}' AND Gram IN (SELECT value FROM json_each(?))
+        GROUP BY RowKey HAVING COUNT(*) >= ?)'''
+    return condition, [json.dumps(grams), math.ceil(THRESHOLD * len(grams))]
+
+
+'''
+    Build the similarity of a row's name to a query, for ORDER BY ... DESC
+
+    args:
+        kind (str): Trigram kind, one of schema.TRIGRAM_COLUMNS,
+        key (str): rowid reference of the searched table, e.g. "Song.rowid",
+        column (str): name column of the searched table, e.g. "Song.Song",
+        text (str): user search query
+
+    returns:
+        expression (str): SQL expression, 1 for identical names,
+        params (list): parameters for the expression
+'''
+
+
+def fuzzy_rank(kind, key, column, text):
+    grams = sorted(trigrams(text))
+    # Shared trigrams over the trigrams of both, the name's counted from
+    # its length and spaces (the same padding as normalize)
+    shared = f'''(SELECT COUNT(*) FROM Trigram WHERE Kind = '{kind}' AND RowKey = {key}
+        AND Gram IN (SELECT value FROM json_each(?)))'''
+    size = f"(length({column}) * 2 + 1 - length(replace({column}, ' ', '')))"
+    return f'2.0 * {shared} / ({len(grams)} + {size})', [json.dumps(grams)]
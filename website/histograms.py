@@ -0,0 +1,304 @@
+"""Binned distributions of the numeric song features.
+
+Every Song feature is split into BINS equal-width bins between its catalog
+minimum and maximum. For the common cases the counts are precomputed:
+
+  * per release year and explicit flag, so no filter, an explicit filter,
+    a year range or both are answered by summing slices of one array;
+  * per artist search, for the most recently used artist queries.
+
+/change keeps all of them current by subtracting the old version of each
+touched row and adding the new one. Any other filter combination is
+answered with a single GROUP BY over the bin expression in SQLite.
+"""
+from .schema import number_of, year_of
+from collections import OrderedDict
+import os
+import sqlite3
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+BINS = 20
+
+SONG_CATEGORIES = ['TrackDuration', 'Popularity', 'Danceability', 'Energy', 'Loudness',
+                   'Speechiness', 'Acousticness', 'Instrumentalness', 'Liveness', 'Valence']
+
+ALBUM_CATEGORIES = ['AverageRating', 'NumberofReviews']
+
+# Release year of a Song row, NULL unless ReleaseDate starts with one
+YEAR = year_of('ReleaseDate')
+
+# Artist queries whose histograms are kept up to date
+ARTIST_CACHE_SIZE = 256
+
+
+'''
+    Build the SQL expression that maps a column to its bin number
+
+    args:
+        category (str): column name,
+        edges (tuple): (low, width) of the bins
+
+    returns:
+        str: SQL expression evaluating to 0..BINS-1, NULL for values not
+            stored as numbers
+'''
+
+
+def bin_expression(category, edges):
+    low, width = edges
+    value = number_of(category)
+    return f'MIN({BINS - 1}, MAX(0, CAST(({value} - {low!r}) / {width!r} AS INTEGER)))'
+
+
+'''
+    Find the bin edges for each category
+
+    args:
+        conn (sqlite3.Connection): connection to read from,
+        table (str): Song or Album,
+        categories (list): numeric columns of that table
+
+    returns:
+        dict: category -> (low, width)
+'''
+
+
+def find_edges(conn, table, categories):
+    selects = ', '.join(f'MIN({number_of(c)}), MAX({number_of(c)})' for c in categories)
+    row = conn.execute(f'SELECT {selects} FROM {table}').fetchone()
+    edges = {}
+    for i, category in enumerate(categories):
+        low, high = row[2 * i], row[2 * i + 1]
+        if low is None:
+            low, high = 0, 1
+        edges[category] = (float(low), (float(high) - float(low)) / BINS or 1.0)
+    return edges
+
+
+'''
+    Count rows per bin with one grouped query
+
+    args:
+        conn (sqlite3.Connection): connection to read from,
+        table (str): table to count,
+        category (str): column to bin,
+        edges (tuple): (low, width) of the bins,
+        where (str): SQL condition for the current filters,
+        params (list): parameters for the condition
+
+    returns:
+        list: BINS counts
+'''
+
+
+def query_counts(conn, table, category, edges, where='1', params=()):
+    counts = [0] * BINS
+    query = f'''SELECT {bin_expression(category, edges)} AS bin, COUNT(*) FROM {table}
+        WHERE {number_of(category)} IS NOT NULL AND ({where}) GROUP BY bin'''
+    for b, n in conn.execute(query, params):
+        counts[b] = n
+    return counts
+
+
+class SongHistograms:
+    def __init__(self, conn):
+        self.lock = threading.Lock()
+        self.edges = find_edges(conn, 'Song', SONG_CATEGORIES)
+        self.artists = OrderedDict()
+
+        low, high = conn.execute(f'SELECT MIN({YEAR}), MAX({YEAR}) FROM Song').fetchone()
+        self.first_year = low or 0
+        years = (high or 0) - self.first_year + 1
+
+        # counts[category][year - first_year, explicit, bin]
+        self.counts = {c: np.zeros((years, 2, BINS), dtype=np.int64)
+                       for c in SONG_CATEGORIES}
+        # Songs without a usable release date only count when no year is set
+        self.undated = {c: np.zeros((2, BINS), dtype=np.int64)
+                        for c in SONG_CATEGORIES}
+        bins = ', '.join(bin_expression(c, self.edges[c]) for c in SONG_CATEGORIES)
+        for row in conn.execute(f"SELECT {YEAR}, IFNULL(Explicit = 'true', 0), {bins} FROM Song"):
+            for category, b in zip(SONG_CATEGORIES, row[2:]):
+                if b is None:
+                    continue
+                if row[0] is None:
+                    self.undated[category][row[1], b] += 1
+                else:
+                    self.counts[category][row[0] - self.first_year, row[1], b] += 1
+
+    def bin(self, category, value):
+        # Like bin_expression, skip anything SQLite wouldn't store as a number
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value != value:
+            return None
+        low, width = self.edges[category]
+        return min(BINS - 1, max(0, int((value - low) / width)))
+
+    def year_slot(self, year):
+        if year < self.first_year:
+            pad = self.first_year - year
+            for c in SONG_CATEGORIES:
+                self.counts[c] = np.pad(self.counts[c], ((pad, 0), (0, 0), (0, 0)))
+            self.first_year = year
+        slot = year - self.first_year
+        size = self.counts[SONG_CATEGORIES[0]].shape[0]
+        if slot >= size:
+            for c in SONG_CATEGORIES:
+                self.counts[c] = np.pad(self.counts[c], ((0, slot - size + 1), (0, 0), (0, 0)))
+        return slot
+
+    '''
+        Get the histogram for a search if it can be answered from the
+        precomputed counts
+
+        args:
+            conn (sqlite3.Connection): connection for filling a new artist entry,
+            category (str): column to bin,
+            song (str): song title filter,
+            artist (str): artist filter,
+            date1 (str): starting year (inclusive),
+            date2 (str): ending year (exclusive),
+            explicit (bool): whether explicit songs are included
+
+        returns:
+            list or None: BINS counts, None if the filters need SQLite
+    '''
+
+    def lookup(self, conn, category, song, artist, date1, date2, explicit):
+        if song or category not in self.counts:
+            return None
+        if (date1 and not date1.isdigit()) or (date2 and not date2.isdigit()):
+            return None
+
+        if artist:
+            # Only the artist filter on its own is kept per query
+            if date1 or date2 or not explicit:
+                return None
+            return self.artist_counts(conn, artist)[category]
+
+        with self.lock:
+            counts = self.counts[category]
+            lo = max(0, int(date1) - self.first_year) if date1 else 0
+            hi = max(0, int(date2) - self.first_year) if date2 else counts.shape[0]
+            flags = slice(0, 1) if not explicit else slice(0, 2)
+            total = counts[lo:hi, flags].sum(axis=(0, 1))
+            if not date1 and not date2:
+                total = total + self.undated[category][flags].sum(axis=0)
+            return [int(n) for n in total]
+
+    def artist_counts(self, conn, artist):
+        key = artist.lower()
+        # Filled under the lock: a sync between the query and storing the
+        # counts would otherwise be missing from them for good
+        with self.lock:
+            if key in self.artists:
+                self.artists.move_to_end(key)
+                return self.artists[key]
+
+            counts = {category: [0] * BINS for category in SONG_CATEGORIES}
+            bins = ', '.join(bin_expression(c, self.edges[c]) for c in SONG_CATEGORIES)
+            for row in conn.execute(f'SELECT {bins} FROM Song WHERE Artist LIKE ?',
+                                    (f'%{artist}%',)):
+                for category, b in zip(SONG_CATEGORIES, row):
+                    if b is not None:
+                        counts[category][b] += 1
+
+            self.artists[key] = counts
+            if len(self.artists) > ARTIST_CACHE_SIZE:
+                self.artists.popitem(last=False)
+        return counts
+
+    '''
+        Work out the bins a song row counts in, without changing anything
+
+        args:
+            row (dict): Song row, from the database or the change log,
+            delta (int): 1 to add the row, -1 to take it out
+
+        returns:
+            list: (category, year, explicit, artist, bin, delta) per binned
+                value; year is None for undated songs
+    '''
+
+    def changes(self, row, delta):
+        date = row['ReleaseDate']
+        year = str(date)[:4] if date is not None else ''
+        year = int(year) if len(year) == 4 and year.isdigit() else None
+        explicit = 1 if row['Explicit'] == 'true' else 0
+        artist = str(row['Artist'] or '').lower()
+        changes = []
+        for category in SONG_CATEGORIES:
+            b = self.bin(category, row[category])
+            if b is not None:
+                changes.append((category, year, explicit, artist, b, delta))
+        return changes
+
+    def apply(self, changes):
+        for category, year, explicit, artist, b, delta in changes:
+            if year is not None:
+                # Slot first: it may replace counts[category] with a padded copy
+                slot = self.year_slot(year)
+                self.counts[category][slot, explicit, b] += delta
+            else:
+                self.undated[category][explicit, b] += delta
+            for key, counts in self.artists.items():
+                if key in artist:
+                    counts[category][b] += delta
+
+    '''
+        Move the counts of changed rows from their old bins to the new ones
+
+        args:
+            conn (sqlite3.Connection): connection to read from,
+            old_rows (dict): rowid -> row dict before the write, None for inserts
+    '''
+
+    def sync(self, conn, old_rows):
+        if not old_rows:
+            return
+        cur = conn.cursor()
+        cur.row_factory = sqlite3.Row
+        marks = ', '.join('?' * len(old_rows))
+        new_rows = cur.execute(
+            f'SELECT rowid, * FROM Song WHERE rowid IN ({marks})', list(old_rows)).fetchall()
+        cur.close()
+
+        # Every change is worked out before any is applied, so a row that
+        # can't be read leaves the counts as they were
+        changes = []
+        for old in old_rows.values():
+            if old is not None:
+                changes.extend(self.changes(old, -1))
+        for new in new_rows:
+            changes.extend(self.changes(new, 1))
+
+        with self.lock:
+            self.apply(changes)
+
+
+'''
+    Precompute the song histograms when the app starts
+
+    args:
+        app (Flask): application being created
+
+    returns:
+        SongHistograms or None
+'''
+
+
+def init_histograms(app):
+    database = app.config['DATABASE']
+    if not app.config.get('SONG_HISTOGRAMS') or np is None or not os.path.exists(database):
+        return None
+    conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    try:
+        histograms = SongHistograms(conn)
+    finally:
+        conn.close()
+    app.extensions['histograms'] = histograms
+    return histograms
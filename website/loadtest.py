@@ -0,0 +1,230 @@
+"""Load test with simulated browsing sessions.
+
+Each of --sessions concurrent sessions keeps its own session cookie and
+loops over a visit: POST a search to /songs, /albums or /artists, page
+through the results with GETs (which replay the search saved in the
+session), sometimes turn the song charts on, and now and then POST an edit
+to /change. The edit inserts a song and deletes it again in the same
+request, so the catalog ends up unchanged.
+
+    python -m website.loadtest http://127.0.0.1:5000 --sessions 50 --duration 30
+
+The report has throughput, and latency percentiles and outcomes per step.
+Besides plain errors, it counts writes that hit a SQLite lock and searches
+the server turned away (admission control or query deadlines) separately.
+"""
+from urllib.parse import urlsplit, urlencode
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from .benchmark import percentile
+
+TERMS = ['love', 'night', 'you', 'baby', 'life', 'heart', 'time', 'a', 'the', '']
+ORDERS = {'songs': ['Popularity', 'ReleaseDate', 'Danceability', 'Energy', ''],
+          'albums': ['AverageRating', 'NumberofReviews', 'ReleaseDate', ''],
+          'artists': ['Artist', 'num_tracks', '']}
+PAGES = ['songs', 'songs', 'songs', 'albums', 'artists']
+
+OUTCOMES = ('ok', 'error', 'locked', 'refused')
+
+
+class Client:
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.cookies = {}
+
+    '''
+        Send one request over a fresh connection, keeping the session cookie
+
+        args:
+            method (str): GET or POST,
+            path (str): path and query string,
+            form (dict): form fields to POST
+
+        returns:
+            status (int): HTTP status, 0 if the connection failed,
+            body (bytes): response body
+    '''
+
+    async def request(self, method, path, form=None):
+        body = urlencode(form or {}, doseq=True).encode()
+        head = [f'{method} {path} HTTP/1.1', f'Host: {self.host}:{self.port}',
+                'Connection: close']
+        if self.cookies:
+            head.append('Cookie: ' + '; '.join(f'{k}={v}' for k, v in self.cookies.items()))
+        if method == 'POST':
+            head += ['Content-Type: application/x-www-form-urlencoded',
+                     f'Content-Length: {len(body)}']
+        data = ('\r\n'.join(head) + '\r\n\r\n').encode() + (body if method == 'POST' else b'')
+
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                writer.write(data)
+                await writer.drain()
+                response = await reader.read()
+            finally:
+                writer.close()
+        except OSError:
+            return 0, b''
+
+        head, _, payload = response.partition(b'\r\n\r\n')
+        lines = head.decode('latin1').split('\r\n')
+        if not lines[0].startswith('HTTP/'):
+            return 0, b''
+        chunked = False
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            if name == 'set-cookie':
+                key, _, rest = value.strip().partition('=')
+                self.cookies[key] = rest.split(';', 1)[0]
+            elif name == 'transfer-encoding' and 'chunked' in value.lower():
+                chunked = True
+        return int(lines[0].split()[1]), dechunk(payload) if chunked else payload
+
+
+def dechunk(payload):
+    body = bytearray()
+    while payload:
+        size, _, payload = payload.partition(b'\r\n')
+        size = int(size.split(b';')[0] or b'0', 16)
+        if not size:
+            break
+        body += payload[:size]
+        payload = payload[size + 2:]
+    return bytes(body)
+
+
+'''
+    Sort a response into ok, error, locked or refused
+
+    args:
+        status (int): HTTP status, 0 if the connection failed,
+        body (bytes): response body
+
+    returns:
+        str: one of OUTCOMES
+'''
+
+
+def outcome(status, body):
+    if status != 200:
+        return 'error'
+    if b'The database is busy' in body:
+        return 'locked'
+    if b'The server is busy' in body or b'took too long' in body:
+        return 'refused'
+    if b'Something went wrong' in body:
+        return 'error'
+    return 'ok'
+
+
+def search_form(page, rng, charts=False):
+    term = rng.choice(TERMS)
+    order = rng.choice(ORDERS[page])
+    if page == 'songs':
+        form = {'song': term, 'artist': '', 'order': order, 'date1': '', 'date2': '',
+                'explicit': 'on', 'stat': 'AVG', 'category': 'Popularity'}
+        if charts:
+            form.update({'chart': 'on', 'hist': 'on'})
+        return form
+    if page == 'albums':
+        return {'album': term, 'order': order, 'date1': '', 'date2': ''}
+    return {'artist': term, 'order': order, 'genre': ''}
+
+
+def write_form(rng):
+    name = f'Load test {rng.getrandbits(48):012x}'
+    return {'trackName': name, 'artistName': 'Load Test', 'albumName': 'Load Test',
+            'duration': '180000', 'popularity': '0',
+            'danceability': '0.5', 'energy': '0.5', 'loudness': '-10',
+            'speechiness': '0.05', 'acousticness': '0.5', 'instrumentalness': '0',
+            'liveness': '0.1', 'happiness': '0.5', 'label': 'Load Test',
+            'remove_song_title': name, 'remove_song_artist': 'Load Test'}
+
+
+'''
+    Browse until the deadline, like one user with one session
+
+    args:
+        url (str): server to load,
+        rng (random.Random): this session's random choices,
+        results (dict): step -> list of (seconds, outcome), appended to,
+        deadline (float): time.monotonic() to stop at,
+        write_ratio (float): share of visits that end with an edit
+'''
+
+
+async def session(url, rng, results, deadline, write_ratio):
+    client = Client(url)
+
+    async def step(name, method, path, form=None):
+        start = time.perf_counter()
+        status, body = await client.request(method, path, form)
+        results.setdefault(name, []).append((time.perf_counter() - start, outcome(status, body)))
+
+    while time.monotonic() < deadline:
+        page = rng.choice(PAGES)
+        await step('search', 'POST', f'/{page}', search_form(page, rng))
+        for n in range(2, 2 + rng.randint(0, 3)):
+            await step('page', 'GET', f'/{page}?page={n}')
+        if page == 'songs' and rng.random() < 0.3:
+            await step('charts', 'POST', '/songs', search_form(page, rng, charts=True))
+        if rng.random() < write_ratio:
+            await step('write', 'POST', '/change', write_form(rng))
+
+
+async def run(url, sessions, duration, write_ratio, seed=None):
+    results = {}
+    deadline = time.monotonic() + duration
+    start = time.perf_counter()
+    await asyncio.gather(*(session(url, random.Random(f'{seed}-{i}' if seed is not None else None),
+                                   results, deadline, write_ratio)
+                           for i in range(sessions)))
+    return results, time.perf_counter() - start
+
+
+def report(results, elapsed):
+    total = sum(len(r) for r in results.values())
+    print(f'{total} requests in {elapsed:.1f} s: {total / elapsed if elapsed else 0:.1f} req/s')
+    print(f"{'step':<8}{'count':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          + ''.join(f'{o:>9}' for o in OUTCOMES[1:]))
+
+    everything = [r for step in results.values() for r in step]
+    for name, rows in sorted(results.items()) + [('all', everything)]:
+        latencies = [seconds for seconds, _ in rows]
+        counts = {o: sum(1 for _, result in rows if result == o) for o in OUTCOMES}
+        rates = ''.join(f'{100 * counts[o] / len(rows):>8.1f}%' for o in OUTCOMES[1:])
+        print(f'{name:<8}{len(rows):>8}' + ''.join(f'{percentile(latencies, p) * 1000:>9.0f}'
+                                                   for p in (0.50, 0.95, 0.99)) + rates)
+
+
+async def server_metrics(url):
+    status, body = await Client(url).request('GET', '/metrics')
+    return json.loads(body) if status == 200 else []
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('url', nargs='?', default='http://127.0.0.1:5000')
+    parser.add_argument('--sessions', type=int, default=20, help='concurrent sessions')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds to run for')
+    parser.add_argument('--write-ratio', type=float, default=0.05,
+                        help='share of visits that end with an edit')
+    parser.add_argument('--seed', type=int, help='repeat the same choices')
+    args = parser.parse_args()
+
+    results, elapsed = asyncio.run(run(args.url, args.sessions, args.duration,
+                                       args.write_ratio, args.seed))
+    report(results, elapsed)
+
+    # Counters of the worker process that answered
+    for metric in asyncio.run(server_metrics(args.url)):
+        summary = f", max {metric['max']}" if 'max' in metric else ''
+        print(f"server: {metric['name']} {metric['route']}/{metric['stage']}: {metric['count']}{summary}")
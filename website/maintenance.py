@@ -0,0 +1,322 @@
+"""Routine maintenance of Music.db.
+
+Edits through /change leave free pages behind, let the WAL grow and make
+the planner's statistics stale. One maintenance pass:
+
+    * refreshes the statistics with PRAGMA optimize (a full ANALYZE the
+      first time, or with --analyze),
+    * prunes change log entries older than --keep-days,
+    * returns up to --vacuum-pages free pages to the file system with an
+      incremental vacuum, if the database is in auto_vacuum=INCREMENTAL mode,
+    * checkpoints the WAL back into the database and truncates it.
+
+It reports the size of every table and index and the free pages before and
+after, checks the file for corruption (PRAGMA quick_check, or the slower
+integrity_check with --integrity), and times the standard search queries
+(SEARCHES) on either side.
+
+    python -m website.maintenance [Music.db] [--analyze] [--full-vacuum]
+
+A full VACUUM rewrites the whole file, and is the only way to switch an
+existing database to incremental mode. It may renumber Song, Album and
+Artist rowids, so --full-vacuum re-links everything keyed by them
+(schema.relink) and the running app's caches and feature store are stale
+afterwards. Stop the app first and restart it (rebuilding the feature store,
+if one is used) when it's done. The scheduled pass (MAINTENANCE_INTERVAL)
+never runs a full VACUUM.
+"""
+from .changelog import PRUNE
+from .schema import relink
+from .sorting import order_by
+import argparse
+import os
+import sqlite3
+import threading
+import time
+
+# Standard searches timed before and after maintenance: name -> (query,
+# params). They follow what views.py runs for common searches.
+SEARCHES = {
+    'songs by title': (
+        'SELECT * FROM Song WHERE Song LIKE ?' + order_by('songs', 'Popularity'), ['%love%']),
+    'songs by year': (
+        '''SELECT * FROM Song WHERE Song.ReleaseYear >= ? AND Song.ReleaseYear < ?
+            AND Explicit = 'false' ''' + order_by('songs', 'ReleaseDate'), [1990, 2000]),
+    'songs by artist': (
+        'SELECT * FROM Song WHERE Artist LIKE ?' + order_by('songs', 'Energy'), ['%the%']),
+    'songs by popularity': (
+        'SELECT * FROM Song' + order_by('songs', 'Popularity'), []),
+    'song stats': (
+        '''SELECT COUNT(Energy), AVG(Energy), MIN(Energy), MAX(Energy), AVG(Energy * Energy)
+            FROM Song WHERE Song.ReleaseYear >= ?''', [2000]),
+    'song groups': (
+        '''SELECT Label, SUM(EnergyN), SUM(EnergySum) / SUM(EnergyN) FROM SongCube
+            WHERE ReleaseYear > 0 AND ReleaseYear >= ? GROUP BY Label ORDER BY 2 DESC
+            LIMIT 100''', [1990]),
+    'albums by title': (
+        '''SELECT DISTINCT Album.Ranking, Album.Album, Album.Artist, Album.ReleaseDate,
+            Album.Genres, Album.AverageRating, Album.NumberofReviews, Song.AlbumImageURL
+            FROM Album LEFT JOIN Song ON Album.Album = Song.Album
+            WHERE Album.Album LIKE ?''' + order_by('albums', 'AverageRating'), ['%the%']),
+    'artists by genre': (
+        '''SELECT Artist.*, COUNT(Song.Song) AS num_tracks FROM Artist
+            LEFT JOIN Song ON Artist.Artist = Song.Artist
+            WHERE Artist.rowid IN (SELECT ArtistGenre.ArtistID FROM Genre
+                JOIN ArtistGenre ON ArtistGenre.GenreID = Genre.GenreID WHERE Genre.Name = ?)
+            GROUP BY Artist.Artist''', ['pop']),
+}
+
+# Change log entries are kept this many days, for workers that are behind
+KEEP_DAYS = 7
+
+
+'''
+    Measure the database file
+
+    args:
+        conn (sqlite3.Connection): connection to the database
+
+    returns:
+        dict: page size, page count, free pages, WAL size in bytes, and
+            objects: [(name, type, bytes)] largest first, empty if SQLite
+            was built without the dbstat table
+'''
+
+
+def sizes(conn):
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    database = conn.execute('PRAGMA database_list').fetchone()[2]
+    wal = f'{database}-wal'
+    report = {'page_size': page_size,
+              'pages': conn.execute('PRAGMA page_count').fetchone()[0],
+              'free_pages': conn.execute('PRAGMA freelist_count').fetchone()[0],
+              'wal_bytes': os.path.getsize(wal) if os.path.exists(wal) else 0,
+              'objects': []}
+    try:
+        report['objects'] = conn.execute('''SELECT dbstat.name, COALESCE(sqlite_master.type, 'table'),
+            SUM(dbstat.pgsize) FROM dbstat LEFT JOIN sqlite_master ON sqlite_master.name = dbstat.name
+            GROUP BY dbstat.name ORDER BY 3 DESC''').fetchall()
+    except sqlite3.OperationalError:
+        pass
+    return report
+
+
+'''
+    Time the standard searches, reading every row like a search does
+
+    args:
+        conn (sqlite3.Connection): connection to the database,
+        repeat (int): runs of each search; the fastest is kept
+
+    returns:
+        dict: search name -> seconds
+'''
+
+
+def benchmark(conn, repeat=3):
+    timings = {}
+    for name, (query, params) in SEARCHES.items():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in conn.execute(query, params):
+                pass
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+    return timings
+
+
+'''
+    Run one maintenance pass
+
+    args:
+        conn (sqlite3.Connection): read-write connection in autocommit mode
+            (isolation_level=None),
+        analyze (bool): run a full ANALYZE instead of PRAGMA optimize,
+        vacuum_pages (int): free pages to release, 0 for all of them,
+        keep_days (float): days of change log to keep,
+        checkpoint (str): wal_checkpoint mode, PASSIVE to not wait on readers
+
+    returns:
+        list: (step, seconds, result) for each step that ran
+'''
+
+
+def maintain(conn, analyze=False, vacuum_pages=0, keep_days=KEEP_DAYS, checkpoint='TRUNCATE'):
+    steps = []
+
+    def step(name, statement, *params):
+        start = time.perf_counter()
+        result = conn.execute(statement, params).fetchall()
+        steps.append((name, time.perf_counter() - start, result))
+
+    # Without statistics yet, optimize has nothing to refresh
+    has_stats = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()
+    if analyze or not has_stats:
+        step('analyze', 'ANALYZE')
+    else:
+        step('optimize', 'PRAGMA optimize')
+
+    step('prune change log', PRUNE, keep_days)
+
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        # The pragma frees one page per step, and execute() only steps
+        # once when there are no rows; executescript runs it to the end
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        start = time.perf_counter()
+        conn.executescript(f'PRAGMA incremental_vacuum({int(vacuum_pages)})')
+        freed = free - conn.execute('PRAGMA freelist_count').fetchone()[0]
+        steps.append(('incremental vacuum', time.perf_counter() - start, [(f'{freed} pages',)]))
+
+    step('checkpoint', f'PRAGMA wal_checkpoint({checkpoint})')
+    return steps
+
+
+'''
+    Rewrite the database with VACUUM, switching it to incremental
+    auto-vacuum, then re-link everything keyed by rowid. The app must not
+    be running.
+
+    args:
+        conn (sqlite3.Connection): read-write connection in autocommit mode
+
+    returns:
+        float: seconds taken
+'''
+
+
+def full_vacuum(conn):
+    start = time.perf_counter()
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        relink(conn)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return time.perf_counter() - start
+
+
+'''
+    Check the database for corruption
+
+    args:
+        conn (sqlite3.Connection): connection to the database,
+        full (bool): run integrity_check, which also checks that indexes
+            match their tables, instead of quick_check
+
+    returns:
+        list: problems found, empty if the database is sound
+'''
+
+
+def check(conn, full=False):
+    pragma = 'integrity_check' if full else 'quick_check'
+    problems = [row[0] for row in conn.execute(f'PRAGMA {pragma}')]
+    return [] if problems == ['ok'] else problems
+
+
+def print_sizes(label, report):
+    page_size = report['page_size']
+    print(f"{label}: {report['pages'] * page_size / 2 ** 20:.1f} MB in {report['pages']} pages, "
+          f"{report['free_pages']} free ({report['free_pages'] * page_size / 2 ** 20:.1f} MB), "
+          f"WAL {report['wal_bytes'] / 2 ** 20:.1f} MB")
+    for name, kind, size in report['objects']:
+        print(f'  {kind:<6}{name:<32}{size / 1024:>10.0f} KB')
+
+
+'''
+    Run maintenance passes in the background every MAINTENANCE_INTERVAL
+    seconds, if set. Each pass waits for the write lock like /change does,
+    and checkpoints without waiting on readers.
+
+    args:
+        app (Flask): application being created
+
+    returns:
+        threading.Thread or None
+'''
+
+
+def init_maintenance(app):
+    interval = app.config.get('MAINTENANCE_INTERVAL')
+    database = app.config['DATABASE']
+    if not interval or not os.path.exists(database):
+        return None
+
+    keep_days = app.config.get('CHANGE_LOG_KEEP_DAYS', KEEP_DAYS)
+    vacuum_pages = app.config.get('MAINTENANCE_VACUUM_PAGES', 1000)
+    metrics = app.extensions.get('metrics')
+
+    def maintenance_loop():
+        while True:
+            time.sleep(interval)
+            conn = sqlite3.connect(database, timeout=30, isolation_level=None)
+            try:
+                steps = maintain(conn, vacuum_pages=vacuum_pages, keep_days=keep_days,
+                                 checkpoint='PASSIVE')
+            except sqlite3.Error:
+                steps = []
+            finally:
+                conn.close()
+            if metrics is not None:
+                for name, seconds, _ in steps:
+                    metrics.record('maintenance', 'background', name, seconds)
+
+    thread = threading.Thread(target=maintenance_loop, daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('database', nargs='?', default='Music.db')
+    parser.add_argument('--analyze', action='store_true',
+                        help='full ANALYZE instead of PRAGMA optimize')
+    parser.add_argument('--vacuum-pages', type=int, default=0,
+                        help='free pages to release, 0 for all')
+    parser.add_argument('--keep-days', type=float, default=KEEP_DAYS,
+                        help='days of change log to keep')
+    parser.add_argument('--full-vacuum', action='store_true',
+                        help='rewrite the file and switch to incremental auto-vacuum '
+                             '(stop the app first)')
+    parser.add_argument('--integrity', action='store_true',
+                        help='run the full integrity_check instead of quick_check')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each timed search')
+    parser.add_argument('--no-benchmark', action='store_true', help="don't time the searches")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database):
+        parser.error(f'{args.database} not found')
+    conn = sqlite3.connect(args.database, timeout=30, isolation_level=None)
+
+    before = sizes(conn)
+    print_sizes('before', before)
+    timings = {} if args.no_benchmark else benchmark(conn, args.repeat)
+
+    if args.full_vacuum:
+        print(f'full vacuum and re-link: {full_vacuum(conn):.2f} s')
+    elif before['free_pages'] and conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        print('free pages are only released by --full-vacuum until the database is in '
+              'incremental auto-vacuum mode')
+
+    for name, seconds, result in maintain(conn, args.analyze, args.vacuum_pages, args.keep_days):
+        print(f'{name}: {seconds:.3f} s' + (f' {result[0]}' if result else ''))
+    print(f'change log: {conn.execute("SELECT COUNT(*) FROM ChangeLog").fetchone()[0]} entries')
+
+    print_sizes('after', sizes(conn))
+    problems = check(conn, args.integrity)
+    print(f"{'integrity' if args.integrity else 'quick'} check: "
+          + ('ok' if not problems else f'{len(problems)} problem(s)'))
+    for problem in problems[:20]:
+        print(f'  {problem}')
+    if timings:
+        after = benchmark(conn, args.repeat)
+        print(f"{'search':<20}{'before ms':>11}{'after ms':>11}")
+        for name, seconds in timings.items():
+            print(f'{name:<20}{seconds * 1000:>11.1f}{after[name] * 1000:>11.1f}')
+    conn.close()
@@ -0,0 +1,99 @@
+"""In-process counters, served as JSON at /metrics.
+
+Each worker process keeps its own; a scraper adds them up across workers.
+
+With TRACE_MEMORY set, tracemalloc follows every request and its peak
+allocation is observed per endpoint (peak_bytes), logged, and sent back in
+an X-Memory-Peak header. tracemalloc sees the whole process, so for exact
+per-request numbers send one request at a time (e.g. python -m
+website.loadtest --sessions 1). Tracing slows Python down severalfold; it
+is meant for checking that memory stays flat, not for production.
+"""
+from flask import request
+import threading
+import tracemalloc
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.seconds = {}
+        self.observed = {}
+
+    '''
+        Count an event
+
+        args:
+            name (str): what happened, e.g. query_cancelled,
+            route (str): route it happened in,
+            stage (str): part of the route's work it cut short,
+            seconds (float): time spent before it happened
+    '''
+
+    def record(self, name, route, stage, seconds=0.0):
+        key = (name, route, stage)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            self.seconds[key] = self.seconds.get(key, 0.0) + seconds
+
+    '''
+        Add a measurement to a running mean and maximum
+
+        args:
+            name (str): what was measured, e.g. peak_bytes,
+            route (str): route it was measured in,
+            stage (str): part of the route's work it covers,
+            value (float): the measurement
+    '''
+
+    def observe(self, name, route, stage, value):
+        key = (name, route, stage)
+        with self.lock:
+            count, total, peak = self.observed.get(key, (0, 0, value))
+            self.observed[key] = (count + 1, total + value, max(peak, value))
+
+    def snapshot(self):
+        with self.lock:
+            counters = [{'name': name, 'route': route, 'stage': stage,
+                         'count': count, 'seconds': round(self.seconds[(name, route, stage)], 3)}
+                        for (name, route, stage), count in sorted(self.counters.items())]
+            observed = [{'name': name, 'route': route, 'stage': stage,
+                         'count': count, 'mean': total / count, 'max': peak}
+                        for (name, route, stage), (count, total, peak) in sorted(self.observed.items())]
+        return counters + observed
+
+
+def start_trace():
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+
+
+'''
+    Set up the counters when the app starts
+
+    args:
+        app (Flask): application being created
+
+    returns:
+        Metrics
+'''
+
+
+def init_metrics(app):
+    metrics = Metrics()
+    app.extensions['metrics'] = metrics
+
+    if app.config.get('TRACE_MEMORY'):
+        def end_trace(response):
+            _, peak = tracemalloc.get_traced_memory()
+            route = request.endpoint or request.path
+            metrics.observe('peak_bytes', route, request.method, peak)
+            app.logger.info('%s %s: peak allocation %d bytes', request.method, request.path, peak)
+            response.headers['X-Memory-Peak'] = str(peak)
+            return response
+
+        app.before_request(start_trace)
+        app.after_request(end_trace)
+    return metrics
@@ -0,0 +1,83 @@
+"""Streaming search results.
+
+A search's unpaginated query is read from the cursor BATCH_SIZE rows at a
+time and passed through once. That pass counts the matches, keeps only the
+rows of the first and the requested page, and feeds every row to the
+consumers asked for (the chart's running means). Memory then stays flat
+however many songs match, and the page no longer needs a second
+LIMIT/OFFSET query.
+"""
+
+BATCH_SIZE = 500
+PER_PAGE = 30
+
+
+'''
+    Iterate a cursor in fixed-size batches
+
+    args:
+        cur (sqlite3.Cursor): cursor with a query executed,
+        size (int): rows per fetchmany
+
+    yields:
+        row (tuple): each result row
+'''
+
+
+def rows(cur, size=BATCH_SIZE):
+    while True:
+        batch = cur.fetchmany(size)
+        if not batch:
+            return
+        yield from batch
+
+
+class Results:
+    '''
+        The matches of a search: how many there are, and the rows of the
+        first page. Templates use its length for paging and iterate it
+        when everything fits on one page.
+    '''
+
+    def __init__(self, count, first):
+        self.count = count
+        self.first = first
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.first)
+
+    def __getitem__(self, index):
+        return self.first[index]
+
+
+'''
+    Count a search's rows in one pass, keeping only what is shown
+
+    args:
+        rows (iterable): result rows, in display order,
+        page (int): page requested,
+        consumers (list): callables given every row
+
+    returns:
+        results (Results): match count and first page,
+        page_rows (list): rows of the requested page
+'''
+
+
+def collect(rows, page=1, consumers=()):
+    start = max(page - 1, 0) * PER_PAGE
+    count = 0
+    first = []
+    page_rows = []
+    for row in rows:
+        if count < PER_PAGE:
+            first.append(row)
+        if start <= count < start + PER_PAGE:
+            page_rows.append(row)
+        for consume in consumers:
+            consume(row)
+        count += 1
+    return Results(count, first), page_rows
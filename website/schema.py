@@ -0,0 +1,481 @@
+"""Schema migrations for Music.db.
+
+Each migration is a list of SQL statements applied in one transaction.
+PRAGMA user_version records how many have been applied, so init_db can
+call migrate() on every start. Apply them by hand with:
+
+    python -m website.schema [Music.db]
+"""
+import sqlite3
+import sys
+
+'''
+    Build the SQL expression for the release year of a song or album
+
+    args:
+        column (str): ReleaseDate column reference, e.g. "new.ReleaseDate"
+
+    returns:
+        str: SQL expression, NULL unless the date starts with a 4-digit year
+'''
+
+
+def year_of(column):
+    return f'''(CASE WHEN {column} GLOB '[0-9][0-9][0-9][0-9]*'
+        THEN CAST(substr({column}, 1, 4) AS INTEGER) END)'''
+
+
+'''
+    Build the SQL expression reading a numeric column for NumPy
+
+    args:
+        column (str): column reference, e.g. "Energy"
+
+    returns:
+        str: SQL expression, NULL unless the value is stored as a number
+'''
+
+
+def number_of(column):
+    return f"(CASE WHEN typeof({column}) IN ('integer', 'real') THEN {column} END)"
+
+
+'''
+    Build the SQL expression for the release day of a song or album
+
+    args:
+        column (str): ReleaseDate column reference, e.g. "new.ReleaseDate"
+
+    returns:
+        str: SQL expression for YYYYMMDD as an integer, with 00 for a
+            missing month or day; NULL unless the date starts with a year
+'''
+
+
+def day_of(column):
+    return f'''(CASE
+        WHEN {column} GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*'
+            THEN CAST(substr({column}, 1, 4) || substr({column}, 6, 2) || substr({column}, 9, 2) AS INTEGER)
+        WHEN {column} GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]*'
+            THEN CAST(substr({column}, 1, 4) || substr({column}, 6, 2) AS INTEGER) * 100
+        WHEN {column} GLOB '[0-9][0-9][0-9][0-9]*'
+            THEN CAST(substr({column}, 1, 4) AS INTEGER) * 10000 END)'''
+
+
+'''
+    Convert a date typed into a search form to the ReleaseDay encoding
+
+    args:
+        text (str): "YYYY", "YYYY-MM" or "YYYY-MM-DD"
+
+    returns:
+        int or None: YYYYMMDD, None if the text isn't such a date
+'''
+
+
+def parse_day(text):
+    parts = text.strip().split('-')
+    if len(parts) > 3 or len(parts[0]) != 4 or not all(p.isdigit() for p in parts):
+        return None
+    if any(len(p) != 2 for p in parts[1:]):
+        return None
+    parts += ['00'] * (3 - len(parts))
+    return int(''.join(parts))
+
+
+# Features summarized in SongCube, with a row count, sum and sum of squares each
+CUBE_FEATURES = ['Popularity', 'Danceability', 'Energy', 'Loudness', 'Speechiness',
+                 'Acousticness', 'Instrumentalness', 'Liveness', 'Valence', 'TrackDuration']
+
+CUBE_KEYS = ['ReleaseYear', 'Label', 'Artist', 'Explicit']
+
+
+# SongCube keys of a Song row; unknown values become 0 or ''
+def cube_key_values(ref):
+    return [f'COALESCE({year_of(ref + "ReleaseDate")}, 0)', f"COALESCE({ref}Label, '')",
+            f"COALESCE({ref}Artist, '')", f"COALESCE({ref}Explicit = 'true', 0)"]
+
+
+# Per-feature count, sum and sum of squares contributed by a Song row
+def cube_measures(ref):
+    values = []
+    for f in CUBE_FEATURES:
+        values += [f'({ref}{f} IS NOT NULL)', f'COALESCE({ref}{f}, 0)',
+                   f'COALESCE({ref}{f} * {ref}{f}, 0)']
+    return values
+
+
+def cube_measure_columns():
+    columns = []
+    for f in CUBE_FEATURES:
+        columns += [f'{f}N', f'{f}Sum', f'{f}Sq']
+    return columns
+
+
+# Statement adding a Song row (old. or new.) to its SongCube cell
+def cube_add(ref):
+    keys = cube_key_values(ref)
+    measures = cube_measures(ref)
+    updates = ', '.join(f'{c} = {c} + excluded.{c}' for c in ['n'] + cube_measure_columns())
+    return f'''INSERT INTO SongCube ({', '.join(CUBE_KEYS + ['n'] + cube_measure_columns())})
+        VALUES ({', '.join(keys + ['1'] + measures)})
+        ON CONFLICT ({', '.join(CUBE_KEYS)}) DO UPDATE SET {updates};'''
+
+
+# Statements taking a Song row back out of its SongCube cell
+def cube_remove(ref):
+    keys = cube_key_values(ref)
+    match = ' AND '.join(f'{k} = {v}' for k, v in zip(CUBE_KEYS, keys))
+    updates = ', '.join(f'{c} = {c} - {v}'
+                        for c, v in zip(['n'] + cube_measure_columns(), ['1'] + cube_measures(ref)))
+    return f'''UPDATE SongCube SET {updates} WHERE {match};
+        DELETE FROM SongCube WHERE n <= 0 AND {match};'''
+
+
+# Migration creating SongCube, filling it and keeping it current
+def song_cube():
+    columns = ', '.join(f'{c} REAL NOT NULL DEFAULT 0' for c in cube_measure_columns())
+    keys = cube_key_values('')
+    sums = ', '.join(f'SUM({m})' for m in cube_measures(''))
+    return [
+        f'''CREATE TABLE SongCube (
+            ReleaseYear INTEGER NOT NULL, Label TEXT NOT NULL, Artist TEXT NOT NULL,
+            Explicit INTEGER NOT NULL, n INTEGER NOT NULL, {columns},
+            PRIMARY KEY ({', '.join(CUBE_KEYS)}))''',
+        'CREATE INDEX SongCubeYear ON SongCube (ReleaseYear)',
+        'CREATE INDEX SongCubeArtist ON SongCube (Artist)',
+        f'''INSERT INTO SongCube SELECT {', '.join(keys)}, COUNT(*), {sums}
+            FROM Song GROUP BY 1, 2, 3, 4''',
+        f'''CREATE TRIGGER SongCubeInsert AFTER INSERT ON Song BEGIN
+            {cube_add('new.')}
+        END''',
+        f'''CREATE TRIGGER SongCubeDelete AFTER DELETE ON Song BEGIN
+            {cube_remove('old.')}
+        END''',
+        f'''CREATE TRIGGER SongCubeUpdate AFTER UPDATE ON Song BEGIN
+            {cube_remove('old.')}
+            {cube_add('new.')}
+        END''',
+    ]
+
+
+# Longest genre text the triggers can split; Seq holds 1..SEQ_SIZE
+SEQ_SIZE = 4096
+
+
+# Genre name at Seq position i of a comma-separated field, and the condition
+# that i starts a non-empty name. Triggers can't use a recursive CTE, so
+# the comma positions come from joining Seq instead.
+def genre_split(column):
+    text = f"({column} || ',')"
+    token = f"lower(trim(substr({text}, i, instr(substr({text}, i), ',') - 1)))"
+    condition = f'''i <= length({text}) AND (i = 1 OR substr({text}, i - 1, 1) = ',')
+        AND length({token}) > 0'''
+    return token, condition
+
+
+# Normalized genre names in a row's genre field, one per result row
+def genre_names(column):
+    token, condition = genre_split(column)
+    return f'SELECT DISTINCT {token} AS Name FROM Seq WHERE {condition}'
+
+
+# Statements linking a row to the genres in its genre field
+def genre_link(table, column, ref):
+    return f'''INSERT OR IGNORE INTO Genre (Name) {genre_names(ref + column)};
+        INSERT OR IGNORE INTO {table}Genre ({table}ID, GenreID)
+            SELECT {ref}rowid, GenreID FROM Genre WHERE Name IN ({genre_names(ref + column)});'''
+
+
+# Statements linking the existing rows of a table to their genres, the same
+# way the triggers do it
+def genre_backfill(table, column):
+    token, condition = genre_split(f'{table}.{column}')
+    return [
+        f'''INSERT OR IGNORE INTO Genre (Name)
+            SELECT DISTINCT {token} FROM {table}, Seq WHERE {condition}''',
+        f'''INSERT OR IGNORE INTO {table}Genre ({table}ID, GenreID)
+            SELECT {table}.rowid, Genre.GenreID FROM {table}, Seq
+            JOIN Genre ON Genre.Name = {token} WHERE {condition}''',
+    ]
+
+
+# Tables with a genre field, and the field
+GENRE_COLUMNS = (('Artist', 'genre'), ('Album', 'Genres'))
+
+
+# Migration splitting Artist.genre and Album.Genres into Genre and link tables.
+# Links use rowids, so a full VACUUM (which may renumber them) needs a re-link.
+def genre_tables():
+    statements = [
+        'CREATE TABLE Seq (i INTEGER PRIMARY KEY)',
+        f'''INSERT INTO Seq WITH RECURSIVE n(i) AS (
+            SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < {SEQ_SIZE}) SELECT i FROM n''',
+        'CREATE TABLE Genre (GenreID INTEGER PRIMARY KEY, Name TEXT NOT NULL UNIQUE)',
+    ]
+    for table, column in GENRE_COLUMNS:
+        statements += [
+            f'''CREATE TABLE {table}Genre (
+                GenreID INTEGER NOT NULL, {table}ID INTEGER NOT NULL,
+                PRIMARY KEY (GenreID, {table}ID)) WITHOUT ROWID''',
+            f'CREATE INDEX {table}Genre{table} ON {table}Genre ({table}ID)',
+            f'''CREATE TRIGGER {table}GenreInsert AFTER INSERT ON {table} BEGIN
+                {genre_link(table, column, 'new.')}
+            END''',
+            f'''CREATE TRIGGER {table}GenreDelete AFTER DELETE ON {table} BEGIN
+                DELETE FROM {table}Genre WHERE {table}ID = old.rowid;
+            END''',
+            f'''CREATE TRIGGER {table}GenreUpdate AFTER UPDATE OF {column} ON {table} BEGIN
+                DELETE FROM {table}Genre WHERE {table}ID = old.rowid;
+                {genre_link(table, column, 'new.')}
+            END''',
+        ] + genre_backfill(table, column)
+    return statements
+
+
+# Migration adding indexed integer ReleaseYear and ReleaseDay columns
+def release_columns():
+    # SongCube only cares about some columns, and filling the new ones
+    # shouldn't move every song out of its cube cell and back
+    watched = ', '.join(['ReleaseDate', 'Label', 'Artist', 'Explicit'] + CUBE_FEATURES)
+    statements = [
+        'DROP TRIGGER SongCubeUpdate',
+        f'''CREATE TRIGGER SongCubeUpdate AFTER UPDATE OF {watched} ON Song BEGIN
+            {cube_remove('old.')}
+            {cube_add('new.')}
+        END''',
+    ]
+    for table in ('Song', 'Album'):
+        fill = f'''UPDATE {table} SET ReleaseYear = {year_of('ReleaseDate')},
+            ReleaseDay = {day_of('ReleaseDate')}'''
+        statements += [
+            f'ALTER TABLE {table} ADD COLUMN ReleaseYear INTEGER',
+            f'ALTER TABLE {table} ADD COLUMN ReleaseDay INTEGER',
+            fill,
+            f'CREATE INDEX {table}ReleaseYear ON {table} (ReleaseYear)',
+            f'CREATE INDEX {table}ReleaseDay ON {table} (ReleaseDay)',
+            f'''CREATE TRIGGER {table}ReleaseInsert AFTER INSERT ON {table} BEGIN
+                {fill} WHERE rowid = new.rowid;
+            END''',
+            f'''CREATE TRIGGER {table}ReleaseUpdate AFTER UPDATE OF ReleaseDate ON {table} BEGIN
+                {fill} WHERE rowid = new.rowid;
+            END''',
+        ]
+    return statements
+
+
+# Song columns kept as the pre-image of updated and deleted songs, for
+# caches that have to take the old version back out
+PRE_IMAGE = ['ReleaseDate', 'Explicit', 'Artist'] + CUBE_FEATURES
+
+
+# Migration adding the append-only ChangeLog of Song, Album and Artist rows
+def change_log():
+    statements = [
+        '''CREATE TABLE ChangeLog (
+            Version INTEGER PRIMARY KEY AUTOINCREMENT,
+            TableName TEXT NOT NULL, RowKey INTEGER NOT NULL, Op TEXT NOT NULL,
+            Old TEXT, At REAL NOT NULL DEFAULT (julianday('now')))''',
+    ]
+    song_old = 'json_object(' + ', '.join(f"'{c}', old.{c}" for c in PRE_IMAGE) + ')'
+    for table in ('Song', 'Album', 'Artist'):
+        old = song_old if table == 'Song' else 'NULL'
+        # The ReleaseYear/ReleaseDay triggers update the row they were fired
+        # for; that isn't a change of its own. So no update that changes
+        # either derived column is logged, including one that sets them
+        # directly. The caches read the year from ReleaseDate itself, and
+        # the update of ReleaseDate that triggered it was logged.
+        derived = ('WHEN old.ReleaseYear IS new.ReleaseYear AND old.ReleaseDay IS new.ReleaseDay'
+                   if table != 'Artist' else '')
+        statements += [
+            f'''CREATE TRIGGER {table}LogInsert AFTER INSERT ON {table} BEGIN
+                INSERT INTO ChangeLog (TableName, RowKey, Op) VALUES ('{table}', new.rowid, 'I');
+            END''',
+            f'''CREATE TRIGGER {table}LogUpdate AFTER UPDATE ON {table} {derived} BEGIN
+                INSERT INTO ChangeLog (TableName, RowKey, Op, Old)
+                    VALUES ('{table}', old.rowid, 'U', {old});
+            END''',
+            f'''CREATE TRIGGER {table}LogDelete AFTER DELETE ON {table} BEGIN
+                INSERT INTO ChangeLog (TableName, RowKey, Op, Old)
+                    VALUES ('{table}', old.rowid, 'D', {old});
+            END''',
+        ]
+    return statements
+
+
+# Kind of trigram index -> (table, column) it covers
+TRIGRAM_COLUMNS = {'Song': ('Song', 'Song'), 'SongArtist': ('Song', 'Artist'),
+                   'Album': ('Album', 'Album'), 'Artist': ('Artist', 'Artist')}
+
+
+# Trigram at Seq position i of a name, and the condition that i starts one.
+# The name is lowercased (ASCII only, like fuzzy.normalize) and each word
+# padded with two spaces before and one after, so short words and word
+# starts get grams of their own. Names longer than SEQ_SIZE are cut short.
+def trigram_split(column):
+    text = f"('  ' || replace(lower({column}), ' ', '  ') || ' ')"
+    return f'substr({text}, i, 3)', f'i <= length({text}) - 2'
+
+
+# Statements indexing (or unindexing) the names of a row
+def trigram_link(kinds, ref):
+    statements = ''
+    for kind, column in kinds:
+        gram, condition = trigram_split(ref + column)
+        statements += f'''INSERT OR IGNORE INTO Trigram (Kind, Gram, RowKey)
+            SELECT '{kind}', {gram}, {ref}rowid FROM Seq WHERE {condition};'''
+    return statements
+
+
+def trigram_unlink(kinds, ref):
+    statements = ''
+    for kind, column in kinds:
+        gram, condition = trigram_split(ref + column)
+        statements += f'''DELETE FROM Trigram WHERE Kind = '{kind}' AND RowKey = {ref}rowid
+            AND Gram IN (SELECT {gram} FROM Seq WHERE {condition});'''
+    return statements
+
+
+# Statements indexing the existing rows of a table, the same way the
+# triggers do it
+def trigram_backfill(table):
+    statements = []
+    for kind, (t, column) in TRIGRAM_COLUMNS.items():
+        if t == table:
+            gram, condition = trigram_split(f'{table}.{column}')
+            statements.append(f'''INSERT OR IGNORE INTO Trigram (Kind, Gram, RowKey)
+                SELECT '{kind}', {gram}, {table}.rowid FROM {table}, Seq WHERE {condition}''')
+    return statements
+
+
+# Migration adding the Trigram index of names behind fuzzy search. Like the
+# genre links it uses rowids, so a full VACUUM needs a re-index.
+def trigram_index():
+    statements = [
+        '''CREATE TABLE Trigram (
+            Kind TEXT NOT NULL, Gram TEXT NOT NULL, RowKey INTEGER NOT NULL,
+            PRIMARY KEY (Kind, Gram, RowKey)) WITHOUT ROWID''',
+    ]
+    for table in ('Song', 'Album', 'Artist'):
+        kinds = [(kind, column) for kind, (t, column) in TRIGRAM_COLUMNS.items() if t == table]
+        statements += [
+            f'''CREATE TRIGGER {table}TrigramInsert AFTER INSERT ON {table} BEGIN
+                {trigram_link(kinds, 'new.')}
+            END''',
+            f'''CREATE TRIGGER {table}TrigramDelete AFTER DELETE ON {table} BEGIN
+                {trigram_unlink(kinds, 'old.')}
+            END''',
+            f'''CREATE TRIGGER {table}TrigramUpdate
+                AFTER UPDATE OF {', '.join(column for _, column in kinds)} ON {table} BEGIN
+                {trigram_unlink(kinds, 'old.')}
+                {trigram_link(kinds, 'new.')}
+            END''',
+        ] + trigram_backfill(table)
+    return statements
+
+
+# Migration adding the indexes behind sorted searches (see sorting.py). An
+# index on a sort key also holds the rowid tiebreaker, so a search sorted
+# by that key alone reads rows in order from it instead of sorting them.
+# These only hold the key: the rows themselves are still read from Song.
+# The album and artist searches join songs by album and artist name; the
+# two-column indexes do cover those joins, so they never read the song rows.
+def sort_indexes():
+    statements = [f'CREATE INDEX SongSort{column} ON Song ({column})'
+                  for column in ['Popularity', 'Song', 'TrackDuration', 'Danceability', 'Energy',
+                                 'Loudness', 'Speechiness', 'Acousticness', 'Instrumentalness',
+                                 'Liveness', 'Valence']]
+    statements += [
+        'CREATE INDEX SongArtistSong ON Song (Artist, Song)',
+        'CREATE INDEX SongAlbumImage ON Song (Album, AlbumImageURL)',
+        'CREATE INDEX AlbumSortAlbum ON Album (Album)',
+        'CREATE INDEX AlbumSortAverageRating ON Album (AverageRating)',
+        'CREATE INDEX AlbumSortNumberofReviews ON Album (NumberofReviews)',
+        'CREATE INDEX ArtistSortArtist ON Artist (Artist)',
+    ]
+    return statements
+
+
+MIGRATIONS = [
+    # 1: similar-songs links look tracks up by their URI
+    ['CREATE INDEX IF NOT EXISTS SongTrackURI ON Song (TrackURI)'],
+    # 2: count/sum/sum-of-squares cube of the song features
+    song_cube(),
+    # 3: Genre table with artist and album links for indexed genre filters
+    genre_tables(),
+    # 4: integer release year and day columns for indexed date filters
+    release_columns(),
+    # 5: append-only change log with a version per changed row
+    change_log(),
+    # 6: trigram index of song, artist and album names for fuzzy search
+    trigram_index(),
+    # 7: indexes for sorted searches and the album and artist joins
+    sort_indexes(),
+]
+
+
+'''
+    Rebuild everything that refers to Song, Album or Artist rows by rowid.
+    VACUUM may renumber the rowids of those tables (they have no INTEGER
+    PRIMARY KEY), which leaves the genre links and the trigram index
+    pointing at the wrong rows, and the change log describing rows that
+    moved. Run it in the transaction right after a VACUUM.
+
+    args:
+        conn (sqlite3.Connection): read-write connection, in a transaction
+'''
+
+
+def relink(conn):
+    for table, column in GENRE_COLUMNS:
+        conn.execute(f'DELETE FROM {table}Genre')
+        for statement in genre_backfill(table, column):
+            conn.execute(statement)
+    conn.execute('DELETE FROM Trigram')
+    for table in ('Song', 'Album', 'Artist'):
+        for statement in trigram_backfill(table):
+            conn.execute(statement)
+    # Keep the newest entry, so versions carry on from where they were
+    conn.execute('DELETE FROM ChangeLog WHERE Version < (SELECT MAX(Version) FROM ChangeLog)')
+
+
+'''
+    Apply any migrations the database hasn't seen yet
+
+    args:
+        conn (sqlite3.Connection): read-write connection
+
+    returns:
+        int: schema version after migrating
+'''
+
+
+def migrate(conn):
+    isolation = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        while True:
+            # Re-read the version inside the write lock, in case another
+            # worker migrated while this one was waiting
+            conn.execute('BEGIN IMMEDIATE')
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.execute('COMMIT')
+                return version
+            try:
+                for statement in MIGRATIONS[version]:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {version + 1}')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+    finally:
+        conn.isolation_level = isolation
+
+
+if __name__ == '__main__':
+    database = sys.argv[1] if len(sys.argv) > 1 else 'Music.db'
+    conn = sqlite3.connect(database)
+    print(f'{database} is at schema version {migrate(conn)}')
+    conn.close()
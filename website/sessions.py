@@ -0,0 +1,152 @@
+"""Server-side session storage.
+
+Session data lives in a small SQLite table keyed by a random id, and the
+cookie only carries that (signed) id. Values are stored with marshal+zlib,
+which is compact and round-trips the plain dicts/lists the views keep in
+the session.
+"""
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
+from datetime import datetime, timezone
+import marshal
+import secrets
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False, expires=0, blob=None):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.expires = expires
+        self.blob = blob
+        self.modified = False
+
+
+'''
+    Encode session data
+
+    args:
+        data (dict): session contents
+
+    returns:
+        bytes: compressed binary encoding of the session
+'''
+
+
+def encode(data):
+    return zlib.compress(marshal.dumps(data))
+
+
+'''
+    Decode session data
+
+    args:
+        blob (bytes): value previously returned by encode()
+
+    returns:
+        dict: session contents
+'''
+
+
+def decode(blob):
+    return marshal.loads(zlib.decompress(blob))
+
+
+class SqliteSessionInterface(SessionInterface):
+    # Run the expired-row sweep once every this many saves
+    evict_every = 100
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.saves = 0
+        conn = self.connect()
+        conn.execute('''CREATE TABLE IF NOT EXISTS Session (
+            id TEXT PRIMARY KEY, data BLOB NOT NULL,
+            expires INTEGER NOT NULL) WITHOUT ROWID''')
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS SessionExpires ON Session (expires)')
+        conn.commit()
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def signer(self, app):
+        return Signer(app.secret_key, salt='session-id')
+
+    def ttl(self, app):
+        return int(app.permanent_session_lifetime.total_seconds())
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self.signer(app).unsign(cookie).decode('ascii')
+            except BadSignature:
+                sid = None
+            if sid:
+                row = self.connect().execute(
+                    'SELECT data, expires FROM Session WHERE id = ?', (sid,)).fetchone()
+                if row and row[1] > time.time():
+                    return ServerSideSession(decode(row[0]), sid=sid,
+                                             expires=row[1], blob=row[0])
+        return ServerSideSession(sid=secrets.token_urlsafe(24), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        conn = self.connect()
+
+        if not session:
+            if not session.new:
+                conn.execute('DELETE FROM Session WHERE id = ?', (session.sid,))
+                conn.commit()
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        now = int(time.time())
+        ttl = self.ttl(app)
+        blob = encode(dict(session))
+
+        # Skip the write when nothing changed, unless the row is past
+        # half its lifetime and needs its expiry pushed out
+        changed = blob != session.blob
+        stale = session.expires - now < ttl // 2
+        if not changed and not stale:
+            return
+
+        expires = now + ttl
+        if changed:
+            conn.execute('INSERT OR REPLACE INTO Session (id, data, expires) VALUES (?, ?, ?)',
+                         (session.sid, blob, expires))
+        else:
+            conn.execute('UPDATE Session SET expires = ? WHERE id = ?',
+                         (expires, session.sid))
+
+        self.saves += 1
+        if self.saves % self.evict_every == 0:
+            conn.execute('DELETE FROM Session WHERE expires < ?', (now,))
+        conn.commit()
+
+        if session.new or stale:
+            response.set_cookie(name, self.signer(app).sign(session.sid).decode('ascii'),
+                                expires=datetime.fromtimestamp(expires, timezone.utc),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
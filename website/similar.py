@@ -0,0 +1,154 @@
+"""Nearest-neighbour search over song audio features.
+
+Every song is a point in the 8-dimensional space of its audio features,
+z-score normalized so that Loudness (in dB) doesn't drown out the 0-1
+features. The k nearest songs are found by brute force over the whole
+matrix in fixed-size blocks. Each block is one BLAS matrix-vector product
+plus an argpartition, which stays in the low milliseconds at millions of
+songs and needs no rebuild when /change writes a row.
+"""
+from .schema import number_of
+import os
+import sqlite3
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FEATURES = ['Danceability', 'Energy', 'Loudness', 'Speechiness',
+            'Acousticness', 'Instrumentalness', 'Liveness', 'Valence']
+
+# Values not stored as numbers load as NULL, and count as 0 like missing ones
+SELECT = f'SELECT rowid, {", ".join(number_of(c) for c in FEATURES)} FROM Song'
+
+# Rows scored per block
+BLOCK = 1 << 16
+
+
+class SimilarIndex:
+    def __init__(self, rows):
+        data = np.array(rows, dtype=np.float64).reshape(len(rows), len(FEATURES) + 1)
+        features = np.nan_to_num(data[:, 1:])
+        self.lock = threading.Lock()
+        self.rowids = data[:, 0].astype(np.int64)
+        self.mean = features.mean(axis=0) if len(rows) else np.zeros(len(FEATURES))
+        self.scale = features.std(axis=0) if len(rows) else np.ones(len(FEATURES))
+        self.scale[self.scale == 0] = 1
+        self.points = self.normalize(features)
+        self.norms = (self.points ** 2).sum(axis=1)
+        self.live = np.ones(len(rows), dtype=bool)
+        self.index = {int(r): i for i, r in enumerate(self.rowids)}
+
+    @classmethod
+    def from_database(cls, conn):
+        return cls(conn.execute(SELECT).fetchall())
+
+    def normalize(self, features):
+        return ((features - self.mean) / self.scale).astype(np.float32)
+
+    '''
+        Find the songs closest to a given song
+
+        args:
+            rowid (int): Song rowid to start from,
+            k (int): number of neighbours
+
+        returns:
+            list: (rowid, distance) pairs, nearest first; None if the
+                song is not in the index
+    '''
+
+    def nearest(self, rowid, k=10):
+        with self.lock:
+            return self.search(rowid, k)
+
+    def search(self, rowid, k):
+        i = self.index.get(rowid)
+        if i is None or not self.live[i]:
+            return None
+        query = self.points[i]
+        best_ids = []
+        best_dist = []
+
+        for start in range(0, len(self.rowids), BLOCK):
+            stop = start + BLOCK
+            # |x - q|^2 = |x|^2 - 2 x.q + |q|^2; |q|^2 is the same for all rows
+            dist = self.norms[start:stop] - 2 * (self.points[start:stop] @ query)
+            dist[~self.live[start:stop]] = np.inf
+            if start <= i < stop:
+                dist[i - start] = np.inf
+
+            n = min(k, len(dist))
+            top = np.argpartition(dist, n - 1)[:n]
+            best_ids.append(top + start)
+            best_dist.append(dist[top])
+
+        ids = np.concatenate(best_ids)
+        dist = np.concatenate(best_dist) + self.norms[i]
+        order = np.argsort(dist)[:k]
+        return [(int(self.rowids[ids[j]]), float(np.sqrt(max(dist[j], 0))))
+                for j in order if np.isfinite(dist[j])]
+
+    '''
+        Re-read the given Song rows and patch them into the index
+
+        args:
+            conn (sqlite3.Connection): connection to read from,
+            rowids (iterable): rowids that were inserted, updated or deleted
+    '''
+
+    def sync(self, conn, rowids):
+        rowids = list(rowids)
+        if not rowids:
+            return
+        marks = ', '.join('?' * len(rowids))
+        rows = conn.execute(
+            f'{SELECT} WHERE rowid IN ({marks})', rowids).fetchall()
+
+        with self.lock:
+            found = set()
+            for row in rows:
+                found.add(row[0])
+                point = self.normalize(np.nan_to_num(
+                    np.array(row[1:], dtype=np.float64)))
+                i = self.index.get(row[0])
+                if i is None:
+                    i = len(self.rowids)
+                    self.index[row[0]] = i
+                    self.rowids = np.append(self.rowids, row[0])
+                    self.points = np.vstack((self.points, point))
+                    self.norms = np.append(self.norms, 0)
+                    self.live = np.append(self.live, True)
+                self.points[i] = point
+                self.norms[i] = (point ** 2).sum()
+                self.live[i] = True
+
+            for rowid in rowids:
+                if rowid not in found and rowid in self.index:
+                    self.live[self.index[rowid]] = False
+
+
+'''
+    Build the similar-songs index when the app starts
+
+    args:
+        app (Flask): application being created
+
+    returns:
+        SimilarIndex or None
+'''
+
+
+def init_similar(app):
+    database = app.config['DATABASE']
+    if not app.config.get('SIMILAR_SONGS') or np is None or not os.path.exists(database):
+        return None
+    conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    try:
+        index = SimilarIndex.from_database(conn)
+    finally:
+        conn.close()
+    app.extensions['similar'] = index
+    return index
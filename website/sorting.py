@@ -0,0 +1,125 @@
+"""Sort orders for search results.
+
+Each kind of search whitelists the keys its results can be sorted by
+(SORTS): the column behind a key, and the direction it sorts in unless one
+is picked. A saved order is a spec string such as "Popularity" or
+"Popularity:desc,Song:asc", built from the form by sort_spec(). Keys and
+directions are looked up, never pasted into SQL, so an unknown one is
+just dropped.
+
+The table's rowid is always the last key, so rows with equal keys keep the
+same order from one page to the next. It sorts in the direction of the
+key before it: with a single key, SQLite can then walk that key's index
+(schema migration 7) forwards or backwards and return rows in order,
+instead of sorting every match in a temporary b-tree first.
+
+The sort indexes are not covering. The results query selects every
+column, so each row is still looked up in the table, and the results pass
+(pipeline.py) still reads every match to count and facet it. What the
+index saves is the sort.
+"""
+
+# Search -> key -> (SQL column, default direction)
+SORTS = {
+    'songs': {
+        'Popularity': ('Song.Popularity', 'desc'),
+        'ReleaseDate': ('Song.ReleaseDay', 'desc'),
+        'Artist': ('Song.Artist', 'asc'),
+        'Song': ('Song.Song', 'asc'),
+        'Album': ('Song.Album', 'asc'),
+        'TrackDuration': ('Song.TrackDuration', 'desc'),
+        'Danceability': ('Song.Danceability', 'desc'),
+        'Energy': ('Song.Energy', 'desc'),
+        'Loudness': ('Song.Loudness', 'desc'),
+        'Speechiness': ('Song.Speechiness', 'desc'),
+        'Acousticness': ('Song.Acousticness', 'desc'),
+        'Instrumentalness': ('Song.Instrumentalness', 'desc'),
+        'Liveness': ('Song.Liveness', 'desc'),
+        'Valence': ('Song.Valence', 'desc'),
+    },
+    'albums': {
+        'Album': ('Album.Album', 'asc'),
+        'ReleaseDate': ('Album.ReleaseDay', 'desc'),
+        'AverageRating': ('Album.AverageRating', 'desc'),
+        'NumberofReviews': ('Album.NumberofReviews', 'desc'),
+    },
+    'artists': {
+        'Artist': ('Artist.Artist', 'asc'),
+        'genre': ('Artist.genre', 'asc'),
+        'num_tracks': ('num_tracks', 'desc'),
+    },
+}
+
+ROWIDS = {'songs': 'Song.rowid', 'albums': 'Album.rowid', 'artists': 'Artist.rowid'}
+
+# Keys the search forms offer
+MAX_KEYS = 2
+
+DIRECTIONS = ('asc', 'desc')
+
+
+'''
+    Build a sort spec from the order and direction fields of a search form
+
+    args:
+        keys (list): key picked in each order field, '' for none,
+        directions (list): direction picked next to each order field
+
+    returns:
+        str: spec such as "Popularity:desc,Song:asc", '' for no order
+'''
+
+
+def sort_spec(keys, directions=()):
+    directions = list(directions) + [''] * len(keys)
+    parts = []
+    for key, direction in zip(keys, directions):
+        if key:
+            parts.append(f'{key}:{direction}' if direction in DIRECTIONS else key)
+    return ','.join(parts)
+
+
+'''
+    Check a sort spec against the keys a search allows
+
+    args:
+        search (str): songs, albums or artists,
+        spec (str): saved sort spec, or a bare key
+
+    returns:
+        list: (key, direction) pairs, unknown keys left out, each key once
+'''
+
+
+def sort_keys(search, spec):
+    allowed = SORTS[search]
+    keys = []
+    for part in (spec or '').split(','):
+        key, _, direction = part.strip().partition(':')
+        if key not in allowed or any(key == k for k, _ in keys):
+            continue
+        keys.append((key, direction.lower() if direction.lower() in DIRECTIONS
+                     else allowed[key][1]))
+    return keys[:MAX_KEYS]
+
+
+'''
+    Build the ORDER BY clause for a sort spec
+
+    args:
+        search (str): songs, albums or artists,
+        spec (str): saved sort spec, or a bare key
+
+    returns:
+        str: ORDER BY clause ending with the rowid tiebreaker, '' if the
+            spec has no valid key
+'''
+
+
+def order_by(search, spec):
+    keys = sort_keys(search, spec)
+    if not keys:
+        return ''
+    terms = [f'{SORTS[search][key][0]} {direction.upper()}' for key, direction in keys]
+    terms.append(f'{ROWIDS[search]} {keys[-1][1].upper()}')
+    return ' ORDER BY ' + ', '.join(terms)
@@ -0,0 +1,301 @@
+"""Type-ahead suggestions for the search boxes.
+
+Song, artist and album names and genres are kept in sorted lists of
+(key, id) pairs, one per word start, so a prefix lookup is a bisect plus a
+short scan. Results are ranked by popularity. The one- and two-letter
+prefixes match the most entries, so their top results are cached. The
+index is built at startup and patched by /change through sync().
+"""
+from .schema import number_of
+from bisect import bisect_left, insort
+import heapq
+import os
+import sqlite3
+import threading
+
+KINDS = ('song', 'artist', 'album', 'genre')
+
+# Prefixes at most this long get their top results cached
+CACHED_PREFIX = 3
+
+# Most suggestions a single lookup can return
+MAX_SUGGESTIONS = 20
+
+# Popularity as a ranking weight; like schema.number_of, anything not
+# stored as a number (NULL, '', 'high') counts as 0
+POPULARITY = f'IFNULL({number_of("Popularity")}, 0)'
+
+
+'''
+    Split a free-text genre field into normalized genre names
+
+    args:
+        text (str): e.g. "Pop, Rock"
+
+    returns:
+        list: e.g. ['pop', 'rock']
+'''
+
+
+def split_genres(text):
+    if not text:
+        return []
+    return [g.strip().lower() for g in text.split(',') if g.strip()]
+
+
+'''
+    Turn a popularity value into a weight that compares with the others
+
+    args:
+        value: Popularity as stored, or None
+
+    returns:
+        int or float: the value if it is a number, otherwise 0
+'''
+
+
+def weight_of(value):
+    return value if isinstance(value, (int, float)) else 0
+
+
+class PrefixIndex:
+    def __init__(self):
+        self.entries = []
+        self.names = {}
+        self.weights = {}
+        self.idents = {}
+        self.cache = {}
+
+    def keys(self, name):
+        name = name.lower()
+        yield name
+        for i, ch in enumerate(name):
+            if ch == ' ' and i + 1 < len(name) and name[i + 1] != ' ':
+                yield name[i + 1:]
+
+    def add(self, ident, name, weight=0):
+        if ident in self.names:
+            self.remove(ident)
+        if not name:
+            return
+        self.names[ident] = name
+        self.weights[ident] = weight_of(weight)
+        self.idents.setdefault(name, set()).add(ident)
+        for key in self.keys(name):
+            insort(self.entries, (key, ident))
+            self.invalidate(key)
+
+    def extend(self, items):
+        for ident, name, weight in items:
+            if not name:
+                continue
+            self.names[ident] = name
+            self.weights[ident] = weight_of(weight)
+            self.idents.setdefault(name, set()).add(ident)
+            self.entries.extend((key, ident) for key in self.keys(name))
+        self.entries.sort()
+        self.cache.clear()
+
+    def remove(self, ident):
+        name = self.names.pop(ident, None)
+        self.weights.pop(ident, None)
+        if name is None:
+            return
+        self.idents[name].discard(ident)
+        if not self.idents[name]:
+            del self.idents[name]
+        for key in self.keys(name):
+            i = bisect_left(self.entries, (key, ident))
+            if i < len(self.entries) and self.entries[i] == (key, ident):
+                del self.entries[i]
+            self.invalidate(key)
+
+    def bump(self, name, weight):
+        weight = weight_of(weight)
+        for ident in self.idents.get(name, ()):
+            if weight > self.weights[ident]:
+                self.weights[ident] = weight
+                for key in self.keys(name):
+                    self.invalidate(key)
+
+    def invalidate(self, key):
+        for n in range(1, CACHED_PREFIX + 1):
+            self.cache.pop(key[:n], None)
+
+    def rank(self, matches, limit):
+        names = []
+        for ident in heapq.nlargest(limit, matches, key=self.weights.__getitem__):
+            name = self.names[ident]
+            if name not in names:
+                names.append(name)
+        return names
+
+    '''
+        Find the most popular names starting with a prefix
+
+        args:
+            prefix (str): text typed so far,
+            k (int): number of suggestions, at most MAX_SUGGESTIONS
+
+        returns:
+            list: up to k names, most popular first
+    '''
+
+    def search(self, prefix, k):
+        prefix = prefix.lower()
+        cached = self.cache.get(prefix)
+        if cached is not None:
+            return cached[:k]
+
+        lo = bisect_left(self.entries, (prefix,))
+        hi = bisect_left(self.entries, (prefix + '\uffff',), lo)
+        matches = {ident for _, ident in self.entries[lo:hi]}
+
+        # Duplicate names (e.g. covers) can crowd the top results, so look
+        # a bit further first and only rank everything if that wasn't enough
+        names = self.rank(matches, MAX_SUGGESTIONS * 4)
+        if len(names) < MAX_SUGGESTIONS and len(matches) > MAX_SUGGESTIONS * 4:
+            names = self.rank(matches, len(matches))
+        names = names[:MAX_SUGGESTIONS]
+
+        if len(prefix) <= CACHED_PREFIX:
+            self.cache[prefix] = names
+        return names[:k]
+
+
+class SuggestIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.indexes = {kind: PrefixIndex() for kind in KINDS}
+        # (table, rowid) -> genres that row contributed, to undo on change
+        self.genre_sources = {}
+        self.genre_counts = {}
+
+    @classmethod
+    def from_database(cls, conn):
+        index = cls()
+        index.build(conn)
+        return index
+
+    def build(self, conn):
+        self.indexes['song'].extend(
+            conn.execute(f'SELECT rowid, Song, {POPULARITY} FROM Song'))
+
+        artist_pop = dict(conn.execute(
+            f'SELECT Artist, MAX({POPULARITY}) FROM Song GROUP BY Artist'))
+        artists = conn.execute('SELECT rowid, Artist, genre FROM Artist').fetchall()
+        self.indexes['artist'].extend(
+            (rowid, name, artist_pop.get(name)) for rowid, name, _ in artists)
+
+        album_pop = dict(conn.execute(
+            f'SELECT Album, MAX({POPULARITY}) FROM Song GROUP BY Album'))
+        albums = conn.execute('SELECT rowid, Album, Genres FROM Album').fetchall()
+        self.indexes['album'].extend(
+            (rowid, name, album_pop.get(name)) for rowid, name, _ in albums)
+
+        for rowid, _, genre in artists:
+            self.set_genres(('Artist', rowid), genre)
+        for rowid, _, genres in albums:
+            self.set_genres(('Album', rowid), genres)
+
+    def set_genres(self, source, text):
+        genre = self.indexes['genre']
+        for name in self.genre_sources.pop(source, []):
+            self.genre_counts[name] -= 1
+            if self.genre_counts[name]:
+                genre.add(name, name, self.genre_counts[name])
+            else:
+                del self.genre_counts[name]
+                genre.remove(name)
+
+        names = split_genres(text)
+        if names:
+            self.genre_sources[source] = names
+        for name in names:
+            self.genre_counts[name] = self.genre_counts.get(name, 0) + 1
+            genre.add(name, name, self.genre_counts[name])
+
+    '''
+        Look up suggestions for one kind of search box
+
+        args:
+            kind (str): one of KINDS,
+            prefix (str): text typed so far,
+            k (int): number of suggestions, at most MAX_SUGGESTIONS
+
+        returns:
+            list: up to k names, most popular first
+    '''
+
+    def search(self, kind, prefix, k=8):
+        with self.lock:
+            return self.indexes[kind].search(prefix, k)
+
+    '''
+        Re-read changed rows and patch them into the index
+
+        args:
+            conn (sqlite3.Connection): connection to read from,
+            touched (dict): table name -> set of rowids written by /change
+    '''
+
+    def sync(self, conn, touched):
+        with self.lock:
+            for rowid in touched.get('Song', ()):
+                row = conn.execute(
+                    f'SELECT Song, {POPULARITY}, Artist, Album FROM Song WHERE rowid = ?',
+                    (rowid,)).fetchone()
+                if row is None:
+                    self.indexes['song'].remove(rowid)
+                    continue
+                self.indexes['song'].add(rowid, row[0], row[1])
+
+                # Keep artist and album rankings roughly in step
+                self.indexes['artist'].bump(row[2], row[1])
+                self.indexes['album'].bump(row[3], row[1])
+
+            for rowid in touched.get('Artist', ()):
+                row = conn.execute(
+                    'SELECT Artist, genre FROM Artist WHERE rowid = ?', (rowid,)).fetchone()
+                if row is None:
+                    self.indexes['artist'].remove(rowid)
+                    self.set_genres(('Artist', rowid), None)
+                    continue
+                self.indexes['artist'].add(
+                    rowid, row[0], self.indexes['artist'].weights.get(rowid))
+                self.set_genres(('Artist', rowid), row[1])
+
+            for rowid in touched.get('Album', ()):
+                row = conn.execute(
+                    'SELECT Album, Genres FROM Album WHERE rowid = ?', (rowid,)).fetchone()
+                if row is None:
+                    self.indexes['album'].remove(rowid)
+                    self.set_genres(('Album', rowid), None)
+                    continue
+                self.indexes['album'].add(
+                    rowid, row[0], self.indexes['album'].weights.get(rowid))
+                self.set_genres(('Album', rowid), row[1])
+
+
+'''
+    Build the suggestion index when the app starts
+
+    args:
+        app (Flask): application being created
+
+    returns:
+        SuggestIndex or None
+'''
+
+
+def init_suggest(app):
+    database = app.config['DATABASE']
+    if not app.config.get('SUGGEST_INDEX') or not os.path.exists(database):
+        return None
+    conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    try:
+        index = SuggestIndex.from_database(conn)
+    finally:
+        conn.close()
+    app.extensions['suggest'] = index
+    return index
@@ -1,136 +1,320 @@
-from flask import Blueprint, render_template, request, flash, session, url_for, redirect
+from flask import Blueprint, render_template, request, flash, session, url_for, redirect, current_app, jsonify
+from .admission import FULL, REDUCED
+from .chartdata import FeatureMeans, bar_data, histogram_data, pie_data, trend_data
+from .columnar import ColumnarSnapshot
+from .db import connect_read, start_deadline
+from .facets import FACETS, FacetCounts, facet_filters
+from .fuzzy import fuzzy_filter, fuzzy_rank
+from .histograms import SONG_CATEGORIES, ALBUM_CATEGORIES, SongHistograms, find_edges, query_counts
+from .pipeline import collect, rows
+from .schema import CUBE_FEATURES, parse_day, year_of
+from .similar import SimilarIndex
+from .sorting import order_by, sort_keys, sort_spec
+from .suggest import SuggestIndex
+from contextlib import nullcontext
+import math
 import sqlite3
-from io import BytesIO
-from matplotlib.figure import Figure
-from matplotlib.patches import Circle
-import base64
 
 views = Blueprint('views', __name__)
 
-DATABASE = 'Music.db'
+# Song search group-by options and the SongCube column behind each
+GROUPS = {
+    'year': 'ReleaseYear',
+    'label': 'Label',
+    'artist': 'Artist',
+    'explicit': 'Explicit'
+}
+
+# Shown when a search's deadline runs out before its results, or before
+# the extras asked for with them
+REFINE = "Error: Your search took too long. Please refine your search and try again."
+PARTIAL = "Your search took too long to finish; some results were left out. Refine your search to see them."
+
+# Statistics the stats forms offer
+STATS = ('AVG', 'MIN', 'MAX', 'median', 'STDDEV')
+
+# Features plotted by the bar and trends charts, in chartdata.FEATURES order
+TREND_FEATURES = ['Popularity', 'Danceability', 'Energy', 'Loudness', 'Speechiness',
+                  'Acousticness', 'Instrumentalness', 'Liveness', 'Valence']
+
 
 '''
-    Create pie chart
+    Turn chart series into what the templates show: the series itself,
+    drawn as SVG in the browser, or a PNG when CHART_RENDERER is 'png'
 
-    args: 
-        stats(list) a list of tuples containing artist data
+    args:
+        data (dict): series from chartdata.py, or '' for no chart
 
-    returns: 
-        str: url for pie chart image
+    returns:
+        dict or str: series, or url for chart image
+'''
+
+
+def render_chart(data):
+    if data and current_app.config.get('CHART_RENDERER', 'svg') == 'png':
+        from .charts import render_png
+        return render_png(data)
+    return data
+
+
+'''
+    Get the columnar snapshot if it can answer a song search
+
+    args:
+        song (str): user search query for song,
+        artist (str): user search query for artist,
+        date1 (str): user search query for starting year,
+        date2 (str): user search query for ending year,
+        facets (dict): facet values picked to drill down
+
+    returns:
+        ColumnarSnapshot or None: None when the search needs SQLite
+'''
+
+
+def song_snapshot(song, artist, date1, date2, facets=None):
+    # Text and facet filters still have to go through SQLite
+    if song or artist or facets:
+        return None
+    if (date1 and not date1.isdigit()) or (date2 and not date2.isdigit()):
+        return None
+    return current_app.extensions.get('columnar')
+
+
+# In-memory caches kept in sync with the catalog: extension name -> the
+# class that builds it from a connection, and whether its sync() takes the
+# whole touched dict or only the Song rows
+CACHES = {
+    'columnar': (ColumnarSnapshot.from_database, False),
+    'suggest': (SuggestIndex.from_database, True),
+    'similar': (SimilarIndex.from_database, False),
+    'histograms': (SongHistograms, False),
+}
+
+
+'''
+    Refresh in-memory copies of the catalog after writes. A cache whose
+    sync fails is rebuilt from the database, or dropped (searches then
+    use SQLite) if that fails too, so the other caches are still synced
+    and the change feed can move past the change.
+
+    args:
+        conn (sqlite3.Connection): connection that sees the writes,
+        touched (dict): table name -> {rowid: row before the first write,
+            None if inserted}, as read from the change log
 '''
 
 
-def make_pie(stats):
-    data = {}
+def sync_caches(conn, touched):
+    for name, (build, everything) in CACHES.items():
+        cache = current_app.extensions.get(name)
+        if cache is None:
+            continue
+        try:
+            cache.sync(conn, touched if everything else touched['Song'])
+        except Exception:
+            current_app.logger.exception('Syncing the %s cache failed, rebuilding it', name)
+            try:
+                current_app.extensions[name] = build(conn)
+            except Exception:
+                current_app.logger.exception('Rebuilding the %s cache failed, dropping it', name)
+                current_app.extensions.pop(name, None)
+
+
+'''
+    Build the conditions for a release date range
+
+    args:
+        table (str): Song or Album,
+        date1 (str): user search query for starting date,
+        date2 (str): user search query for ending date
+
+    returns:
+        conditions (list): SQL conditions,
+        params (list): parameters for the conditions
+'''
 
-    # Add data to dict
-    for row in stats:
-        if row[4] not in data:
-            data[row[4]] = 1
+
+def date_filters(table, date1, date2):
+    conditions = []
+    params = []
+
+    # A bare year covers all of that year, like the old text comparison did;
+    # a fuller date goes by day. Both are range scans on an index.
+    for value, year_op, day_op in ((date1, '>=', '>'), (date2, '<', '<')):
+        if not value:
+            continue
+        day = parse_day(value)
+        if day is None:
+            conditions.append(f'{table}.ReleaseDate {day_op} ?')
+            params.append(value)
+        elif day % 10000 == 0:
+            conditions.append(f'{table}.ReleaseYear {year_op} ?')
+            params.append(day // 10000)
         else:
-            data[row[4]] += 1
+            conditions.append(f'{table}.ReleaseDay {day_op} ?')
+            params.append(day)
 
-    # Convert small percentage categories to category 'other'
-    other_genres = []
-    other_ct = 0
-    for key, value in data.items():
-        if value/len(stats) < 0.02:
-            other_genres.append(key)
-            other_ct += value
+    return conditions, params
 
-    for key in other_genres:
-        data.pop(key)
 
-    if other_genres:
-        label = "Other: " + ', '.join(other_genres)
-    else:
-        label = "Other"
+'''
+    Build the WHERE clause for a song search
 
-    data[label] = other_ct
-    data = {k: v for k, v in sorted(data.items(), key=lambda item: item[1])}
+    args:
+        song (str): user search query for song,
+        artist (str): user search query for artist,
+        date1 (str): user search query for starting year,
+        date2 (str): user search query for ending year,
+        explicit (bool): user selection of explicit or not,
+        facets (dict): facet values picked to drill down,
+        fuzzy (bool): match song and artist names despite typos
 
-    labels = data.keys()
-    sizes = [x/len(stats) for x in data.values()]
+    returns:
+        where (str): SQL condition,
+        params (list): parameters for the condition
+'''
 
-    fig = Figure()
 
-    ax = fig.add_subplot(1, 1, 1)
+def song_filters(song, artist, date1, date2, explicit, facets=None, fuzzy=False):
+    conditions = []
+    params = []
 
-    # Create the pie chart
-    wedges, text, autotexts = ax.pie(
-        sizes, labels=labels, autopct='%1.1f%%', startangle=90)
-    centre_circle = Circle((0, 0), 0.70, fc='white')
-    ax.add_artist(centre_circle)
-    ax.axis('equal')
+    # Add Conditions based on user input
+    for kind, column, text in (('Song', 'Song', song), ('SongArtist', 'Artist', artist)):
+        if text and fuzzy:
+            condition, text_params = fuzzy_filter(kind, 'Song.rowid', text)
+            conditions.append(condition)
+            params += text_params
+        elif text:
+            conditions.append(f'{column} LIKE ?')
+            params.append(f'%{text}%')
+    date_conditions, date_params = date_filters('Song', date1, date2)
+    conditions += date_conditions
+    params += date_params
+    if not explicit:
+        conditions.append("Explicit = 'false'")
+    facet_conditions, facet_params = facet_filters(facets)
+    conditions += facet_conditions
+    params += facet_params
+
+    return " AND ".join(conditions) or "1", params
 
-    # Save the pie chart image to buffer
-    buf = BytesIO()
-    fig.savefig(buf, format='png')
-    data = base64.b64encode(buf.getbuffer()).decode('ascii')
-    url = f'data:image/png;base64,{data}'
 
-    return url
+'''
+    Build the WHERE clause for an album search
 
+    args:
+        title (str): user search query for album title,
+        date1 (str): user search query for starting year,
+        date2 (str): user search query for ending year,
+        fuzzy (bool): match album titles despite typos
 
+    returns:
+        where (str): SQL condition,
+        params (list): parameters for the condition
 '''
-    Create bar chart
 
-    args: 
-        stats (list): a list of tuples containing song data
 
-    returns: 
-        str: url for bar chart image
+def album_filters(title, date1, date2, fuzzy=False):
+    conditions = []
+    params = []
+
+    # Add Conditions based on user input
+    if title and fuzzy:
+        condition, title_params = fuzzy_filter('Album', 'Album.rowid', title)
+        conditions.append(condition)
+        params += title_params
+    elif title:
+        conditions.append('Album.Album LIKE ?')
+        params.append(f'%{title}%')
+    date_conditions, date_params = date_filters('Album', date1, date2)
+    conditions += date_conditions
+    params += date_params
+
+    return " AND ".join(conditions) or "1", params
+
+
+'''
+    Build the WHERE clause for an artist search
+
+    args:
+        search (str): user search query for artist,
+        genre (str): user search query for genre,
+        fuzzy (bool): match artist names despite typos
+
+    returns:
+        where (str): SQL condition,
+        params (list): parameters for the condition
 '''
 
 
-def make_chart(stats):
-    # Create dict to store data
-    categories = {
-        'popularity': [],
-        'danceability': [],
-        'energy': [],
-        'loudness': [],
-        'speechiness': [],
-        'acousticness': [],
-        'instrumentalness': [],
-        'liveness': [],
-        'valence': []
-    }
+def artist_filters(search, genre, fuzzy=False):
+    conditions = []
+    params = []
 
-    # Add data to dict
-    for row in stats:
-        categories['popularity'].append(row[9])
-        categories['danceability'].append(row[10])
-        categories['energy'].append(row[11])
-        categories['loudness'].append(row[12])
-        categories['speechiness'].append(row[13])
-        categories['acousticness'].append(row[14])
-        categories['instrumentalness'].append(row[15])
-        categories['liveness'].append(row[16])
-        categories['valence'].append(row[17])
+    # Add Conditions based on user input
+    if search and fuzzy:
+        condition, search_params = fuzzy_filter('Artist', 'Artist.rowid', search)
+        conditions.append(condition)
+        params += search_params
+    elif search:
+        conditions.append('Artist.Artist LIKE ?')
+        params.append(f'%{search}%')
+    if genre:
+        # Matches part of a genre name, like the old LIKE over Artist.genre;
+        # only the small Genre table is scanned, the links are read by index
+        conditions.append('''Artist.rowid IN (SELECT ArtistGenre.ArtistID FROM Genre
+            JOIN ArtistGenre ON ArtistGenre.GenreID = Genre.GenreID WHERE Genre.Name LIKE ?)''')
+        params.append(f'%{genre.strip()}%')
 
-    values = [(sum(x)/len(x)) for x in categories.values()]
-    colors = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728',
-              '#9467bd', '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22']
+    return " AND ".join(conditions) or "1", params
 
-    fig = Figure()
-    ax = fig.add_axes([0.1, 0.25, 0.8, 0.6])
 
-    # Create the bar chart
-    ax.bar(categories.keys(), values, color=colors, width=0.4)
+'''
+    Compute several statistics of a search together
 
-    ax.set_xlabel('Statistic')
-    ax.set_ylabel('Rating')
-    ax.set_title('Statistics for your search!')
-    ax.set_xticklabels(categories.keys(), rotation=90)
+    args:
+        cur (sqlite3.Cursor): cursor to query with,
+        table (str): Song or Album,
+        where (str): SQL condition for the search,
+        params (list): parameters for the condition,
+        pairs (list): (stat, category) pairs, stat one of STATS
 
-    # Save the bar chart image to buffer
-    buf = BytesIO()
-    fig.savefig(buf, format='png')
-    data = base64.b64encode(buf.getbuffer()).decode('ascii')
-    url = f'data:image/png;base64,{data}'
+    returns:
+        list: (stat, category, value) for each valid pair, in order
+'''
 
-    return url
+
+def batch_stats(cur, table, where, params, pairs):
+    allowed = SONG_CATEGORIES if table == 'Song' else ALBUM_CATEGORIES
+    pairs = [(s, c) for s, c in pairs if s in STATS and c in allowed]
+    categories = list(dict.fromkeys(c for _, c in pairs))
+    if not categories:
+        return []
+
+    # One scan gives count, mean, min, max and mean square of every category
+    selects = ', '.join(f'COUNT({c}), AVG({c}), MIN({c}), MAX({c}), AVG({c} * {c})'
+                        for c in categories)
+    row = cur.execute(f'SELECT {selects} FROM {table} WHERE {where}', params).fetchone()
+
+    values = {}
+    for i, category in enumerate(categories):
+        n, mean, low, high, square = row[5 * i:5 * i + 5]
+        values[('AVG', category)] = mean
+        values[('MIN', category)] = low
+        values[('MAX', category)] = high
+        values[('STDDEV', category)] = math.sqrt(max(square - mean * mean, 0)) if n else None
+
+        # The median needs the values in order, so it costs a query of its own
+        if ('median', category) in pairs and n:
+            values[('median', category)] = cur.execute(
+                f'''SELECT AVG({category}) FROM (SELECT {category} FROM {table}
+                WHERE ({where}) AND {category} IS NOT NULL
+                ORDER BY {category} LIMIT ? OFFSET ?)''',
+                list(params) + [2 - n % 2, (n - 1) // 2]).fetchone()[0]
+
+    return [(s, c, values.get((s, c))) for s, c in pairs]
 
 
 '''
@@ -144,27 +328,39 @@ def make_chart(stats):
         explicit (bool): user selection of explicit or not,
         stat (str): stat to calculate for advanced statistics,
         category (str): category for advanced statistics,
-        chart (bool): user selection to show chart or not
+        chart (bool): user selection to show chart or not,
+        pairs (list): (stat, category) pairs for the statistics table,
+        facets (dict): facet values picked to drill down,
+        fuzzy (bool): match song and artist names despite typos, best matches
+            first unless an order is given
     
     returns: 
-        results (list): list of tuples containing song data,
+        results (Results): number of matching songs, and the first page of them,
         page_results (list): list of tuples containing song data to display on current page,
         stat_result (float): result of advanced statistics calculation,
         page (int): current page to display,
-        song_chart_url (str): link to song chart image
+        song_chart_url (dict or str): bar chart of the feature means,
+        stat_table (list): (stat, category, value) for each pair,
+        facet_counts (dict): facet -> most common (value, count) pairs
 '''
 
 
-def get_song_data(song, artist, order, date1, date2, explicit, stat, category, chart):
+def get_song_data(song, artist, order, date1, date2, explicit, stat, category, chart, pairs=(),
+                  facets=None, fuzzy=False):
 
-    # Establish connection to db
-    conn = sqlite3.connect('Music.db')
+    # Establish read-only connection to db
+    conn = connect_read()
+    deadline = start_deadline(conn, 'songs')
     cur = conn.cursor()
 
     query1 = ""
 
+    snapshot = song_snapshot(song, artist, date1, date2, facets)
+    if snapshot is not None:
+        mask = snapshot.mask(date1, date2, explicit)
+
     # Create base query for advanced statistics
-    if stat and category:
+    if stat and category and snapshot is None:
         g = ""
         if stat == 'STDDEV':
             query1 = f"""SELECT SQRT( SUM(({category} - mean_value) * ({
@@ -181,87 +377,103 @@ def get_song_data(song, artist, order, date1, date2, explicit, stat, category, c
                 ({category}) AS col FROM Song WHERE """
 
     # Create base query for results
-    query = "SELECT * FROM Song WHERE "
-    conditions = []
-
-    # Add Conditions based on user input
-    if song:
-        conditions.append(f'''Song LIKE "%{song}%"''')
-    if artist:
-        conditions.append(f'''Artist LIKE "%{artist}%"''')
-    if date1:
-        conditions.append(f'''ReleaseDate > {date1}''')
-    if date2:
-        conditions.append(f'''ReleaseDate < {date2}''')
-    if not explicit:
-        conditions.append(f'''Explicit = "false"''')
-
-    # Join conditions
-    if conditions:
-        query += " AND ".join(conditions)
-        if query1:
-            query1 += " AND ".join(conditions)
-    else:
-        query += "1"
-        if query1:
-            query1 += "1"
+    where, params = song_filters(song, artist, date1, date2, explicit, facets, fuzzy)
+    query = "SELECT * FROM Song WHERE " + where
+    if query1:
+        query1 += where
 
     # Specify order based on user input
-    if order:
-        query += f''' ORDER BY "{order}" DESC'''
-
-    # Execute queries and receive results
+    query_params = list(params)
+    sort = order_by('songs', order)
+    if sort:
+        query += sort
+    elif fuzzy and (song or artist):
+        ranks = []
+        for kind, column, text in (('Song', 'Song', song), ('SongArtist', 'Artist', artist)):
+            if text:
+                rank, rank_params = fuzzy_rank(kind, 'Song.rowid', f'Song.{column}', text)
+                ranks.append(rank)
+                query_params += rank_params
+        query += f" ORDER BY {' + '.join(ranks)} DESC, Song.rowid"
+
+    # Stream the results once, keeping only the rows shown; the facet
+    # counts and the chart's means are taken along the way
+    page = request.args.get('page', default=1, type=int)
+    facet_counts = FacetCounts()
+    means = FeatureMeans() if chart and snapshot is None else None
+    consumers = [facet_counts.add] + ([means.add] if means else [])
     try:
-        cur.execute(query)
-        results = cur.fetchall()
-    except Exception:
-        flash("Error: Something went wrong.", category="error")
-        return "", "", "", ""
+        cur.execute(query, query_params)
+        results, page_results = collect(rows(cur), page, consumers)
+    except Exception as e:
+        if deadline.cancelled(e, 'results'):
+            flash(REFINE, category="error")
+        else:
+            flash("Error: Something went wrong.", category="error")
+        return "", "", "", "", "", [], {}
 
     # Determine current page to display
     if len(results) > 30:
-        page = request.args.get('page', default=1, type=int)
         session['song_page'] = page
-        per_page = 30
-        offset = (page - 1) * per_page
-        query2 = query + f" LIMIT {per_page} OFFSET {offset}"
     else:
         page = 1
         session['song_page'] = 1
-        query2 = ""
+        page_results = ""
 
-    if category and stat == 'median':
+    if category and stat == 'median' and query1:
         query1 += f""") SELECT AVG({
             category}) AS median FROM OrderedData WHERE RowAsc IN (RowDesc, RowDesc + 1, RowDesc - 1)"""
 
     stat_result = ""
-    page_results = ""
+    partial = False
     if query1:
         try:
-            cur.execute(query1)
+            cur.execute(query1, params)
             stat_result = cur.fetchone()
-        except Exception:
-            flash("Error: Something went wrong.", category="error")
-            return "", "", "", ""
+        except Exception as e:
+            if not deadline.cancelled(e, 'stat'):
+                flash("Error: Something went wrong.", category="error")
+                return "", "", "", "", "", [], {}
+            partial = True
+
+    if stat and category and snapshot is not None:
+        value = snapshot.aggregate(stat, category, mask)
+        if value is None:
+            stat_result = ""
+        elif stat == 'MIN' or stat == 'MAX':
+            cur.execute("SELECT * FROM Song WHERE rowid = ?", (value,))
+            stat_result = cur.fetchone()
+        else:
+            stat_result = (value,)
 
-    if query2:
+    stat_table = []
+    if pairs and snapshot is not None:
+        stat_table = [(s, c, snapshot.statistic(s, c, mask)) for s, c in pairs
+                      if s in STATS and c in mask.view.columns]
+    elif pairs:
         try:
-            cur.execute(query2)
-            page_results = cur.fetchall()
-        except Exception:
-            flash("Error: Something went wrong.", category="error")
-            return "", "", "", ""
+            stat_table = batch_stats(cur, 'Song', where, params, pairs)
+        except Exception as e:
+            if deadline.cancelled(e, 'stat_table'):
+                partial = True
+            else:
+                flash("Error: Something went wrong.", category="error")
+
+    if partial:
+        flash(PARTIAL, category="info")
 
     # Close connection
     cur.close()
     conn.close()
 
-    if chart:
-        song_chart_url = make_chart(results)
+    if chart and snapshot is not None:
+        song_chart_url = render_chart(bar_data(snapshot.means(mask)))
+    elif chart and results:
+        song_chart_url = render_chart(bar_data(means.values()))
     else:
         song_chart_url = ''
 
-    return results, page_results, stat_result, page, song_chart_url
+    return results, page_results, stat_result, page, song_chart_url, stat_table, facet_counts.top()
 
 
 '''
@@ -269,24 +481,29 @@ def get_song_data(song, artist, order, date1, date2, explicit, stat, category, c
 
     args: 
         title (str): user search query for album title,
-        order (str): order for results,
+        order (str): sort spec for results (see sorting.py),
         date1 (int): user search query for starting year,
         date2 (int): user search query for ending year,
         stat (str): stat to calculate for advanced statistics,
-        category (str): category for advanced statistics
+        category (str): category for advanced statistics,
+        pairs (list): (stat, category) pairs for the statistics table,
+        fuzzy (bool): match album titles despite typos, best matches first
+            unless an order is given
     
     returns: 
-        results (list): list of tuples containing album data,
+        results (Results): number of matching albums, and the first page of them,
         page_results (list): list of tuples containing album data to display on current page,
         stat_result (float): result of advanced statistics calculation,
-        page (int): current page to display
+        page (int): current page to display,
+        stat_table (list): (stat, category, value) for each pair
 '''
 
 
-def get_album_data(title, order, date1, date2, stat, category):
+def get_album_data(title, order, date1, date2, stat, category, pairs=(), fuzzy=False):
 
-    # Establish connection to db
-    conn = sqlite3.connect('Music.db')
+    # Establish read-only connection to db
+    conn = connect_read()
+    deadline = start_deadline(conn, 'albums')
     cur = conn.cursor()
 
     query1 = ""
@@ -310,78 +527,366 @@ def get_album_data(title, order, date1, date2, stat, category):
             query1 = f"SELECT {stat}({category}) AS col FROM Album WHERE "
 
     # Create base query for results
-    query = '''SELECT DISTINCT Album.*, Song.AlbumImageURL 
+    where, params = album_filters(title, date1, date2, fuzzy)
+    query = '''SELECT DISTINCT Album.Ranking, Album.Album, Album.Artist, Album.ReleaseDate,
+            Album.Genres, Album.AverageRating, Album.NumberofReviews, Song.AlbumImageURL 
             FROM Album LEFT JOIN Song ON 
-            Album.Album = Song.Album WHERE '''
-    conditions = []
-
-    # Add Conditions based on user input
-    if title:
-        conditions.append(f'''Album.Album LIKE "%{title}%"''')
-    if date1:
-        conditions.append(f'''Album.ReleaseDate > {date1}''')
-    if date2:
-        conditions.append(f'''Album.ReleaseDate < {date2}''')
-
-    # Join conditions
-    if conditions:
-        query += " AND ".join(conditions)
-        if query1:
-            query1 += " AND ".join(conditions)
-    else:
-        query += "1"
-        if query1:
-            query1 += "1"
+            Album.Album = Song.Album WHERE ''' + where
+    if query1:
+        query1 += where
     if category and stat == 'median':
         query1 += f""") SELECT AVG({
             category}) AS median FROM OrderedData WHERE RowAsc IN (RowDesc, RowDesc + 1, RowDesc - 1)"""
 
     # Order results based on user input
-    if order:
-        query += f''' ORDER BY "Album.{order}" DESC'''
-
-    # Execute queries and receive results
+    query_params = list(params)
+    sort = order_by('albums', order)
+    if sort:
+        query += sort
+    elif fuzzy and title:
+        rank, rank_params = fuzzy_rank('Album', 'Album.rowid', 'Album.Album', title)
+        query += f' ORDER BY {rank} DESC, Album.rowid'
+        query_params += rank_params
+
+    # Stream the results once, keeping only the rows shown
+    page = request.args.get('page', default=1, type=int)
     try:
-        cur.execute(query)
-        results = cur.fetchall()
+        cur.execute(query, query_params)
+        results, page_results = collect(rows(cur), page)
     except Exception as e:
-        flash("Error: Something went wrong.", category="error")
-        return "", "", "", ""
+        if deadline.cancelled(e, 'results'):
+            flash(REFINE, category="error")
+        else:
+            flash("Error: Something went wrong.", category="error")
+        return "", "", "", "", []
 
     # Determine results for current page
     if len(results) > 30:
-        page = request.args.get('page', default=1, type=int)
         session['album_page'] = page
-        per_page = 30
-        offset = (page - 1) * per_page
-        query2 = query + f" LIMIT {per_page} OFFSET {offset}"
     else:
         page = 1
         session['album_page'] = 1
-        query2 = ""
+        page_results = ""
 
     stat_result = ""
-    page_results = ""
+    partial = False
     if query1:
         try:
-            cur.execute(query1)
+            cur.execute(query1, params)
             stat_result = cur.fetchone()
-        except Exception:
-            flash("Error: Something went wrong", category="error")
-            return "", "", "", ""
-    if query2:
+        except Exception as e:
+            if not deadline.cancelled(e, 'stat'):
+                flash("Error: Something went wrong", category="error")
+                return "", "", "", "", []
+            partial = True
+
+    stat_table = []
+    if pairs:
         try:
-            cur.execute(query2)
-            page_results = cur.fetchall()
-        except Exception:
-            flash("Error: Something went wrong", category="error")
-            return "", "", "", ""
+            stat_table = batch_stats(cur, 'Album', where, params, pairs)
+        except Exception as e:
+            if deadline.cancelled(e, 'stat_table'):
+                partial = True
+            else:
+                flash("Error: Something went wrong.", category="error")
+
+    if partial:
+        flash(PARTIAL, category="info")
 
     # Close connection to db
     cur.close()
     conn.close()
 
-    return results, page_results, stat_result, page
+    return results, page_results, stat_result, page, stat_table
+
+
+'''
+    Build the WHERE clause for a song search answered from SongCube
+
+    args:
+        artist (str): user search query for artist,
+        date1 (str): starting year, digits only,
+        date2 (str): ending year, digits only,
+        explicit (bool): user selection of explicit or not,
+        facets (dict): facet values picked to drill down,
+        fuzzy (bool): match artist names despite typos
+
+    returns:
+        where (str): SQL condition,
+        params (list): parameters for the condition
+'''
+
+
+def cube_filters(artist, date1, date2, explicit, facets=None, fuzzy=False):
+    conditions = []
+    params = []
+
+    if artist and fuzzy:
+        # The cube keeps artist names, so go through the songs' index
+        condition, artist_params = fuzzy_filter('SongArtist', 'Song.rowid', artist)
+        conditions.append(f'Artist IN (SELECT Artist FROM Song WHERE {condition})')
+        params += artist_params
+    elif artist:
+        conditions.append('Artist LIKE ?')
+        params.append(f'%{artist}%')
+    # Undated songs sit in year 0 and only count without a date filter
+    if date1 or date2:
+        conditions.append('ReleaseYear > 0')
+    if date1:
+        conditions.append('ReleaseYear >= ?')
+        params.append(int(date1))
+    if date2:
+        conditions.append('ReleaseYear < ?')
+        params.append(int(date2))
+    if not explicit:
+        conditions.append('Explicit = 0')
+    facet_conditions, facet_params = facet_filters(facets, cube=True)
+    conditions += facet_conditions
+    params += facet_params
+
+    return " AND ".join(conditions) or "1", params
+
+
+'''
+    Get per-group aggregates of a song category for a search
+
+    args:
+        group_by (str): one of GROUPS,
+        song (str): user search query for song,
+        artist (str): user search query for artist,
+        date1 (str): user search query for starting year,
+        date2 (str): user search query for ending year,
+        explicit (bool): user selection of explicit or not,
+        category (str): category to aggregate,
+        facets (dict): facet values picked to drill down,
+        fuzzy (bool): match song and artist names despite typos
+
+    returns:
+        list: (group, count, mean, standard deviation) tuples
+'''
+
+
+def get_song_groups(group_by, song, artist, date1, date2, explicit, category, facets=None,
+                    fuzzy=False):
+    if group_by not in GROUPS or category not in CUBE_FEATURES:
+        return []
+
+    column = GROUPS[group_by]
+    dates_ok = (not date1 or date1.isdigit()) and (not date2 or date2.isdigit())
+
+    if song or not dates_ok:
+        # A title filter needs the songs themselves
+        where, params = song_filters(song, artist, date1, date2, explicit, facets, fuzzy)
+        key = {'ReleaseYear': year_of('ReleaseDate'),
+               'Explicit': "Explicit = 'true'"}.get(column, column)
+        query = f'''SELECT {key} AS grp, COUNT({category}), AVG({category}),
+            AVG({category} * {category}) FROM Song WHERE {where} GROUP BY grp'''
+    else:
+        # Everything else comes from the pre-aggregated SongCube
+        where, params = cube_filters(artist, date1, date2, explicit, facets, fuzzy)
+        query = f'''SELECT {column} AS grp, SUM({category}N),
+            SUM({category}Sum) / SUM({category}N), SUM({category}Sq) / SUM({category}N)
+            FROM SongCube WHERE {where} GROUP BY grp'''
+
+    # Years read best in order; labels and artists by size
+    if column in ('ReleaseYear', 'Explicit'):
+        query += ' ORDER BY grp'
+    else:
+        query += ' ORDER BY 2 DESC'
+    query += ' LIMIT 100'
+
+    conn = connect_read()
+    try:
+        rows = conn.execute(query, params).fetchall()
+    except Exception:
+        flash("Error: Something went wrong.", category="error")
+        rows = []
+    conn.close()
+
+    groups = []
+    for group, count, mean, square in rows:
+        if not count:
+            continue
+        if column == 'Explicit':
+            group = 'true' if group else 'false'
+        spread = math.sqrt(max(square - mean * mean, 0))
+        groups.append((group, int(count), mean, spread))
+    return groups
+
+
+'''
+    Get the yearly trend of every chart feature for a search
+
+    args:
+        song (str): user search query for song,
+        artist (str): user search query for artist,
+        date1 (str): user search query for starting year,
+        date2 (str): user search query for ending year,
+        explicit (bool): user selection of explicit or not,
+        facets (dict): facet values picked to drill down,
+        fuzzy (bool): match song and artist names despite typos
+
+    returns:
+        dict: trend chart series, '' if no song has a release year
+'''
+
+
+def get_song_trends(song, artist, date1, date2, explicit, facets=None, fuzzy=False):
+    means = ', '.join(f'SUM({f}Sum) / SUM({f}N)' for f in TREND_FEATURES)
+    dates_ok = (not date1 or date1.isdigit()) and (not date2 or date2.isdigit())
+
+    if song or not dates_ok:
+        # A title filter needs the songs themselves
+        where, params = song_filters(song, artist, date1, date2, explicit, facets, fuzzy)
+        averages = ', '.join(f'AVG({f})' for f in TREND_FEATURES)
+        query = f'''SELECT {year_of('ReleaseDate')} AS year, COUNT(*), {averages}
+            FROM Song WHERE {where} AND year IS NOT NULL GROUP BY year ORDER BY year'''
+    else:
+        # One SongCube row per year, label, artist and explicit flag
+        where, params = cube_filters(artist, date1, date2, explicit, facets, fuzzy)
+        query = f'''SELECT ReleaseYear, SUM(n), {means} FROM SongCube
+            WHERE {where} AND ReleaseYear > 0 GROUP BY ReleaseYear ORDER BY ReleaseYear'''
+
+    conn = connect_read()
+    try:
+        rows = conn.execute(query, params).fetchall()
+    except Exception:
+        flash("Error: Something went wrong.", category="error")
+        rows = []
+    conn.close()
+
+    if not rows:
+        return ''
+
+    years = [row[0] for row in rows]
+    counts = [row[1] for row in rows]
+    trends = [[row[2 + i] for row in rows] for i in range(len(TREND_FEATURES))]
+
+    return trend_data(years, counts, trends)
+
+
+'''
+    Get the distribution of a song category for a search
+
+    args:
+        song (str): user search query for song,
+        artist (str): user search query for artist,
+        date1 (str): user search query for starting year,
+        date2 (str): user search query for ending year,
+        explicit (bool): user selection of explicit or not,
+        category (str): category to bin,
+        facets (dict): facet values picked to drill down,
+        fuzzy (bool): match song and artist names despite typos
+
+    returns:
+        dict: histogram series, '' for a category that can't be binned
+'''
+
+
+def get_song_histogram(song, artist, date1, date2, explicit, category, facets=None, fuzzy=False):
+    if category not in SONG_CATEGORIES:
+        return ''
+
+    conn = connect_read()
+    histograms = current_app.extensions.get('histograms')
+
+    # Use the precomputed counts when the filters allow it
+    counts = None
+    if histograms is not None:
+        edges = histograms.edges[category]
+        if not facets and not fuzzy:
+            counts = histograms.lookup(
+                conn, category, song, artist, date1, date2, explicit)
+    else:
+        edges = find_edges(conn, 'Song', [category])[category]
+
+    if counts is None:
+        where, params = song_filters(song, artist, date1, date2, explicit, facets, fuzzy)
+        counts = query_counts(conn, 'Song', category, edges, where, params)
+
+    conn.close()
+
+    return histogram_data(category, edges, counts)
+
+
+'''
+    Get the distribution of an album category for a search
+
+    args:
+        title (str): user search query for album title,
+        date1 (str): user search query for starting year,
+        date2 (str): user search query for ending year,
+        category (str): category to bin,
+        fuzzy (bool): match album titles despite typos
+
+    returns:
+        dict: histogram series, '' for a category that can't be binned
+'''
+
+
+def get_album_histogram(title, date1, date2, category, fuzzy=False):
+    if category not in ALBUM_CATEGORIES:
+        return ''
+
+    conn = connect_read()
+    edges = find_edges(conn, 'Album', [category])[category]
+    where, params = album_filters(title, date1, date2, fuzzy)
+    counts = query_counts(conn, 'Album', category, edges, where, params)
+    conn.close()
+
+    return histogram_data(category, edges, counts)
+
+
+'''
+    Count the genres of the artists matching a search
+
+    args:
+        cur (sqlite3.Cursor): cursor to query with,
+        where (str): artist_filters condition,
+        params (list): parameters for the condition
+
+    returns:
+        dict: number of matching artists in each genre
+'''
+
+
+def get_genre_counts(cur, where, params):
+    cur.execute(f'''SELECT Genre.Name, COUNT(*) FROM Artist
+        JOIN ArtistGenre ON ArtistGenre.ArtistID = Artist.rowid
+        JOIN Genre ON Genre.GenreID = ArtistGenre.GenreID
+        WHERE {where} GROUP BY Genre.Name''', params)
+    return dict(cur.fetchall())
+
+
+'''
+    Get the mean of every chart feature for a song search
+
+    args:
+        song (str): user search query for song,
+        artist (str): user search query for artist,
+        date1 (str): user search query for starting year,
+        date2 (str): user search query for ending year,
+        explicit (bool): user selection of explicit or not,
+        facets (dict): facet values picked to drill down,
+        fuzzy (bool): match song and artist names despite typos
+
+    returns:
+        list: mean of each feature, None if no song matches
+'''
+
+
+def get_song_means(song, artist, date1, date2, explicit, facets=None, fuzzy=False):
+    snapshot = song_snapshot(song, artist, date1, date2, facets)
+    if snapshot is not None:
+        mask = snapshot.mask(date1, date2, explicit)
+        return snapshot.means(mask) if mask.any() else None
+
+    where, params = song_filters(song, artist, date1, date2, explicit, facets, fuzzy)
+    averages = ', '.join(f'AVG({f})' for f in TREND_FEATURES)
+    conn = connect_read()
+    row = conn.execute(f'SELECT COUNT(*), {averages} FROM Song WHERE {where}', params).fetchone()
+    conn.close()
+    return list(row[1:]) if row[0] else None
 
 
 '''
@@ -389,87 +894,303 @@ def get_album_data(title, order, date1, date2, stat, category):
 
     args: 
         search (str): user search query for artist name,
-        order (str): order to display results,
+        order (str): sort spec for results (see sorting.py),
         genre (str): user search query for genre,
-        pie (bool): user selection whether to generate pie chart or not
+        pie (bool): user selection whether to generate pie chart or not,
+        fuzzy (bool): match artist names despite typos, best matches first
+            unless an order is given
     
     returns: 
-        results (list): list of tuples containing song data,
+        results (Results): number of matching artists, and the first page of them,
         page_results (list): list of tuples containing song data to display on current page,
         page (int): current page to display,
-        pie_url (str): link to pie chart image
+        pie_url (dict or str): genre pie chart
 '''
 
 
-def get_artist_data(search, order, genre, pie):
+def get_artist_data(search, order, genre, pie, fuzzy=False):
 
-    # Establish connection to db
-    conn = sqlite3.connect('Music.db')
+    # Establish read-only connection to db
+    conn = connect_read()
+    deadline = start_deadline(conn, 'artists')
     cur = conn.cursor()
 
     # Base Query
     query = '''SELECT Artist.*, COUNT(Song.Song) AS 
         num_tracks FROM Artist LEFT JOIN Song ON 
         Artist.Artist=Song.Artist WHERE '''
-    conditions = []
-
-    # Add Conditions based on user input
-    if search:
-        conditions.append(f'''Artist.Artist LIKE "%{search}%"''')
-    if genre:
-        conditions.append(f'''Artist.genre LIKE "%{genre}%"''')
-
-    # Join conditions
-    if conditions:
-        query += " AND ".join(conditions)
-    else:
-        query += "1"
+    where, params = artist_filters(search, genre, fuzzy)
+    query += where
 
     query += " GROUP BY Artist.Artist"
 
     # Order results based on user input
-    if order:
-        query += f''' ORDER BY "{order}" DESC'''
-
-    # Execute queries and receive results
+    query_params = list(params)
+    sort = order_by('artists', order)
+    if sort:
+        query += sort
+    elif fuzzy and search:
+        rank, rank_params = fuzzy_rank('Artist', 'Artist.rowid', 'Artist.Artist', search)
+        query += f' ORDER BY {rank} DESC, Artist.rowid'
+        query_params += rank_params
+
+    # Stream the results once, keeping only the rows shown
+    page = request.args.get('page', default=1, type=int)
     try:
-        cur.execute(query)
-        results = cur.fetchall()
-    except Exception:
-        flash("Error: Something went wrong.", category="error")
+        cur.execute(query, query_params)
+        results, page_results = collect(rows(cur), page)
+    except Exception as e:
+        if deadline.cancelled(e, 'results'):
+            flash(REFINE, category="error")
+        else:
+            flash("Error: Something went wrong.", category="error")
         return "", "", "", ""
 
     # Determine results to show on current page
     if len(results) > 30:
-        page = request.args.get('page', default=1, type=int)
         session['artist_page'] = page
-        per_page = 30
-        offset = (page - 1) * per_page
-        query2 = query + f" LIMIT {per_page} OFFSET {offset}"
     else:
         page = 1
         session['artist_page'] = 1
-        query2 = ""
+        page_results = ""
 
-    page_results = ""
-    if query2:
+    # Count each genre of the matching artists
+    pie_url = ''
+    if pie:
         try:
-            cur.execute(query2)
-            page_results = cur.fetchall()
-        except Exception:
-            flash("Error: Something went wrong.", category="error")
-            return "", "", "", ""
+            genre_counts = get_genre_counts(cur, where, params)
+        except Exception as e:
+            if deadline.cancelled(e, 'pie'):
+                flash(PARTIAL, category="info")
+            else:
+                flash("Error: Something went wrong.", category="error")
+            genre_counts = {}
+        if genre_counts:
+            pie_url = render_chart(pie_data(genre_counts))
 
     # Close connection to db
     cur.close()
     conn.close()
 
-    if pie:
-        pie_url = make_pie(results)
+    return results, page_results, page, pie_url
+
+
+'''
+    Estimate the cost of a search and wait for admission control to let it run
+
+    args:
+        table (str): Song or Album,
+        where (str): SQL condition of the search,
+        params (list): parameters for the condition,
+        stat (str): single statistic asked for, if any,
+        chart (bool): whether a chart is drawn from the results,
+        pairs (list): (stat, category) pairs for the statistics table
+
+    returns:
+        context manager yielding FULL, REDUCED or None (turned away)
+'''
+
+
+def admit_search(table, where, params, stat=None, chart=False, pairs=()):
+    admission = current_app.extensions.get('admission')
+    if admission is None:
+        return nullcontext(FULL)
+
+    conn = connect_read()
+    try:
+        visited, matched = admission.estimate(conn, table, where, params)
+        cost = admission.cost(visited, matched, stat, chart, pairs)
+    except Exception:
+        # Let the search itself report what is wrong with it
+        cost = 0
+    conn.close()
+    return admission.admit(cost)
+
+
+'''
+    Approximate the median of a song category from the histogram counts
+
+    args:
+        category (str): column to summarize,
+        song (str): user search query for song,
+        artist (str): user search query for artist,
+        date1 (str): user search query for starting year,
+        date2 (str): user search query for ending year,
+        explicit (bool): user selection of explicit or not,
+        facets (dict): facet values picked to drill down,
+        fuzzy (bool): match song and artist names despite typos
+
+    returns:
+        float or None: None if the histograms can't answer the search
+'''
+
+
+def approximate_median(category, song, artist, date1, date2, explicit, facets=None, fuzzy=False):
+    histograms = current_app.extensions.get('histograms')
+    if histograms is None or category not in histograms.edges or facets or fuzzy:
+        return None
+
+    conn = connect_read()
+    counts = histograms.lookup(conn, category, song, artist, date1, date2, explicit)
+    conn.close()
+    if not counts or not sum(counts):
+        return None
+
+    # Interpolate within the bin holding the middle value
+    low, width = histograms.edges[category]
+    half = sum(counts) / 2
+    seen = 0
+    for i, n in enumerate(counts):
+        if n and seen + n >= half:
+            return low + width * (i + (half - seen) / n)
+        seen += n
+    return None
+
+
+'''
+    Run a song search, under admission control
+
+    args:
+        data (dict): saved search, as stored in the session
+
+    returns:
+        dict: arguments for songs.html
+'''
+
+
+def song_search(data):
+    song = data['song']
+    artist = data['artist']
+    order = data['order']
+    date1 = data['date1']
+    date2 = data['date2']
+    explicit = data['explicit']
+    stat = data['stat']
+    category = data['category']
+    chart = data['chart']
+    hist = data.get('hist')
+    group = data.get('group')
+    trend = data.get('trend')
+    table_stats = data.get('table_stats') or []
+    table_categories = data.get('table_categories') or []
+    pairs = [(s, c) for s in table_stats for c in table_categories]
+    facets = data.get('facets') or {}
+    fuzzy = data.get('fuzzy')
+
+    args = dict(results=[], search=song, chart=chart, artist=artist, order=order,
+                sorts=sort_keys('songs', order),
+                date1=date1, date2=date2, explicit=explicit, stat=stat, category=category,
+                page_results=[], stat_result='', page=1, song_chart_url='', hist=hist,
+                hist_url='', group=group, groups=[], trend=trend, trend_url='',
+                table_stats=table_stats, table_categories=table_categories, stat_table=[],
+                facets=facets, facet_counts={}, fuzzy=fuzzy)
+
+    # Stats and charts from the columnar snapshot cost next to nothing
+    where, params = song_filters(song, artist, date1, date2, explicit, facets, fuzzy)
+    if song_snapshot(song, artist, date1, date2, facets) is not None:
+        admit = admit_search('Song', where, params)
     else:
-        pie_url = ''
+        admit = admit_search('Song', where, params, stat if category else None, chart, pairs)
+
+    with admit as level:
+        if level is None:
+            flash("Error: The server is busy. Please refine your search or try again.",
+                  category="error")
+            return args
+
+        # Reduced searches skip the chart and estimate medians instead of sorting
+        run_stat, run_chart, run_pairs = stat, chart, pairs
+        if level == REDUCED:
+            flash("The server is busy, so the chart was skipped and medians are approximate.",
+                  category="info")
+            run_chart = None
+            run_pairs = [(s, c) for s, c in pairs if s != 'median']
+            if stat == 'median':
+                run_stat = None
+
+        (args['results'], args['page_results'], args['stat_result'], args['page'],
+         args['song_chart_url'], args['stat_table'], args['facet_counts']) = get_song_data(
+            song, artist, order, date1, date2, explicit, run_stat, category, run_chart, run_pairs,
+            facets, fuzzy)
+
+        if level == REDUCED:
+            if stat == 'median' and category:
+                value = approximate_median(category, song, artist, date1, date2, explicit, facets,
+                                           fuzzy)
+                args['stat_result'] = (value,) if value is not None else ''
+            computed = {(s, c): v for s, c, v in args['stat_table']}
+            args['stat_table'] = [
+                (s, c, computed.get((s, c)) if s != 'median' else
+                 approximate_median(c, song, artist, date1, date2, explicit, facets, fuzzy))
+                for s, c in pairs if s in STATS and c in SONG_CATEGORIES]
+
+        if hist:
+            args['hist_url'] = render_chart(
+                get_song_histogram(song, artist, date1, date2, explicit, category, facets, fuzzy))
+        if group:
+            args['groups'] = get_song_groups(group, song, artist, date1, date2, explicit, category,
+                                             facets, fuzzy)
+        if trend:
+            args['trend_url'] = render_chart(
+                get_song_trends(song, artist, date1, date2, explicit, facets, fuzzy))
+
+    return args
 
-    return results, page_results, page, pie_url
+
+'''
+    Run an album search, under admission control
+
+    args:
+        data (dict): saved search, as stored in the session
+
+    returns:
+        dict: arguments for albums.html
+'''
+
+
+def album_search(data):
+    title = data['title']
+    order = data['order']
+    date1 = data['date1']
+    date2 = data['date2']
+    stat = data['stat']
+    category = data['category']
+    hist = data.get('hist')
+    table_stats = data.get('table_stats') or []
+    table_categories = data.get('table_categories') or []
+    pairs = [(s, c) for s in table_stats for c in table_categories]
+    fuzzy = data.get('fuzzy')
+
+    args = dict(results=[], search=title, order=order, sorts=sort_keys('albums', order),
+                date1=date1, date2=date2,
+                page_results=[], stat_result='', stat=stat, category=category, page=1,
+                hist=hist, hist_url='', table_stats=table_stats,
+                table_categories=table_categories, stat_table=[], fuzzy=fuzzy)
+
+    where, params = album_filters(title, date1, date2, fuzzy)
+    with admit_search('Album', where, params, stat if category else None, False, pairs) as level:
+        if level is None:
+            flash("Error: The server is busy. Please refine your search or try again.",
+                  category="error")
+            return args
+
+        # Albums have no precomputed distribution, so a reduced search
+        # leaves medians out
+        run_stat, run_pairs = stat, pairs
+        if level == REDUCED:
+            flash("The server is busy, so medians were left out.", category="info")
+            run_pairs = [(s, c) for s, c in pairs if s != 'median']
+            if stat == 'median':
+                run_stat = None
+
+        (args['results'], args['page_results'], args['stat_result'], args['page'],
+         args['stat_table']) = get_album_data(title, order, date1, date2, run_stat, category, run_pairs,
+                                              fuzzy)
+
+        if hist:
+            args['hist_url'] = render_chart(get_album_histogram(title, date1, date2, category, fuzzy))
+
+    return args
 
 
 @views.route('/')
@@ -480,61 +1201,47 @@ def home():
 @views.route('/songs', methods=['GET', 'POST'])
 def songs():
     if request.method == 'POST':
-
-        session.clear()
-        search = request.form.get('song')
-        artist = request.form.get('artist')
-        order = request.form.get('order')
-        date1 = request.form.get('date1')
-        date2 = request.form.get('date2')
-        explicit = request.form.get('explicit')
-        stat = request.form.get('stat')
-        category = request.form.get('category')
-        chart = request.form.get('chart')
-
         session['song_search_data'] = {
-            'song': search,
-            'artist': artist,
-            'order': order,
-            'date1': date1,
-            'date2': date2,
-            'explicit': explicit,
-            'stat': stat,
-            'category': category,
-            'chart': chart
+            'song': request.form.get('song'),
+            'artist': request.form.get('artist'),
+            'order': sort_spec(request.form.getlist('order'), request.form.getlist('direction')),
+            'date1': request.form.get('date1'),
+            'date2': request.form.get('date2'),
+            'explicit': request.form.get('explicit'),
+            'stat': request.form.get('stat'),
+            'category': request.form.get('category'),
+            'chart': request.form.get('chart'),
+            'hist': request.form.get('hist'),
+            'group': request.form.get('group'),
+            'trend': request.form.get('trend'),
+            'table_stats': request.form.getlist('table_stat'),
+            'table_categories': request.form.getlist('table_category'),
+            'fuzzy': request.form.get('fuzzy')
         }
 
-        results, page_results, stat_result, page, song_chart_url = get_song_data(
-            search, artist, order, date1, date2, explicit, stat, category, chart)
+        search = song_search(session['song_search_data'])
 
-        count = len(results)
+        count = len(search['results'])
         flash(f'''Retrieved {
               count} result(s) matching your search.''', category="success")
 
-        return render_template('songs.html', results=results, search=search, chart=chart,
-                               artist=artist, order=order, date1=date1, date2=date2, explicit=explicit,
-                               stat=stat, category=category, page_results=page_results,
-                               stat_result=stat_result, page=page, song_chart_url=song_chart_url)
+        return render_template('songs.html', **search)
     else:
         search_data = session.get('song_search_data')
         if search_data:
-            song = session['song_search_data']['song']
-            artist = session['song_search_data']['artist']
-            order = session['song_search_data']['order']
-            date1 = session['song_search_data']['date1']
-            date2 = session['song_search_data']['date2']
-            explicit = session['song_search_data']['explicit']
-            stat = session['song_search_data']['stat']
-            category = session['song_search_data']['category']
-            chart = session['song_search_data']['chart']
-
-            results, page_results, stat_result, page, song_chart_url, = get_song_data(
-                song, artist, order, date1, date2, explicit, stat, category, chart)
-
-            return render_template('songs.html', results=results, search=song, chart=chart,
-                                   artist=artist, order=order, date1=date1, date2=date2, explicit=explicit,
-                                   stat=stat, category=category, page_results=page_results,
-                                   stat_result=stat_result, page=page, song_chart_url=song_chart_url)
+            # Drill down by a facet value, or drop one (no value)
+            facet = request.args.get('facet')
+            if facet in FACETS:
+                facets = dict(search_data.get('facets') or {})
+                value = request.args.get('value')
+                if value is None:
+                    facets.pop(facet, None)
+                else:
+                    facets[facet] = value
+                search_data = dict(search_data, facets=facets)
+                session['song_search_data'] = search_data
+
+            return render_template('songs.html', **song_search(search_data))
 
         return render_template('songs.html')
 
@@ -542,49 +1249,30 @@ def songs():
 @views.route('/albums', methods=['GET', 'POST'])
 def albums():
     if request.method == 'POST':
-        search = request.form.get('album')
-        order = request.form.get('order')
-        date1 = request.form.get('date1')
-        date2 = request.form.get('date2')
-
-        stat = request.form.get('stat')
-        category = request.form.get('category')
-
         session['album_search_data'] = {
-            'title': search,
-            'order': order,
-            'date1': date1,
-            'date2': date2,
-            'stat': stat,
-            'category': category
+            'title': request.form.get('album'),
+            'order': sort_spec(request.form.getlist('order'), request.form.getlist('direction')),
+            'date1': request.form.get('date1'),
+            'date2': request.form.get('date2'),
+            'stat': request.form.get('stat'),
+            'category': request.form.get('category'),
+            'hist': request.form.get('hist'),
+            'table_stats': request.form.getlist('table_stat'),
+            'table_categories': request.form.getlist('table_category'),
+            'fuzzy': request.form.get('fuzzy')
         }
 
-        results, page_results, stat_result, page = get_album_data(
-            search, order, date1, date2, stat, category)
+        search = album_search(session['album_search_data'])
 
-        count = len(results)
+        count = len(search['results'])
         flash(f'''Retrieved {
               count} result(s) matching your search.''', category="success")
 
-        return render_template('albums.html', results=results, search=search, order=order,
-                               date1=date1, date2=date2, page_results=page_results,
-                               stat_result=stat_result, stat=stat, category=category, page=page)
+        return render_template('albums.html', **search)
     else:
         search_data = session.get('album_search_data')
         if search_data:
-            title = session['album_search_data']['title']
-            order = session['album_search_data']['order']
-            date1 = session['album_search_data']['date1']
-            date2 = session['album_search_data']['date2']
-            stat = session['album_search_data']['stat']
-            category = session['album_search_data']['category']
-
-            results, page_results, stat_result, page = get_album_data(
-                title, order, date1, date2, stat, category)
-
-            return render_template('albums.html', results=results, search=title, order=order,
-                                   date1=date1, date2=date2, page_results=page_results,
-                                   stat_result=stat_result, stat=stat, category=category, page=page)
+            return render_template('albums.html', **album_search(search_data))
 
         return render_template('albums.html')
 
@@ -593,26 +1281,30 @@ def albums():
 def artists():
     if request.method == 'POST':
         search = request.form.get('artist')
-        order = request.form.get('order')
+        order = sort_spec(request.form.getlist('order'), request.form.getlist('direction'))
         genre = request.form.get('genre')
         pie = request.form.get('pie')
+        fuzzy = request.form.get('fuzzy')
 
         session['artist_search_data'] = {
             'name': search,
             'order': order,
             'genre': genre,
-            'pie': pie
+            'pie': pie,
+            'fuzzy': fuzzy
         }
 
         results, page_results, page, pie_url = get_artist_data(
-            search, order, genre, pie)
+            search, order, genre, pie, fuzzy)
 
         count = len(results)
         flash(f'''Retrieved {
               count} result(s) matching your search.''', category="success")
 
-        return render_template('artists.html', results=results, search=search, order=order, pie=pie,
-                               genre=genre, page_results=page_results, page=page, pie_url=pie_url)
+        return render_template('artists.html', results=results, search=search, order=order,
+                               sorts=sort_keys('artists', order), pie=pie,
+                               genre=genre, page_results=page_results, page=page, pie_url=pie_url,
+                               fuzzy=fuzzy)
     else:
         search_data = session.get('artist_search_data')
         if search_data:
@@ -620,16 +1312,138 @@ def artists():
             order = session['artist_search_data']['order']
             genre = session['artist_search_data']['genre']
             pie = session['artist_search_data']['pie']
+            fuzzy = session['artist_search_data'].get('fuzzy')
 
             results, page_results, page, pie_url = get_artist_data(
-                name, order, genre, pie)
+                name, order, genre, pie, fuzzy)
 
-            return render_template('artists.html', results=results, search=name, order=order, pie=pie,
-                                   genre=genre, page_results=page_results, page=page, pie_url=pie_url)
+            return render_template('artists.html', results=results, search=name, order=order,
+                                   sorts=sort_keys('artists', order), pie=pie,
+                                   genre=genre, page_results=page_results, page=page, pie_url=pie_url,
+                                   fuzzy=fuzzy)
 
     return render_template('artists.html')
 
 
+@views.route('/songs/similar')
+def similar():
+    track = request.args.get('track')
+    k = min(request.args.get('k', default=10, type=int), 100)
+
+    index = current_app.extensions.get('similar')
+    if index is None:
+        flash("Error: Similar songs are not available.", category="error")
+        return redirect(url_for('views.songs'))
+
+    conn = connect_read()
+    cur = conn.cursor()
+
+    cur.execute("SELECT rowid, * FROM Song WHERE TrackURI = ?", (track,))
+    seed = cur.fetchone()
+    neighbours = index.nearest(seed[0], k) if seed else None
+    if not neighbours:
+        cur.close()
+        conn.close()
+        flash("Error: Song not found.", category="error")
+        return redirect(url_for('views.songs'))
+
+    rowids = [rowid for rowid, _ in neighbours]
+    marks = ', '.join('?' * len(rowids))
+    cur.execute(f"SELECT rowid, * FROM Song WHERE rowid IN ({marks})", rowids)
+    rows = {row[0]: row[1:] for row in cur.fetchall()}
+
+    cur.close()
+    conn.close()
+
+    results = [(rows[rowid], distance)
+               for rowid, distance in neighbours if rowid in rows]
+
+    return render_template('similar.html', seed=seed[1:], results=results)
+
+
+'''
+    Suggest names for what has been typed in a search box
+
+    args:
+        kind (str): song, artist, album or genre,
+        prefix (str): text typed so far,
+        k (int): number of suggestions
+
+    returns:
+        list: names, most popular first
+'''
+
+
+def get_suggestions(kind, prefix, k):
+    index = current_app.extensions.get('suggest')
+    prefix = prefix.strip()
+    if index is None or kind not in index.indexes or not prefix:
+        return []
+    return index.search(kind, prefix, k)
+
+
+@views.route('/api/suggest')
+def suggest():
+    return jsonify(get_suggestions(request.args.get('type', 'song'), request.args.get('q', ''),
+                                   request.args.get('k', default=8, type=int)))
+
+
+'''
+    Get the series behind a chart of the saved search, without its results
+
+    args:
+        chart (str): songs, songs-histogram, songs-trend, albums-histogram
+            or artists-genres
+
+    returns:
+        dict or str: chart data, '' if there is no such chart for the
+            saved search
+'''
+
+
+def get_chart_series(chart):
+    songs = session.get('song_search_data') or {}
+    song_args = [songs.get(k) for k in ('song', 'artist', 'date1', 'date2', 'explicit')]
+    song_facets = songs.get('facets')
+    song_fuzzy = songs.get('fuzzy')
+    albums = session.get('album_search_data') or {}
+    artists = session.get('artist_search_data') or {}
+
+    data = ''
+    if chart == 'songs' and songs:
+        means = get_song_means(*song_args, song_facets, song_fuzzy)
+        data = bar_data(means) if means else ''
+    elif chart == 'songs-histogram' and songs:
+        data = get_song_histogram(*song_args, songs.get('category'), song_facets, song_fuzzy)
+    elif chart == 'songs-trend' and songs:
+        data = get_song_trends(*song_args, song_facets, song_fuzzy)
+    elif chart == 'albums-histogram' and albums:
+        data = get_album_histogram(albums.get('title'), albums.get('date1'),
+                                   albums.get('date2'), albums.get('category'), albums.get('fuzzy'))
+    elif chart == 'artists-genres' and artists:
+        where, params = artist_filters(artists.get('name'), artists.get('genre'),
+                                       artists.get('fuzzy'))
+        conn = connect_read()
+        genre_counts = get_genre_counts(conn.cursor(), where, params)
+        conn.close()
+        data = pie_data(genre_counts) if genre_counts else ''
+    return data
+
+
+@views.route('/api/chart-data/<chart>')
+def chart_data(chart):
+    data = get_chart_series(chart)
+    if not data:
+        return jsonify({}), 404
+    return jsonify(data)
+
+
+@views.route('/metrics')
+def metrics():
+    metrics = current_app.extensions.get('metrics')
+    return jsonify(metrics.snapshot() if metrics is not None else [])
+
+
 @views.route('/change', methods=['GET', 'POST'])
 def change():
     if request.method == 'POST':
@@ -690,10 +1504,9 @@ def change():
         artist_column = request.form.get('artist_column')
         artist_new_value = request.form.get('artist_new_value')
 
-        conn = sqlite3.connect('Music.db')
-        cur = conn.cursor()
-
-        try:
+        # Runs in the writer thread, grouped with other editors' changes
+        def write(cur):
+            messages = []
             if song_name:
                 query = f'''INSERT INTO Song (Song, Artist, Album,
                     AlbumImageURL, TrackDuration, Explicit, Popularity, Danceability, Energy,
@@ -703,53 +1516,66 @@ def change():
                             song_duration, song_explicit, song_popularity, song_danceability,
                             song_energy, song_loudness, song_speechiness, song_acousticness,
                             song_instrumentalness, song_liveness, song_happiness, song_label, song_track_URL))
-                flash("Successfully inserted record.", category="success")
+                messages.append("Successfully inserted record.")
             elif album_name:
                 query = f'''INSERT INTO Album (Album, Artist, ReleaseDate, Genres,
                     AverageRating) VALUES (?, ?, ?, ?, ?)'''
                 cur.execute(query, (album_name, album_artist,
                             album_ReleaseDate, album_genres, album_average_rating))
-                flash("Successfully inserted record.", category="success")
+                messages.append("Successfully inserted record.")
             if artist_name:
                 query = f'''INSERT INTO Artist (Artist, facebook, twitter, website, genre,
                     mtv) VALUES (?, ?, ?, ?, ?, ?)'''
                 cur.execute(query, (artist_name, artist_facebook,
                             artist_twitter, artist_website, artist_genre, artist_mtv))
-                flash("Successfully inserted record.", category="success")
+                messages.append("Successfully inserted record.")
             if remove_song_title:
                 query = f'''DELETE FROM Song WHERE Song = ? AND Artist = ?'''
                 cur.execute(query, (remove_song_title, remove_song_artist))
-                flash("Successfully deleted record.", category="success")
+                messages.append("Successfully deleted record.")
             if remove_album_title:
                 query = '''DELETE FROM Album Where Album = ? AND Artist = ?'''
                 cur.execute(query, (remove_album_title, remove_album_artist))
-                flash("Successfully deleted record.", category="success")
+                messages.append("Successfully deleted record.")
             if remove_artist_name:
                 query = f'''DELETE FROM Artist WHERE Artist = ?'''
                 cur.execute(query, (remove_artist_name,))
-                flash("Successfully deleted record.", category="success")
+                messages.append("Successfully deleted record.")
             if song_to_update:
                 query = f'''UPDATE Song SET {song_column} = "{
                     song_new_value}" WHERE Song = "{song_to_update}" AND Artist = "{song_artist_to_update}"'''
                 cur.execute(query)
-                flash("Successfully updated record.", category="success")
+                messages.append("Successfully updated record.")
             if album_to_update:
                 query = f'''UPDATE Album SET {album_column} = "{
                     album_new_value}" WHERE Album = "{album_to_update}" AND Artist = "{album_artist_to_update}"'''
                 cur.execute(query)
-                flash("Successfully updated record.", category="success")
+                messages.append("Successfully updated record.")
             if artist_to_update:
                 query = f'''UPDATE Artist SET {artist_column} = "{
                     artist_new_value}" WHERE name = "{artist_to_update}"'''
                 cur.execute(query)
-                flash("Successfully updated record.", category="success")
+                messages.append("Successfully updated record.")
+            return messages
+
+        try:
+            messages = current_app.extensions['writer'].submit(write)
+        except sqlite3.OperationalError as e:
+            # Another process held the write lock for too long
+            if 'locked' not in str(e) and 'busy' not in str(e):
+                flash("Error: Something went wrong.", category="error")
+                return render_template('change.html')
+            metrics = current_app.extensions.get('metrics')
+            if metrics is not None:
+                metrics.record('database_locked', 'change', 'write')
+            flash("Error: The database is busy. Please try again.", category="error")
+            return render_template('change.html')
         except Exception:
             flash(f"Error: Something went wrong.", category="error")
             return render_template('change.html')
 
-        conn.commit()
-        cur.close()
-        conn.close()
+        for message in messages:
+            flash(message, category="success")
 
         return render_template("change.html")
     else:
@@ -0,0 +1,142 @@
+"""Serialized writes for /change.
+
+One thread per process owns the only read-write connection to Music.db.
+Requests hand it a function to run and wait for the result. Whatever
+arrives while a transaction is being prepared, up to WRITE_BATCH_SIZE
+functions within WRITE_BATCH_WINDOW seconds, is run in that same
+transaction, each in its own savepoint, and committed once. Editors never
+race each other for the write lock, and a burst of edits costs one fsync.
+Other processes still share the lock, which the connection waits up to 30
+seconds for.
+"""
+from concurrent.futures import Future
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+
+class Writer:
+    def __init__(self, database, window=0.005, batch_size=64, on_commit=None):
+        self.database = database
+        self.window = window
+        self.batch_size = batch_size
+        self.on_commit = on_commit
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.pid = None
+
+    '''
+        Run a write in the writer thread and wait for it to commit
+
+        args:
+            fn (callable): fn(cur) doing the write,
+            timeout (float): seconds to wait for the commit
+
+        returns:
+            whatever fn returned, once its transaction has committed;
+            an exception fn raised is raised here instead
+    '''
+
+    def submit(self, fn, timeout=60):
+        self.start()
+        future = Future()
+        self.jobs.put((fn, future))
+        return future.result(timeout)
+
+    def start(self):
+        # Threads don't survive fork, so each worker process starts its own
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.jobs = queue.Queue()
+                threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        conn = sqlite3.connect(self.database, timeout=30, isolation_level=None)
+        jobs = self.jobs
+        while True:
+            batch = [jobs.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(jobs.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.commit(conn, batch)
+
+    def commit(self, conn, batch):
+        cur = conn.cursor()
+        results = []
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            for fn, future in batch:
+                cur.execute('SAVEPOINT job')
+                try:
+                    result = fn(cur)
+                except Exception as e:
+                    cur.execute('ROLLBACK TO job')
+                    cur.execute('RELEASE job')
+                    results.append((future, e, None))
+                    continue
+                cur.execute('RELEASE job')
+                results.append((future, None, result))
+            cur.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for fn, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            cur.close()
+
+        if self.on_commit is not None:
+            try:
+                self.on_commit(conn)
+            except Exception:
+                pass
+
+        for future, error, result in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+'''
+    Create the writer when the app starts; after every commit it brings
+    the in-memory caches up to date from the change log
+
+    args:
+        app (Flask): application being created
+
+    returns:
+        Writer
+'''
+
+
+def init_writer(app):
+    from .views import sync_caches
+
+    def on_commit(conn):
+        feed = app.extensions.get('changefeed')
+        if feed is None:
+            return
+        with app.app_context():
+            touched = feed.catch_up(conn, sync_caches)
+        feed.prune(conn)
+
+        # Only the process that wrote republishes the feature store
+        store = app.extensions.get('feature_store')
+        if store is not None and touched['Song']:
+            store.schedule_rebuild()
+
+    writer = Writer(app.config['DATABASE'], app.config.get('WRITE_BATCH_WINDOW', 0.005),
+                    app.config.get('WRITE_BATCH_SIZE', 64), on_commit)
+    app.extensions['writer'] = writer
+    return writer